@@ -0,0 +1,138 @@
+# aila_backend/benchmarks/bench_compute_levels.py
+"""
+Benchmark for compute_levels' orphan rescue (step 5).
+
+Builds synthetic file graphs where a share of the nodes are orphans (no
+incoming edge from the root's tree). Many orphan labels are close to a
+reachable label, like LLM output that forgot an edge. The graphs go through
+compute_levels with the bigram top-k index (kg_index.NearestLabelIndex) and,
+up to --max-scan nodes, with the old scan over every reachable node. Reports
+time, how often both pick the same parent, and how much similarity the index
+gives up per orphan on average (mean gap). Runs in a throw-away working
+directory; no network needed.
+
+    python aila_backend/benchmarks/bench_compute_levels.py
+    python aila_backend/benchmarks/bench_compute_levels.py --sizes 100 1000 10000 --orphans 0.4
+"""
+import argparse
+import copy
+import os
+import random
+import sys
+import tempfile
+import time
+from difflib import SequenceMatcher
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+# English letter frequencies (per mille), so bigram statistics look like real concept labels
+LETTERS = "etaoinshrdlcumwfgypbvkjxqz"
+LETTER_WEIGHTS = [127, 91, 82, 75, 70, 67, 63, 61, 60, 43, 40, 28, 28, 24, 24, 22, 20, 20, 19, 15, 10, 8, 2, 2, 1, 1]
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="nodes per graph")
+    p.add_argument("--orphans", type=float, default=0.3, help="share of nodes with no path from the root")
+    p.add_argument("--related", type=float, default=0.7, help="share of orphans whose label resembles a reachable one")
+    p.add_argument("--max-scan", type=int, default=5000, help="largest size to also run the old scan on")
+    p.add_argument("--vocab", type=int, default=3000, help="distinct words labels are built from")
+    p.add_argument("--seed", type=int, default=0)
+    return p.parse_args()
+
+
+def make_graph(size: int, orphan_rate: float, related: float, seed: int, vocab: int):
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < vocab:
+        words.add("".join(rng.choices(LETTERS, LETTER_WEIGHTS, k=rng.randint(4, 10))))
+    words = sorted(words)
+
+    root = "lecture_root"
+    nodes = [{"id": root, "label": "Lecture Topic", "isRoot": True}]
+    edges = []
+    placed = []
+    for i in range(size - 1):
+        nid = f"n{i}"
+        if placed and rng.random() < orphan_rate:
+            if rng.random() < related:
+                # a sub-concept of something already in the tree, e.g. "hash table" -> "hash table resizing"
+                label = rng.choice(placed)[1] + " " + rng.choice(words)
+            else:
+                label = " ".join(rng.sample(words, rng.choice([1, 2, 3])))
+            nodes.append({"id": nid, "label": label})
+            continue
+        label = " ".join(rng.sample(words, rng.choice([1, 2, 2, 3])))
+        parent = root if len(placed) < 8 else rng.choice(placed)[0]
+        nodes.append({"id": nid, "label": label})
+        edges.append({"source": parent, "target": nid, "relation": "has_part"})
+        placed.append((nid, label))
+    return nodes, edges, root
+
+
+class _ScanIndex:
+    """The pre-index behaviour: ratio against every reachable label, first best wins."""
+
+    def __init__(self, normalize, **_):
+        self.normalize = normalize
+        self._norm = {}
+
+    def add(self, key, label):
+        self._norm.setdefault(key, self.normalize(label))
+
+    def best(self, label):
+        norm = self.normalize(label)
+        best_key, best_score = None, 0.0
+        for key, other in self._norm.items():
+            score = SequenceMatcher(None, norm, other).ratio()
+            if score > best_score:
+                best_key, best_score = key, score
+        return best_key, best_score
+
+
+def _parents(edges):
+    return {e["target"]: e["source"] for e in edges if e.get("relation") == "related"}
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("AILA_EMBEDDED_WORKERS", "0")
+    workdir = tempfile.mkdtemp(prefix="aila-bench-levels-")
+    os.chdir(workdir)  # importing main creates aila.db in the working directory
+    sys.path.insert(0, REPO_ROOT)
+
+    from aila_backend import main as app_main
+    from aila_backend.kg_index import NearestLabelIndex
+
+    print(f"{'nodes':>7} {'orphans':>7} {'indexed':>9} {'scan':>9} {'speed-up':>8} {'same parent':>12} {'mean gap':>9}")
+    for size in args.sizes:
+        nodes, edges, root = make_graph(size, args.orphans, args.related, args.seed, args.vocab)
+        orphans = len(nodes) - 1 - len(edges)
+
+        app_main.NearestLabelIndex = NearestLabelIndex
+        started = time.perf_counter()
+        _, indexed_edges = app_main.compute_levels(copy.deepcopy(nodes), copy.deepcopy(edges), root)
+        indexed_s = time.perf_counter() - started
+
+        scan_s, agreement, gap = None, "-", "-"
+        if size <= args.max_scan:
+            app_main.NearestLabelIndex = _ScanIndex
+            started = time.perf_counter()
+            _, scanned_edges = app_main.compute_levels(copy.deepcopy(nodes), copy.deepcopy(edges), root)
+            scan_s = time.perf_counter() - started
+            got, want = _parents(indexed_edges), _parents(scanned_edges)
+            same = sum(1 for nid, parent in want.items() if got.get(nid) == parent)
+            agreement = f"{100.0 * same / max(1, len(want)):.1f}%"
+            labels = {n["id"]: app_main._normalize_label(n.get("label", n["id"])) for n in nodes}
+            score = lambda nid, parent: SequenceMatcher(None, labels[nid], labels[parent]).ratio()
+            gap = f"{sum(score(nid, p) - score(nid, got[nid]) for nid, p in want.items()) / max(1, len(want)):.3f}"
+        app_main.NearestLabelIndex = NearestLabelIndex
+
+        print(f"{size:>7} {orphans:>7} {indexed_s:>8.2f}s "
+              f"{(f'{scan_s:.2f}s' if scan_s is not None else '-'):>9} "
+              f"{(f'{scan_s / indexed_s:.0f}x' if scan_s else '-'):>8} {agreement:>12} {gap:>9}")
+    print(f"workdir  : {workdir}")
+
+
+if __name__ == "__main__":
+    main()
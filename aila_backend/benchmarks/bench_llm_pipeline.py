@@ -0,0 +1,137 @@
+# aila_backend/benchmarks/bench_llm_pipeline.py
+"""
+Offline throughput benchmark for lecture processing and quiz generation.
+
+Runs the real endpoints (upload → two-pass KG → master merge, then quiz
+create → batched MCQ generation) against the deterministic FakeProvider, in
+a throw-away working directory so the real aila.db and LLM cache are never
+touched. No network or API key needed.
+
+    python aila_backend/benchmarks/bench_llm_pipeline.py --lectures 3 --slides 25
+    python aila_backend/benchmarks/bench_llm_pipeline.py --latency-ms 800 --rate-429 0.05 --rpm 15
+
+--rpm defaults high so the numbers measure the pipeline itself; pass 15 to
+see what the free-tier limiter does to the same workload.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--lectures", type=int, default=3, help="lectures to upload (one week each)")
+    p.add_argument("--slides", type=int, default=20, help="slides per generated lecture PDF")
+    p.add_argument("--quizzes", type=int, default=2, help="quizzes to generate per week")
+    p.add_argument("--latency-ms", type=float, default=200)
+    p.add_argument("--jitter-ms", type=float, default=50)
+    p.add_argument("--error-rate", type=float, default=0.0)
+    p.add_argument("--rate-429", type=float, default=0.0)
+    p.add_argument("--rpm", type=int, default=6000, help="limiter requests/minute per model")
+    p.add_argument("--seed", type=int, default=0)
+    return p.parse_args()
+
+
+TOPIC_WORDS = ["Stacks", "Queues", "Heaps", "Tries", "Graphs", "Sorting", "Hashing", "Recursion",
+               "Pointers", "Iterators", "Closures", "Generics", "Threads", "Sockets", "Indexes", "Joins"]
+
+
+def make_lecture_pdf(path: str, lecture_no: int, slides: int):
+    import fitz
+    doc = fitz.open()
+    for i in range(slides):
+        # three slides per topic, distinct topic names per lecture
+        topic = TOPIC_WORDS[(lecture_no * 5 + i // 3) % len(TOPIC_WORDS)]
+        page = doc.new_page()
+        page.insert_text((72, 72), topic, fontsize=24)
+        body = "\n".join(
+            f"Point {j + 1}: property {j} of {topic} and how it relates to the rest."
+            for j in range(8)
+        )
+        page.insert_text((72, 120), body, fontsize=11)
+    doc.save(path)
+    doc.close()
+
+
+def main():
+    args = parse_args()
+    os.environ.update({
+        "AILA_LLM_PROVIDER": "fake",
+        "AILA_LLM_CACHE": "off",
+        "AILA_EMBEDDED_WORKERS": "0",  # jobs are run inline below
+        "AILA_FAKE_LLM_LATENCY_MS": str(args.latency_ms),
+        "AILA_FAKE_LLM_JITTER_MS": str(args.jitter_ms),
+        "AILA_FAKE_LLM_ERROR_RATE": str(args.error_rate),
+        "AILA_FAKE_LLM_429_RATE": str(args.rate_429),
+        "AILA_FAKE_LLM_SEED": str(args.seed),
+    })
+    workdir = tempfile.mkdtemp(prefix="aila-bench-")
+    os.chdir(workdir)  # aila.db and db/uploads are relative paths
+    sys.path.insert(0, REPO_ROOT)
+
+    from fastapi.testclient import TestClient
+    from aila_backend import main as app_main
+    from aila_backend.llm_client import llm_client
+    from aila_backend.job_queue import get_queue
+
+    llm_client.rpm = args.rpm
+    client = TestClient(app_main.app)
+    course_id = "bench-course"
+
+    # ── lecture processing ────────────────────────────────────────────────
+    lecture_times, total_slides = [], 0
+    for n in range(1, args.lectures + 1):
+        pdf = os.path.join(workdir, f"lecture_{n}.pdf")
+        make_lecture_pdf(pdf, n, args.slides)
+        started = time.perf_counter()
+        with open(pdf, "rb") as f:
+            resp = client.post("/api/upload-lecture/", files={"file": (f"lecture_{n}.pdf", f, "application/pdf")},
+                               data={"course_id": course_id, "week": str(n)})
+        get_queue().run_one("bench-worker")  # what a worker.py process would do
+        status = client.get("/api/lecture-status/", params={"processing_id": resp.json()["processing_id"]}).json()
+        lecture_times.append(time.perf_counter() - started)
+        total_slides += args.slides
+        print(f"[BENCH] lecture {n}: {status['status']} in {lecture_times[-1]:.2f}s")
+
+    # ── quiz generation ───────────────────────────────────────────────────
+    quiz_times, mcq_count = [], 0
+    for week in range(1, args.lectures + 1):
+        nodes = client.get("/api/knowledge-graph", params={"courseid": course_id, "week": week}).json()["nodes"]
+        concept_ids = [node["id"] for node in nodes if not node.get("isRoot")]
+        for q in range(args.quizzes):
+            picked = concept_ids[q::args.quizzes][:8]
+            if not picked:
+                continue
+            quiz_id = client.post("/api/quiz/create", json={
+                "name": f"Bench W{week} Q{q}", "course_id": course_id, "week": week, "concept_ids": picked,
+            }).json()["quiz_id"]
+            started = time.perf_counter()
+            out = client.post(f"/api/quiz/generate-mcqs/{quiz_id}", json={}).json()
+            quiz_times.append(time.perf_counter() - started)
+            mcq_count += out.get("generated_mcqs", 0)
+
+    provider = llm_client.provider.stats()
+    lecture_total = sum(lecture_times)
+    quiz_total = sum(quiz_times)
+    print("\n===== AILA offline benchmark (FakeProvider) =====")
+    print(f"fake latency {args.latency_ms:.0f}±{args.jitter_ms:.0f}ms, "
+          f"errors {args.error_rate:.0%}, 429s {args.rate_429:.0%}, limiter {args.rpm} rpm")
+    print(f"lectures : {len(lecture_times)} in {lecture_total:.2f}s "
+          f"({lecture_total / max(1, len(lecture_times)):.2f}s each, "
+          f"{total_slides / max(lecture_total, 1e-9):.1f} slides/s)")
+    print(f"quizzes  : {len(quiz_times)} in {quiz_total:.2f}s, {mcq_count} MCQs "
+          f"({mcq_count / max(quiz_total, 1e-9):.1f} MCQs/s)")
+    print(f"LLM calls: {provider['calls']} "
+          f"(injected errors {provider['injected_errors']}, injected 429s {provider['injected_429s']})")
+    stages = client.get("/api/metrics", params={"prefix": "lecture_stage_seconds"}).json()["histograms"]
+    for series, h in stages.items():
+        print(f"  {series:<40} avg {h['avg']:.3f}s  max {h['max']:.3f}s")
+    print(f"workdir  : {workdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# aila_backend/benchmarks/bench_merge_graphs.py
+"""
+Scaling benchmark for merge_graphs' near-duplicate matching.
+
+Builds synthetic file graphs whose labels include near-duplicates (typos,
+plurals, reordered punctuation), then merges them with the bigram index
+(kg_index.LabelIndex) and, up to --max-scan nodes, with the old linear scan.
+It checks both produce identical output. Runs in a throw-away working
+directory; no network needed.
+
+    python aila_backend/benchmarks/bench_merge_graphs.py
+    python aila_backend/benchmarks/bench_merge_graphs.py --sizes 1000 5000 10000 20000 --max-scan 5000
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+# English letter frequencies (per mille), so bigram statistics look like real concept labels
+LETTERS = "etaoinshrdlcumwfgypbvkjxqz"
+LETTER_WEIGHTS = [127, 91, 82, 75, 70, 67, 63, 61, 60, 43, 40, 28, 28, 24, 24, 22, 20, 20, 19, 15, 10, 8, 2, 2, 1, 1]
+
+
+def make_vocabulary(size: int, rng: random.Random) -> list:
+    """Pseudo-words, so label overlap looks like a real course rather than a small toy vocabulary."""
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choices(LETTERS, LETTER_WEIGHTS, k=rng.randint(4, 10))))
+    return sorted(words)
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--sizes", type=int, nargs="+", default=[500, 2000, 10000],
+                   help="total nodes across all file graphs")
+    p.add_argument("--files", type=int, default=10, help="file graphs per week")
+    p.add_argument("--dup-rate", type=float, default=0.3, help="share of labels that are near-duplicates")
+    p.add_argument("--max-scan", type=int, default=2000, help="largest size to also run the linear scan on")
+    p.add_argument("--vocab", type=int, default=3000, help="distinct words labels are built from")
+    p.add_argument("--seed", type=int, default=0)
+    return p.parse_args()
+
+
+def _variant(label: str, rng: random.Random) -> str:
+    kind = rng.randrange(4)
+    if kind == 0:
+        return label + "s"
+    if kind == 1:
+        i = rng.randrange(len(label))
+        return label[:i] + rng.choice("abcdefghijklmnopqrstuvwxyz") + label[i + 1:]
+    if kind == 2:
+        return label.title() + "."
+    return label.replace(" ", "-")
+
+
+def make_graphs(total_nodes: int, files: int, dup_rate: float, seed: int, vocab: int = 3000) -> list:
+    rng = random.Random(seed)
+    words = make_vocabulary(vocab, rng)
+    seen = []
+    graphs = []
+    per_file = max(2, total_nodes // files)
+    for f in range(files):
+        root = f"file_{f}_root"
+        nodes = [{"id": root, "label": f"Lecture {f} Topic", "isRoot": True, "level": 0}]
+        edges = []
+        for i in range(per_file - 1):
+            if seen and rng.random() < dup_rate:
+                label = _variant(rng.choice(seen), rng)
+            else:
+                label = " ".join(rng.sample(words, rng.choice([1, 2, 2, 3])))
+                seen.append(label)
+            nid = f"f{f}_n{i}"
+            nodes.append({"id": nid, "label": label, "slide_nums": [rng.randint(1, 40)]})
+            parent = root if i < 8 else f"f{f}_n{rng.randrange(i)}"
+            edges.append({"source": parent, "target": nid, "relation": "has_part"})
+        graphs.append({"nodes": nodes, "edges": edges})
+    return graphs
+
+
+class _ScanIndex:
+    """The pre-index behaviour: linear scan over every merged node, in insertion order."""
+
+    def __init__(self, normalize, threshold=0.85, corpus=()):
+        self._labels = {}
+
+    def add(self, key, label):
+        self._labels[key] = label
+
+    def find(self, label, similar):
+        for key, existing in self._labels.items():
+            if similar(label, existing):
+                return key
+        return None
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("AILA_EMBEDDED_WORKERS", "0")
+    workdir = tempfile.mkdtemp(prefix="aila-bench-merge-")
+    os.chdir(workdir)  # importing main creates aila.db in the working directory
+    sys.path.insert(0, REPO_ROOT)
+
+    from aila_backend import main as app_main
+    from aila_backend.kg_index import LabelIndex
+
+    print(f"{'nodes':>7} {'merged':>7} {'indexed':>9} {'scan':>9} {'speed-up':>8}  identical")
+    for size in args.sizes:
+        graphs = make_graphs(size, args.files, args.dup_rate, args.seed, args.vocab)
+
+        app_main.LabelIndex = LabelIndex
+        started = time.perf_counter()
+        indexed = app_main.merge_graphs(copy.deepcopy(graphs), 1)
+        indexed_s = time.perf_counter() - started
+
+        scan_s, identical = None, "-"
+        if size <= args.max_scan:
+            app_main.LabelIndex = _ScanIndex
+            started = time.perf_counter()
+            scanned = app_main.merge_graphs(copy.deepcopy(graphs), 1)
+            scan_s = time.perf_counter() - started
+            identical = "yes" if json.dumps(scanned, sort_keys=True) == json.dumps(indexed, sort_keys=True) else "NO"
+        app_main.LabelIndex = LabelIndex
+
+        print(f"{size:>7} {len(indexed['nodes']):>7} {indexed_s:>8.2f}s "
+              f"{(f'{scan_s:.2f}s' if scan_s is not None else '-'):>9} "
+              f"{(f'{scan_s / indexed_s:.0f}x' if scan_s else '-'):>8}  {identical}")
+        if identical == "NO":
+            sys.exit("indexed merge differs from the linear scan")
+    print(f"workdir  : {workdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+# aila_backend/benchmarks/bench_quiz_submit.py
+"""
+Latency benchmark for POST /api/student/quiz/submit under a submit burst.
+
+Seeds a quiz with a question bank and one open attempt per student. Then all
+students submit at once (--students concurrent requests through the ASGI app,
+in one event loop like a single uvicorn worker). Reports p50 / p95 / p99 /
+max latency and wall time for the set-based endpoint and for the old
+per-question loop (two queries per answer), reproduced below as a route that
+exists only in the benchmark. Runs in a throw-away working directory; no
+network needed.
+
+--legacy-schema starts from an aila.db whose mcq_responses table has the
+old layout (surrogate id, no unique (attempt_id, mcq_id)) and duplicate
+answers. It checks that startup migrates it, and that submits, resubmits
+and per-answer writes through the group-commit writer
+(POST /api/quiz/attempt/submit, each answer sent twice) succeed on it.
+
+    python aila_backend/benchmarks/bench_quiz_submit.py
+    python aila_backend/benchmarks/bench_quiz_submit.py --students 200 --questions 25 --rounds 3
+    python aila_backend/benchmarks/bench_quiz_submit.py --legacy-schema --students 20 --rounds 1
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--students", type=int, default=200, help="concurrent submissions per burst")
+    p.add_argument("--questions", type=int, default=20, help="answers per submission")
+    p.add_argument("--bank", type=int, default=200, help="questions in the quiz bank")
+    p.add_argument("--rounds", type=int, default=3, help="bursts per endpoint (fresh attempts each)")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--legacy-schema", action="store_true",
+                   help="start from the pre-composite-key mcq_responses table")
+    return p.parse_args()
+
+
+# mcq_responses as the repo's original aila.db has it
+LEGACY_RESPONSES = """
+    CREATE TABLE mcq_responses (
+        id TEXT PRIMARY KEY,
+        attempt_id TEXT,
+        mcq_id TEXT,
+        question TEXT NOT NULL,
+        answered_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        selected_answer TEXT NOT NULL,
+        is_correct BOOLEAN DEFAULT 0,
+        FOREIGN KEY (attempt_id) REFERENCES quiz_attempts(id),
+        FOREIGN KEY (mcq_id) REFERENCES mcq(id)
+    )
+"""
+
+
+def make_legacy_db():
+    """aila.db with the legacy mcq_responses table: three answers to one question, one to another."""
+    import sqlite3
+
+    conn = sqlite3.connect("aila.db")
+    conn.execute(LEGACY_RESPONSES)
+    conn.executemany(
+        "INSERT INTO mcq_responses (id, attempt_id, mcq_id, question, answered_at, selected_answer) "
+        "VALUES (?, ?, ?, 'Q?', ?, ?)",
+        [("r1", "legacy", "m1", "2024-01-01 10:00:00", "old"),
+         ("r2", "legacy", "m1", "2024-01-01 10:05:00", "newest"),
+         ("r3", "legacy", "m1", "2024-01-01 10:01:00", "older"),
+         ("r4", "legacy", "m2", "2024-01-01 10:00:00", "only")],
+    )
+    conn.commit()
+    conn.close()
+
+
+def check_legacy_migration(app_main):
+    """Duplicates collapsed to the newest answer and the unique index exists."""
+    from sqlalchemy import text
+
+    with app_main.engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT mcq_id, selected_answer FROM mcq_responses WHERE attempt_id = 'legacy' ORDER BY mcq_id"
+        )).fetchall()
+        index = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ux_mcq_responses_attempt_mcq'"
+        )).first()
+    assert [tuple(r) for r in rows] == [("m1", "newest"), ("m2", "only")], rows
+    assert index, "ux_mcq_responses_attempt_mcq missing"
+
+
+def _legacy_route(app_main):
+    """The pre-batching submit loop: one MCQ query and one MCQResponse query per answer."""
+    from fastapi import Body, Depends
+    from aila_backend.models import MCQ, MCQResponse, QuizAttempt
+
+    @app_main.app.post("/bench/legacy-submit")
+    async def legacy_submit(payload: dict = Body(...), db=Depends(app_main.get_db)):
+        attempt_id, quiz_id = payload["attempt_id"], payload["quiz_id"]
+        attempt = db.query(QuizAttempt).filter(QuizAttempt.id == attempt_id).first()
+        correct_count = 0
+        for resp in payload["responses"]:
+            mcq = db.query(MCQ).filter(MCQ.id == resp["mcq_id"]).first()
+            if not mcq:
+                continue
+            is_correct = resp["selected_answer"] == mcq.answer
+            correct_count += is_correct
+            existing = db.query(MCQResponse).filter(
+                MCQResponse.attempt_id == attempt_id, MCQResponse.mcq_id == mcq.id
+            ).first()
+            if existing:
+                existing.selected_answer = resp["selected_answer"]
+                existing.is_correct = is_correct
+            else:
+                db.add(MCQResponse(attempt_id=attempt_id, mcq_id=mcq.id, question=mcq.question,
+                                   selected_answer=resp["selected_answer"], is_correct=is_correct))
+        attempt.score = correct_count
+        attempt.total_questions = len(payload["responses"])
+        attempt.completed = True
+        db.commit()
+        await app_main.manager.broadcast(quiz_id, {"type": "submission"})
+        return {"success": True, "score": correct_count}
+
+
+def seed(app_main, args, rng):
+    from aila_backend.models import MCQ, Quiz, QuizAttempt
+
+    db = app_main.SessionLocal()
+    quiz_id = str(uuid.uuid4())
+    db.add(Quiz(id=quiz_id, name="Bench quiz", course_id="bench", week=1))
+    bank = []
+    for i in range(args.bank):
+        options = [f"option {i}.{j}" for j in range(4)]
+        mcq = MCQ(id=str(uuid.uuid4()), quiz_id=quiz_id, concept_id=f"c{i % 10}",
+                  question=f"Question {i}?", options=options, answer=options[0],
+                  bloom_level="Remember", difficulty="Medium")
+        db.add(mcq)
+        bank.append((mcq.id, options))
+    db.commit()
+
+    def new_burst():
+        payloads = []
+        for s in range(args.students):
+            attempt_id = str(uuid.uuid4())
+            db.add(QuizAttempt(id=attempt_id, quiz_id=quiz_id, student_id=f"s{s}",
+                               score=0, total_questions=0, completed=False))
+            payloads.append({
+                "attempt_id": attempt_id, "student_id": f"s{s}", "quiz_id": quiz_id,
+                "responses": [{"mcq_id": mcq_id, "selected_answer": rng.choice(options)}
+                              for mcq_id, options in rng.sample(bank, args.questions)],
+            })
+        db.commit()
+        return payloads
+
+    return new_burst
+
+
+async def answer_each(client, payloads):
+    """Every answer of every payload through /api/quiz/attempt/submit, twice, all at once."""
+    async def one(attempt_id, resp):
+        r = await client.post("/api/quiz/attempt/submit", data={
+            "attempt_id": attempt_id, "mcq_id": resp["mcq_id"], "selected": resp["selected_answer"],
+        })
+        r.raise_for_status()
+
+    await asyncio.gather(*(one(p["attempt_id"], resp) for p in payloads
+                           for resp in p["responses"] for _ in range(2)))
+
+
+async def burst(client, url, payloads):
+    async def one(payload):
+        started = time.perf_counter()
+        r = await client.post(url, json=payload)
+        r.raise_for_status()
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*(one(p) for p in payloads))
+    return sorted(latencies), time.perf_counter() - started
+
+
+def pct(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def main():
+    args = parse_args()
+    os.environ.update({"AILA_LLM_PROVIDER": "fake", "AILA_EMBEDDED_WORKERS": "0"})
+    workdir = tempfile.mkdtemp(prefix="aila-bench-submit-")
+    os.chdir(workdir)  # aila.db is a relative path
+    sys.path.insert(0, REPO_ROOT)
+    if args.legacy_schema:
+        make_legacy_db()
+
+    import httpx
+    from aila_backend import main as app_main
+
+    if args.legacy_schema:
+        check_legacy_migration(app_main)
+    _legacy_route(app_main)
+    new_burst = seed(app_main, args, random.Random(args.seed))
+
+    async def run():
+        transport = httpx.ASGITransport(app=app_main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            results = {}
+            if args.legacy_schema:
+                await answer_each(client, new_burst())
+            for name, url in (("set-based", "/api/student/quiz/submit"), ("per-row", "/bench/legacy-submit")):
+                latencies, walls = [], []
+                for _ in range(args.rounds):
+                    payloads = new_burst()
+                    lat, wall = await burst(client, url, payloads)
+                    latencies += lat
+                    walls.append(wall)
+                if args.legacy_schema:
+                    await burst(client, url, payloads)  # resubmit: every answer hits ON CONFLICT
+                results[name] = (sorted(latencies), sum(walls) / len(walls))
+            return results
+
+    with contextlib.redirect_stdout(io.StringIO()):  # the endpoints print per submission
+        results = asyncio.run(run())
+
+    if args.legacy_schema:
+        print("legacy mcq_responses schema: migrated; submits, resubmits and answer writes ok")
+    print(f"{args.students} concurrent submits x {args.questions} answers, {args.rounds} round(s)")
+    print(f"{'endpoint':>10} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'burst':>8}")
+    for name, (lat, wall) in results.items():
+        print(f"{name:>10} " + " ".join(f"{pct(lat, q) * 1000:>6.0f}ms" for q in (0.5, 0.95, 0.99))
+              + f" {lat[-1] * 1000:>6.0f}ms {wall:>7.2f}s")
+    print(f"workdir  : {workdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+# aila_backend/benchmarks/bench_write_queue.py
+"""
+Sustained write throughput for the quiz answer path.
+
+Every write is what POST /api/quiz/attempt/submit does: upsert one
+mcq_responses row and update the attempt's responses JSON. The same
+--writes are run three ways:
+
+  per-write commit, rollback journal — --writers threads, each committing
+      its own writes on the pre-WAL settings (journal_mode=DELETE,
+      synchronous=FULL, 5s lock timeout). Counts "database is locked" failures.
+  per-write commit, WAL — the same threads on the WAL / busy_timeout engine.
+  group commit, WAL — --concurrency coroutines handing writes to
+      write_queue.GroupCommitWriter.
+
+Each variant gets its own SQLite file in a throw-away working directory.
+
+    python aila_backend/benchmarks/bench_write_queue.py
+    python aila_backend/benchmarks/bench_write_queue.py --writes 20000 --writers 32 --concurrency 400
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--writes", type=int, default=5000, help="answers written per variant")
+    p.add_argument("--writers", type=int, default=16, help="threads for the per-write commit variants")
+    p.add_argument("--concurrency", type=int, default=200, help="in-flight writes for the group commit variant")
+    p.add_argument("--attempts", type=int, default=200, help="attempts the answers are spread over")
+    return p.parse_args()
+
+
+def make_sessions(path: str, wal: bool):
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.orm import sessionmaker
+    from aila_backend.database import Base, _sqlite_pragmas
+
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False, "timeout": 5})
+    if wal:
+        event.listen(engine, "connect", _sqlite_pragmas)
+    Base.metadata.create_all(engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def seed(session_factory, attempts: int):
+    from aila_backend.models import QuizAttempt
+
+    db = session_factory()
+    for a in range(attempts):
+        db.add(QuizAttempt(id=f"a{a}", quiz_id="bench", student_id=f"s{a}",
+                           score=0, total_questions=0, completed=False, responses={}))
+    db.commit()
+    db.close()
+
+
+def make_write(i: int, attempts: int):
+    """The submit_mcq_answer write for answer i."""
+    from aila_backend.main import _upsert_responses
+    from aila_backend.models import QuizAttempt
+
+    attempt_id, mcq_id = f"a{i % attempts}", f"m{i}"
+
+    def write(wdb):
+        attempt = wdb.get(QuizAttempt, attempt_id)
+        attempt.responses = {**(attempt.responses or {}), mcq_id: {"selected": "a", "correct": True}}
+        _upsert_responses(wdb, [{"attempt_id": attempt_id, "mcq_id": mcq_id, "question": "Q?",
+                                 "selected_answer": "a", "is_correct": True}])
+    return write
+
+
+def run_per_write(session_factory, args):
+    from sqlalchemy.exc import OperationalError
+
+    failures = [0]
+    lock = threading.Lock()
+
+    def worker(w):
+        db = session_factory()
+        for i in range(w, args.writes, args.writers):
+            try:
+                make_write(i, args.attempts)(db)
+                db.commit()
+            except OperationalError:
+                db.rollback()
+                with lock:
+                    failures[0] += 1
+        db.close()
+
+    threads = [threading.Thread(target=worker, args=(w,)) for w in range(args.writers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - started, failures[0]
+
+
+def run_group_commit(session_factory, args):
+    from aila_backend.write_queue import GroupCommitWriter
+
+    writer = GroupCommitWriter(session_factory)
+
+    async def run():
+        gate = asyncio.Semaphore(args.concurrency)
+
+        async def one(i):
+            async with gate:
+                await writer.run(make_write(i, args.attempts))
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(one(i) for i in range(args.writes)), return_exceptions=True)
+        return time.perf_counter() - started, sum(1 for r in results if isinstance(r, Exception))
+
+    return asyncio.run(run())
+
+
+def main():
+    args = parse_args()
+    os.environ.update({"AILA_LLM_PROVIDER": "fake", "AILA_EMBEDDED_WORKERS": "0"})
+    workdir = tempfile.mkdtemp(prefix="aila-bench-writes-")
+    os.chdir(workdir)  # importing main creates aila.db in the working directory
+    sys.path.insert(0, REPO_ROOT)
+
+    import aila_backend.main  # noqa: F401  (registers every model on Base)
+
+    variants = [
+        ("per-write commit, rollback journal", False, run_per_write),
+        ("per-write commit, WAL", True, run_per_write),
+        ("group commit, WAL", True, run_group_commit),
+    ]
+    print(f"{args.writes} answers over {args.attempts} attempts")
+    print(f"{'variant':>36} {'seconds':>8} {'writes/s':>9} {'failed':>7}")
+    for n, (name, wal, run) in enumerate(variants):
+        sessions = make_sessions(os.path.join(workdir, f"bench{n}.db"), wal)
+        seed(sessions, args.attempts)
+        seconds, failed = run(sessions, args)
+        print(f"{name:>36} {seconds:>8.2f} {(args.writes - failed) / seconds:>9.0f} {failed:>7}")
+    print(f"workdir  : {workdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,35 @@
 # aila_backend/database.py
-from sqlalchemy import create_engine
+import os
+
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./aila.db"
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("AILA_SQLITE_BUSY_TIMEOUT_MS", 10000))
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
     connect_args={"check_same_thread": False}
 )
 
+
+@event.listens_for(engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _):
+    """
+    WAL: readers don't block the writer and vice versa. busy_timeout: a
+    writer waits this long for the lock instead of raising "database is
+    locked". synchronous=NORMAL is crash-safe in WAL mode (a power loss can
+    drop the last commits, never corrupt the file) and avoids an fsync per commit.
+    """
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -21,3 +40,31 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+def ensure_columns(table_name: str, columns: dict):
+    """
+    create_all() never alters an existing table and there's no migration
+    tool, so new columns on old tables are added here.
+    columns maps name -> column DDL, e.g. {"attempts": "INTEGER DEFAULT 0"}.
+    """
+    insp = inspect(engine)
+    if not insp.has_table(table_name):
+        return
+    existing = {c["name"] for c in insp.get_columns(table_name)}
+    with engine.begin() as conn:
+        for name, ddl in columns.items():
+            if name not in existing:
+                conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {name} {ddl}"))
+                print(f"[DB] Added column {table_name}.{name}")
+
+
+def ensure_indexes(indexes: dict, unique: bool = False):
+    """
+    Create indexes that create_all() skipped because their table already existed.
+    unique=True builds UNIQUE indexes; the caller removes duplicates first.
+    """
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    with engine.begin() as conn:
+        for name, ddl in indexes.items():
+            conn.execute(text(f"CREATE {kind} IF NOT EXISTS {name} ON {ddl}"))
@@ -0,0 +1,397 @@
+# aila_backend/job_queue.py
+"""
+Durable queue for lecture processing jobs.
+
+Uploads used to run process_lecture_and_kg as a FastAPI BackgroundTask,
+inside the web process. That work was lost on restart, had no concurrency
+limit, and held the GIL during PyMuPDF parsing. Uploads are now enqueued
+here and run by separate worker processes (worker.py).
+
+The lecture_processing table is the queue's status view: one row per
+upload, whose status goes pending -> processing -> done | error. A failed
+attempt goes back to pending with a backoff until max_attempts is used up.
+
+Two backends, picked with AILA_JOB_BACKEND:
+
+  sqlite (default) — single-box installs. The row *is* the queue entry.
+      Workers claim a row with a conditional UPDATE and hold a lease
+      (visibility timeout) that a heartbeat keeps extending. If a worker
+      dies, its lease expires and another worker picks the job up.
+      Per-course fairness: the next claim goes to the course served least
+      recently, and at most AILA_JOB_MAX_PER_COURSE jobs of one course run
+      at once.
+
+  redis — rq queues at AILA_REDIS_URL. Courses are hashed onto a few shard
+      queues and workers dequeue round-robin across them. rq provides the
+      retries (Retry), and job_timeout acts as the visibility timeout. The
+      row is still updated, so the status API is the same for both backends.
+"""
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+import zlib
+
+from sqlalchemy import and_, func, or_
+
+from aila_backend.database import SessionLocal
+from aila_backend.models import LectureProcessing
+from aila_backend.progress_bus import publish as publish_progress
+
+
+JOB_BACKEND            = os.environ.get("AILA_JOB_BACKEND", "sqlite").lower()
+REDIS_URL              = os.environ.get("AILA_REDIS_URL", "redis://localhost:6379/0")
+VISIBILITY_TIMEOUT     = float(os.environ.get("AILA_JOB_VISIBILITY_TIMEOUT", 600))
+MAX_ATTEMPTS           = int(os.environ.get("AILA_JOB_MAX_ATTEMPTS", 3))
+MAX_RUNNING_PER_COURSE = int(os.environ.get("AILA_JOB_MAX_PER_COURSE", 1))
+RETRY_BACKOFF          = [30, 120, 300]  # seconds before attempt 2, 3, 4...
+POLL_INTERVAL          = 1.0
+REDIS_SHARDS           = 4
+REDIS_QUEUE_PREFIX     = "aila-lectures"
+
+
+def make_worker_id(prefix: str = "worker") -> str:
+    return f"{prefix}-{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+def _backoff(attempt: int) -> float:
+    return RETRY_BACKOFF[min(max(attempt, 1) - 1, len(RETRY_BACKOFF) - 1)]
+
+
+def _run_pipeline(processing_id: str):
+    """
+    Run the lecture pipeline for one row. Raises if processing failed.
+    Deduplicated uploads (stats["dedup"]) only need their master merge.
+    """
+    # heavy import, only in workers
+    from aila_backend.main import process_lecture_and_kg, merge_deduplicated_upload
+
+    db = SessionLocal()
+    try:
+        job = db.query(LectureProcessing).filter(LectureProcessing.id == processing_id).first()
+        if not job:
+            raise ValueError(f"Job {processing_id} not found")
+        args = (job.file_path, job.upload_id or job.id, job.course_id, job.week, job.file_name, job.id)
+        dedup = bool((job.stats or {}).get("dedup"))
+    finally:
+        db.close()
+    if dedup:
+        merge_deduplicated_upload(processing_id, args[2], args[3])
+        return
+    if not args[0] or not os.path.exists(args[0]):
+        raise FileNotFoundError(f"Upload file missing for job {processing_id}: {args[0]}")
+    process_lecture_and_kg(*args, raise_on_error=True)
+
+
+def _record_failure(processing_id: str, error: str, retry_in: float = None):
+    """Mark a failed attempt: back to pending (retry_in seconds) or terminal error."""
+    db = SessionLocal()
+    try:
+        values = {"worker_id": None, "lease_expires_at": None, "progress": 0}
+        if retry_in is not None:
+            values.update({
+                "status": "pending",
+                "available_at": time.time() + retry_in,
+                "error_message": f"{error[:400]} (retrying in {retry_in:.0f}s)",
+            })
+        else:
+            values.update({"status": "error", "error_message": error[:500]})
+        db.query(LectureProcessing).filter(LectureProcessing.id == processing_id).update(values)
+        db.commit()
+    finally:
+        db.close()
+    publish_progress(processing_id, "retry" if retry_in is not None else "error", progress=0,
+                     status=values["status"], error=values["error_message"])
+
+
+# ── SQLite backend ──────────────────────────────────────────────────────────
+class SQLiteJobQueue:
+    name = "sqlite"
+
+    def submit(self, job: LectureProcessing):
+        pass  # the committed row is already claimable
+
+    def _claimable(self, now: float):
+        LP = LectureProcessing
+        return and_(
+            LP.file_path.isnot(None),
+            or_(
+                and_(LP.status == "pending", or_(LP.available_at.is_(None), LP.available_at <= now)),
+                # visibility timeout: a claim whose lease lapsed is up for grabs again
+                and_(LP.status == "processing", LP.lease_expires_at.isnot(None), LP.lease_expires_at < now),
+            ),
+        )
+
+    def claim(self, worker_id: str):
+        """Lease the next job, fairly across courses. Returns its id or None."""
+        LP = LectureProcessing
+        now = time.time()
+        db = SessionLocal()
+        try:
+            candidates = (
+                db.query(LP).filter(self._claimable(now))
+                .order_by(LP.available_at, LP.created_at).limit(200).all()
+            )
+            if not candidates:
+                return None
+            running = dict(
+                db.query(LP.course_id, func.count(LP.id))
+                .filter(LP.status == "processing", LP.lease_expires_at >= now)
+                .group_by(LP.course_id).all()
+            )
+            last_served = dict(
+                db.query(LP.course_id, func.max(LP.claimed_at)).group_by(LP.course_id).all()
+            )
+            oldest_per_course = {}
+            for job in candidates:  # already oldest-first
+                if running.get(job.course_id, 0) >= MAX_RUNNING_PER_COURSE:
+                    continue
+                oldest_per_course.setdefault(job.course_id, job)
+            # Least recently served course goes first; never-served courses first of all
+            for course_id in sorted(oldest_per_course, key=lambda c: last_served.get(c) or 0):
+                job = oldest_per_course[course_id]
+                if job.status == "processing" and (job.attempts or 0) >= (job.max_attempts or MAX_ATTEMPTS):
+                    # Worker(s) died on every attempt — stop handing it out
+                    db.query(LP).filter(LP.id == job.id, LP.status == "processing").update({
+                        "status": "error", "worker_id": None, "lease_expires_at": None,
+                        "error_message": "Worker lost on final attempt (visibility timeout expired)",
+                    }, synchronize_session=False)
+                    db.commit()
+                    publish_progress(job.id, "error", progress=0, status="error",
+                                     error="Worker lost on final attempt (visibility timeout expired)")
+                    continue
+                # Conditional update: only one worker wins a given (status, attempts) state
+                job_id, prev_status, prev_worker, attempts = job.id, job.status, job.worker_id, job.attempts
+                won = db.query(LP).filter(
+                    LP.id == job_id, LP.status == prev_status, LP.attempts == attempts,
+                ).update({
+                    "status": "processing",
+                    "worker_id": worker_id,
+                    "attempts": (attempts or 0) + 1,
+                    "claimed_at": now,
+                    "lease_expires_at": now + VISIBILITY_TIMEOUT,
+                }, synchronize_session=False)
+                db.commit()
+                if won:
+                    if prev_status == "processing":
+                        print(f"[QUEUE] Reclaimed {job_id} from {prev_worker} (lease expired)")
+                    return job_id
+            return None
+        finally:
+            db.close()
+
+    def heartbeat(self, processing_id: str, worker_id: str) -> bool:
+        """Extend the lease. False means another worker has taken the job over."""
+        db = SessionLocal()
+        try:
+            n = db.query(LectureProcessing).filter(
+                LectureProcessing.id == processing_id, LectureProcessing.worker_id == worker_id,
+            ).update({"lease_expires_at": time.time() + VISIBILITY_TIMEOUT}, synchronize_session=False)
+            db.commit()
+            return bool(n)
+        finally:
+            db.close()
+
+    def release(self, processing_id: str, worker_id: str):
+        db = SessionLocal()
+        try:
+            db.query(LectureProcessing).filter(
+                LectureProcessing.id == processing_id, LectureProcessing.worker_id == worker_id,
+            ).update({"worker_id": None, "lease_expires_at": None}, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def fail(self, processing_id: str, worker_id: str, error: str):
+        db = SessionLocal()
+        try:
+            job = db.query(LectureProcessing).filter(LectureProcessing.id == processing_id).first()
+            if not job or job.worker_id != worker_id:
+                return  # lease was lost; the new owner decides
+            attempts, max_attempts = job.attempts or 1, job.max_attempts or MAX_ATTEMPTS
+        finally:
+            db.close()
+        retry_in = _backoff(attempts) if attempts < max_attempts else None
+        _record_failure(processing_id, error, retry_in)
+
+    def run_one(self, worker_id: str) -> bool:
+        """Claim and run a single job. Returns False when nothing was claimable."""
+        processing_id = self.claim(worker_id)
+        if not processing_id:
+            return False
+        print(f"[QUEUE] {worker_id} running {processing_id}")
+        stop = threading.Event()
+
+        def _beat():
+            while not stop.wait(VISIBILITY_TIMEOUT / 3):
+                if not self.heartbeat(processing_id, worker_id):
+                    print(f"[QUEUE] {worker_id} lost the lease on {processing_id}")
+                    return
+
+        beater = threading.Thread(target=_beat, name=f"lease-{processing_id[:8]}", daemon=True)
+        beater.start()
+        try:
+            _run_pipeline(processing_id)
+            self.release(processing_id, worker_id)
+        except Exception as e:
+            traceback.print_exc()
+            self.fail(processing_id, worker_id, str(e))
+        finally:
+            stop.set()
+        return True
+
+    def work(self, worker_id: str = None, stop_event: threading.Event = None):
+        worker_id = worker_id or make_worker_id()
+        stop_event = stop_event or threading.Event()
+        print(f"[QUEUE] {worker_id} polling SQLite queue")
+        while not stop_event.is_set():
+            try:
+                if not self.run_one(worker_id):
+                    stop_event.wait(POLL_INTERVAL)
+            except Exception as e:  # DB hiccup — back off and keep serving
+                print(f"[QUEUE] {worker_id} loop error: {e}")
+                stop_event.wait(POLL_INTERVAL * 5)
+
+
+# ── Redis / rq backend ──────────────────────────────────────────────────────
+class RedisJobQueue:
+    name = "redis"
+
+    def __init__(self, url: str = REDIS_URL):
+        from redis import Redis
+        from rq import Queue
+        self.connection = Redis.from_url(url)
+        self.queues = [
+            Queue(f"{REDIS_QUEUE_PREFIX}-{i}", connection=self.connection) for i in range(REDIS_SHARDS)
+        ]
+
+    def queue_for(self, course_id: str):
+        return self.queues[zlib.crc32((course_id or "").encode("utf-8")) % REDIS_SHARDS]
+
+    def submit(self, job: LectureProcessing):
+        from rq import Retry
+        retries = max(0, (job.max_attempts or MAX_ATTEMPTS) - 1)
+        rq_job = self.queue_for(job.course_id).enqueue(
+            "aila_backend.job_queue.run_rq_job", job.id,
+            job_id=job.id,
+            job_timeout=int(VISIBILITY_TIMEOUT),
+            retry=Retry(max=retries, interval=RETRY_BACKOFF[:retries]) if retries else None,
+        )
+        return rq_job.id
+
+    def work(self, worker_id: str = None, stop_event=None):
+        from rq import Worker
+        from rq.worker import DequeueStrategy
+        worker = Worker(self.queues, connection=self.connection, name=worker_id or make_worker_id("rq"))
+        worker.work(dequeue_strategy=DequeueStrategy.ROUND_ROBIN)
+
+
+def run_rq_job(processing_id: str):
+    """rq entry point: mirror the attempt into the status row, then run the pipeline."""
+    from rq import get_current_job
+    rq_job = get_current_job()
+    db = SessionLocal()
+    try:
+        db.query(LectureProcessing).filter(LectureProcessing.id == processing_id).update({
+            "status": "processing",
+            "attempts": LectureProcessing.attempts + 1,
+            "worker_id": rq_job.worker_name if rq_job else None,
+            "claimed_at": time.time(),
+        }, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+    try:
+        _run_pipeline(processing_id)
+    except Exception as e:
+        retries_left = getattr(rq_job, "retries_left", 0) or 0
+        _record_failure(processing_id, str(e), _backoff(MAX_ATTEMPTS - retries_left) if retries_left else None)
+        raise  # let rq schedule the retry / record the failure
+
+
+# ── public API ──────────────────────────────────────────────────────────────
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = RedisJobQueue() if JOB_BACKEND == "redis" else SQLiteJobQueue()
+        return _queue
+
+
+def enqueue_lecture(db, processing_id: str, file_path: str, course_id: str, week: int,
+                    file_name: str, upload_id: str = None, content_hash: str = None,
+                    progress: int = 0, stats: dict = None) -> LectureProcessing:
+    """
+    Create the status row for an upload and hand it to the queue backend.
+    Commits the session, including anything the caller added to it.
+    """
+    job = LectureProcessing(
+        id=processing_id,
+        course_id=course_id,
+        week=week,
+        file_name=file_name,
+        status="pending",
+        progress=progress,
+        file_path=file_path,
+        upload_id=upload_id or processing_id,
+        attempts=0,
+        max_attempts=MAX_ATTEMPTS,
+        available_at=time.time(),
+        content_hash=content_hash,
+        stats=stats,
+    )
+    db.add(job)
+    db.commit()
+    backend_job_id = get_queue().submit(job)
+    if backend_job_id:
+        job.backend_job_id = backend_job_id
+        db.commit()
+    return job
+
+
+def queue_stats(db) -> dict:
+    LP = LectureProcessing
+    now = time.time()
+    by_status = dict(db.query(LP.status, func.count(LP.id)).group_by(LP.status).all())
+    pending_by_course = dict(
+        db.query(LP.course_id, func.count(LP.id)).filter(LP.status == "pending").group_by(LP.course_id).all()
+    )
+    stale = db.query(func.count(LP.id)).filter(
+        LP.status == "processing", LP.lease_expires_at.isnot(None), LP.lease_expires_at < now
+    ).scalar()
+    return {
+        "backend": get_queue().name,
+        "by_status": by_status,
+        "pending_by_course": pending_by_course,
+        "expired_leases": stale,
+        "visibility_timeout_s": VISIBILITY_TIMEOUT,
+        "max_attempts": MAX_ATTEMPTS,
+        "max_running_per_course": MAX_RUNNING_PER_COURSE,
+    }
+
+
+def start_embedded_workers(count: int) -> list:
+    """
+    Worker threads inside the web process, so a bare `uvicorn main:app`
+    still processes uploads. Production should run worker.py instead and set
+    AILA_EMBEDDED_WORKERS=0.
+    """
+    queue = get_queue()
+    if count <= 0:
+        return []
+    if queue.name != "sqlite":
+        print("[QUEUE] Embedded workers only support the sqlite backend — start worker.py for rq")
+        return []
+    threads = []
+    for i in range(count):
+        t = threading.Thread(target=queue.work, args=(make_worker_id(f"embedded{i}"),),
+                             name=f"lecture-worker-{i}", daemon=True)
+        t.start()
+        threads.append(t)
+    return threads
@@ -0,0 +1,127 @@
+# aila_backend/kg_cache.py
+"""
+Process-local cache of parsed knowledge graphs.
+
+Keyed on (course, week, graph_type, source_file). Each entry holds the node
+and edge lists, an id -> node dict and adjacency lists. A lookup first reads
+the row's (id, version) without its blobs, a single-row query. The JSON is
+parsed again only if that differs from the cached entry. Every KG write bumps
+knowledge_graph.version, so writes from worker processes invalidate entries
+in the web process too. Eviction is LRU, bounded by the size of the cached
+JSON (AILA_KG_CACHE_MAX_BYTES).
+
+Entries are shared between requests: treat them as read-only.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict, defaultdict
+
+from sqlalchemy import text as sql_text
+
+from aila_backend.metrics import metrics
+
+
+CACHE_MAX_BYTES = int(os.environ.get("AILA_KG_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+
+class CachedGraph:
+    __slots__ = ("graph_id", "version", "nodes", "edges", "by_id", "children", "parents", "size")
+
+    def __init__(self, graph_id, version, nodes, edges, size):
+        self.graph_id = graph_id
+        self.version = version
+        self.nodes = nodes
+        self.edges = edges
+        self.size = size
+        self.by_id = {}
+        for n in nodes:
+            if isinstance(n, dict) and "id" in n:
+                self.by_id.setdefault(n["id"], n)  # first occurrence wins, like next(...) did
+        self.children = defaultdict(list)  # node id -> edges out
+        self.parents = defaultdict(list)   # node id -> edges in
+        for e in edges:
+            if isinstance(e, dict):
+                self.children[e.get("source")].append(e)
+                self.parents[e.get("target")].append(e)
+
+
+class KGCache:
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> CachedGraph, least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _query(self, course_id, week, graph_type, source_file, columns):
+        sql = f"SELECT {columns} FROM knowledge_graph WHERE course_id=:c AND week=:w AND graph_type=:t"
+        params = {"c": course_id, "w": week, "t": graph_type}
+        if source_file is not None:
+            sql += " AND source_file=:f"
+            params["f"] = source_file
+        return sql_text(sql + " LIMIT 1"), params
+
+    def get(self, db, course_id, week, graph_type: str = "master", source_file: str = None):
+        """The parsed graph, or None if there is no such row or its JSON is unreadable."""
+        key = (course_id, week, graph_type, source_file)
+        stmt, params = self._query(course_id, week, graph_type, source_file, "id, version")
+        row = db.execute(stmt, params).fetchone()
+        if row is None:
+            self.invalidate(*key)
+            return None
+        graph_id, version = row[0], row[1] or 0
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.graph_id == graph_id and entry.version == version:
+                self._entries.move_to_end(key)
+                metrics.inc("kg_cache_total", outcome="hit")
+                return entry
+
+        metrics.inc("kg_cache_total", outcome="miss")
+        blobs = db.execute(
+            sql_text("SELECT node_data, edge_data, version FROM knowledge_graph WHERE id=:id"),
+            {"id": graph_id}
+        ).fetchone()
+        if blobs is None:
+            return None
+        try:
+            nodes = json.loads(blobs[0]) if blobs[0] else []
+            edges = json.loads(blobs[1]) if blobs[1] else []
+        except (TypeError, ValueError):
+            print(f"[KG CACHE] Unreadable graph JSON in {graph_id}")
+            return None
+        # the version read with the blobs, in case a write landed in between
+        entry = CachedGraph(graph_id, blobs[2] or 0, nodes, edges,
+                            size=len(blobs[0] or "") + len(blobs[1] or ""))
+        self._put(key, entry)
+        return entry
+
+    def _put(self, key, entry):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            if entry.size > self.max_bytes:
+                return  # too big to keep; the caller still gets it
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while self._bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                metrics.inc("kg_cache_evictions_total")
+
+    def invalidate(self, course_id, week, graph_type: str = None, source_file: str = None):
+        """Drop cached entries of a course week (all graph types unless given)."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == course_id and k[1] == week
+                        and (graph_type is None or k[2] == graph_type)
+                        and (source_file is None or k[3] == source_file)]:
+                self._bytes -= self._entries.pop(key).size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+kg_cache = KGCache()
@@ -0,0 +1,222 @@
+# aila_backend/kg_index.py
+"""
+Candidate blocking for near-duplicate concept labels.
+
+merge_graphs used to compare every incoming label against every merged node
+with SequenceMatcher (_similar_labels), which is quadratic in the nodes of a
+week. LabelIndex keeps a character-bigram inverted index over the normalized
+labels. It narrows each lookup to labels that *could* pass the similarity
+check, and runs the exact check only on those.
+
+The blocking is lossless, so merge output is unchanged. For SequenceMatcher,
+ratio = 2M / S, where M is the number of matched characters and S = |a| + |b|.
+M is spread over k matching blocks, and consecutive blocks are separated by
+at least one unmatched character, so k - 1 <= S - 2M. A block of length L
+gives L - 1 bigrams that both labels contain. So the shared bigram count is
+at least 3M - S - 1, and ratio >= t implies M >= tS/2. Labels shorter than 4
+characters only match exactly, which a separate dict covers. With both
+labels at least 4 characters long (S >= 8), the bound is at least one shared
+bigram for any threshold above 0.75. The default of 0.85 is well clear of that.
+
+    index = LabelIndex(_normalize_label, corpus=all_labels)
+    match = index.find(label, _similar_labels)   # first similar key in insertion order, or None
+    index.add(node_id, label)
+
+NearestLabelIndex serves compute_levels, which wants the best parent for an
+orphan at a loose threshold (0.4) where no bigram bound is lossless. It
+narrows to the top-k labels by shared rare bigrams instead.
+"""
+import math
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+
+
+MIN_FUZZY_LEN = 4  # _similar_labels: shorter labels must match exactly
+
+
+def _bigrams(text: str) -> Counter:
+    return Counter(text[i:i + 2] for i in range(len(text) - 1))
+
+
+_TOKEN_IDS = {}
+
+
+def _tokens(counts: Counter) -> list:
+    """
+    Bigram occurrences as distinct tokens ("ab", k), so set overlap = multiset
+    bigram overlap. Tokens are interned as ints to keep set intersections cheap.
+    """
+    ids = _TOKEN_IDS
+    return [ids.setdefault((bg, k), len(ids)) for bg, n in counts.items() for k in range(n)]
+
+
+class LabelIndex:
+    """
+    Bigram index with prefix filtering: every label indexes only its rarest
+    tokens — as many as a partner could fail to share while still reaching
+    the threshold, plus one. Two labels with enough shared tokens then always
+    share an indexed one. Token rarity comes from `corpus` (the labels about
+    to be merged) and is fixed for the life of the index.
+    """
+
+    def __init__(self, normalize, threshold: float = 0.85, corpus=()):
+        if threshold <= 0.75:
+            raise ValueError("LabelIndex blocking is only lossless for thresholds above 0.75")
+        self.normalize = normalize
+        self.threshold = threshold
+        self._freq = Counter()
+        for label in corpus:
+            self._freq.update(_tokens(_bigrams(normalize(label))))
+        self._order = {}                      # key -> insertion rank (first add wins)
+        self._labels = {}                     # key -> raw label
+        self._norm = {}                       # key -> normalized label
+        self._toksets = {}                    # key -> frozenset of tokens (verification)
+        self._prefix = {}                     # key -> indexed tokens
+        self._exact = defaultdict(set)        # normalized label -> keys
+        self._postings = defaultdict(lambda: defaultdict(set))  # token -> label length -> keys
+        self._next = 0
+
+    def __len__(self):
+        return len(self._labels)
+
+    # ── bounds ────────────────────────────────────────────────────────────
+    def _length_bounds(self, n: int):
+        """Partner lengths m that can reach the threshold: 2*min(n, m)/(n + m) >= t."""
+        t = self.threshold
+        return n * t / (2 - t) - 1e-9, n * (2 - t) / t + 1e-9
+
+    def _min_shared(self, total_len: int) -> int:
+        """Fewest shared bigrams two labels of combined length total_len need to reach the threshold."""
+        return max(1, int(1.5 * self.threshold * total_len - total_len - 1))
+
+    def _prefix_tokens(self, norm: str, counts: Counter) -> list:
+        tokens = sorted(_tokens(counts), key=lambda tok: (self._freq.get(tok, 0), tok))
+        lo, _ = self._length_bounds(len(norm))
+        # the smallest overlap any admissible partner needs; longer partners need more
+        need = self._min_shared(len(norm) + max(MIN_FUZZY_LEN, math.ceil(lo)))
+        return tokens[:max(1, len(tokens) - need + 1)]
+
+    # ── maintenance ───────────────────────────────────────────────────────
+    def add(self, key, label):
+        """Index `label` under `key`; re-adding a key replaces its label but keeps its rank."""
+        if key in self._labels:
+            self.remove(key, keep_rank=True)
+        if key not in self._order:
+            self._order[key] = self._next
+            self._next += 1
+        norm = self.normalize(label)
+        self._labels[key] = label
+        self._norm[key] = norm
+        self._exact[norm].add(key)
+        if len(norm) >= MIN_FUZZY_LEN:
+            counts = _bigrams(norm)
+            self._toksets[key] = frozenset(_tokens(counts))
+            self._prefix[key] = self._prefix_tokens(norm, counts)
+            for tok in self._prefix[key]:
+                self._postings[tok][len(norm)].add(key)
+
+    def remove(self, key, keep_rank: bool = False):
+        norm = self._norm.pop(key, None)
+        if norm is None:
+            return
+        self._labels.pop(key, None)
+        self._toksets.pop(key, None)
+        self._exact[norm].discard(key)
+        if not self._exact[norm]:
+            del self._exact[norm]
+        for tok in self._prefix.pop(key, ()):
+            by_len = self._postings.get(tok)
+            if by_len is not None and len(norm) in by_len:
+                by_len[len(norm)].discard(key)
+                if not by_len[len(norm)]:
+                    del by_len[len(norm)]
+                if not by_len:
+                    del self._postings[tok]
+        if not keep_rank:
+            self._order.pop(key, None)
+
+    # ── lookup ────────────────────────────────────────────────────────────
+    def candidates(self, label) -> list:
+        """Keys that may be similar to `label`, in insertion order (a superset of true matches)."""
+        norm = self.normalize(label)
+        found = set(self._exact.get(norm, ()))
+        n = len(norm)
+        if n >= MIN_FUZZY_LEN:
+            counts = _bigrams(norm)
+            tokset = frozenset(_tokens(counts))
+            lo, hi = self._length_bounds(n)
+            lengths = range(max(MIN_FUZZY_LEN, math.ceil(lo)), math.floor(hi) + 1)
+            probe = defaultdict(set)  # partner length -> keys sharing a prefix token
+            for tok in self._prefix_tokens(norm, counts):
+                by_len = self._postings.get(tok)
+                if by_len:
+                    for m in lengths:
+                        if m in by_len:
+                            probe[m] |= by_len[m]
+            toksets = self._toksets
+            for m, keys in probe.items():
+                need = self._min_shared(n + m)
+                found.update(key for key in keys - found if len(tokset & toksets[key]) >= need)
+        return sorted(found, key=self._order.__getitem__)
+
+    def find(self, label, similar):
+        """First indexed key (insertion order) whose label satisfies similar(label, that_label)."""
+        for key in self.candidates(label):
+            if similar(label, self._labels[key]):
+                return key
+        return None
+
+
+class NearestLabelIndex:
+    """
+    Best-match lookup for compute_levels' orphan rescue, which wants the most
+    similar reachable label rather than a yes/no at a high threshold. Labels
+    are ranked by how many bigrams they share with the query, counting only
+    bigrams that are rare in the index (a bigram in every other label says
+    little). SequenceMatcher then runs on the top `k` of them only. This is a
+    heuristic: the best match is almost always in the top k, but not
+    guaranteed (see benchmarks/bench_compute_levels.py for the agreement rate).
+    """
+
+    def __init__(self, normalize, k: int = 24, max_postings: int = 256):
+        self.normalize = normalize
+        self.k = k
+        self.max_postings = max_postings     # bigrams shared by more labels than this are skipped
+        self._order = {}                      # key -> insertion rank
+        self._norm = {}                       # key -> normalized label
+        self._postings = defaultdict(set)     # bigram -> keys
+
+    def __len__(self):
+        return len(self._norm)
+
+    def add(self, key, label):
+        if key in self._norm:
+            return
+        norm = self.normalize(label)
+        self._order[key] = len(self._order)
+        self._norm[key] = norm
+        for bg in _bigrams(norm):
+            self._postings[bg].add(key)
+
+    def candidates(self, norm: str) -> list:
+        """Up to k keys sharing the most informative bigrams with `norm` (already normalized)."""
+        shared = Counter()
+        postings = sorted((self._postings.get(bg, ()) for bg in _bigrams(norm)), key=len)
+        for i, keys in enumerate(postings):
+            # always probe the rarest bigram, even if it is common
+            if i and len(keys) > self.max_postings:
+                break
+            shared.update(keys)
+        order = self._order
+        return sorted(shared, key=lambda key: (-shared[key], order[key]))[:self.k]
+
+    def best(self, label):
+        """(key, SequenceMatcher ratio) of the most similar label among the candidates, or (None, 0.0)."""
+        norm = self.normalize(label)
+        best_key, best_score = None, 0.0
+        # earliest-added key wins ties, like a scan in insertion order
+        for key in sorted(self.candidates(norm), key=self._order.__getitem__):
+            score = SequenceMatcher(None, norm, self._norm[key]).ratio()
+            if score > best_score:
+                best_key, best_score = key, score
+        return best_key, best_score
@@ -0,0 +1,175 @@
+# aila_backend/kg_store.py
+"""
+Row-per-node copy of knowledge graphs, for lookups that need one node or its
+neighbours rather than the whole graph.
+
+knowledge_graph rows keep node_data / edge_data as JSON. A whole-graph read
+(the graph view, merging) parses them once, which is faster than
+reassembling thousands of rows. Everything that wanted a single concept
+used to parse the blob and scan it, though. Now every write of a graph also
+writes kg_nodes (primary key graph_id, node_id) and kg_edges (indexed on
+(graph_id, source) and (graph_id, target)) in the same transaction:
+
+    save_graph(db, graph_id, nodes, edges)      # replace a graph's rows; caller commits
+    get_node(db, graph_id, node_id)             # one node dict, or None
+    get_nodes(db, graph_id, node_ids)           # {node_id: node dict}
+    neighbours(db, graph_id, node_id)           # {"parents": [...], "children": [...]}
+
+Graphs stored before these tables existed are copied over by backfill() at
+startup.
+"""
+import json
+
+from sqlalchemy import text as sql_text
+
+from aila_backend.database import SessionLocal
+from aila_backend.models import KgEdge, KgNode
+
+
+def _node_rows(graph_id, nodes):
+    for i, node in enumerate(nodes or []):
+        if not isinstance(node, dict) or node.get("id") is None:
+            continue
+        level = node.get("level")
+        yield {
+            "graph_id": graph_id, "node_id": str(node["id"]), "position": i,
+            "label": node.get("label"), "level": level if isinstance(level, int) else None,
+            "data": node,
+        }
+
+
+def _edge_rows(graph_id, edges):
+    for i, edge in enumerate(edges or []):
+        if not isinstance(edge, dict):
+            continue
+        yield {
+            "graph_id": graph_id, "position": i, "source": edge.get("source"),
+            "target": edge.get("target"), "relation": edge.get("relation"),
+        }
+
+
+def delete_graphs(db, graph_ids):
+    """Drop the rows of these graphs. Caller commits."""
+    graph_ids = list(graph_ids)
+    if not graph_ids:
+        return
+    db.query(KgNode).filter(KgNode.graph_id.in_(graph_ids)).delete(synchronize_session=False)
+    db.query(KgEdge).filter(KgEdge.graph_id.in_(graph_ids)).delete(synchronize_session=False)
+
+
+def save_graph(db, graph_id, nodes, edges):
+    """
+    Replace the rows of one graph. Call in the transaction that writes the
+    knowledge_graph row, so both copies change together. Caller commits.
+    A node ID repeated within a graph keeps its first occurrence, as the
+    old `next(n for n in nodes if ...)` lookups did.
+    """
+    delete_graphs(db, [graph_id])
+    node_rows = list(_node_rows(graph_id, nodes))
+    edge_rows = list(_edge_rows(graph_id, edges))
+    if node_rows:
+        db.execute(KgNode.__table__.insert().prefix_with("OR IGNORE"), node_rows)
+    if edge_rows:
+        db.execute(KgEdge.__table__.insert(), edge_rows)
+
+
+def copy_graph(db, source_id, target_id):
+    """Copy a graph's rows under a new graph id (dedup of re-uploads). Caller commits."""
+    delete_graphs(db, [target_id])
+    db.execute(
+        sql_text("""
+            INSERT INTO kg_nodes (graph_id, node_id, position, label, level, data)
+            SELECT :t, node_id, position, label, level, data FROM kg_nodes WHERE graph_id = :s
+        """),
+        {"s": source_id, "t": target_id}
+    )
+    db.execute(
+        sql_text("""
+            INSERT INTO kg_edges (graph_id, position, source, target, relation)
+            SELECT :t, position, source, target, relation FROM kg_edges WHERE graph_id = :s
+        """),
+        {"s": source_id, "t": target_id}
+    )
+
+
+def master_graph_id(db, course_id, week):
+    """id of the week's master graph, or None."""
+    row = db.execute(
+        sql_text("SELECT id FROM knowledge_graph WHERE course_id=:c AND week=:w AND graph_type='master'"),
+        {"c": course_id, "w": week}
+    ).fetchone()
+    return row[0] if row else None
+
+
+def get_node(db, graph_id, node_id):
+    if graph_id is None or node_id is None:
+        return None
+    row = db.query(KgNode.data).filter(KgNode.graph_id == graph_id, KgNode.node_id == str(node_id)).first()
+    return row[0] if row else None
+
+
+def get_nodes(db, graph_id, node_ids) -> dict:
+    node_ids = [str(n) for n in node_ids or [] if n is not None]
+    if graph_id is None or not node_ids:
+        return {}
+    rows = db.query(KgNode.node_id, KgNode.data).filter(
+        KgNode.graph_id == graph_id, KgNode.node_id.in_(node_ids)
+    ).all()
+    return {node_id: data for node_id, data in rows if data is not None}
+
+
+def neighbours(db, graph_id, node_id) -> dict:
+    """Edges into and out of one node, each with the node at its other end."""
+    out_edges = db.query(KgEdge).filter(KgEdge.graph_id == graph_id, KgEdge.source == node_id) \
+        .order_by(KgEdge.position).all()
+    in_edges = db.query(KgEdge).filter(KgEdge.graph_id == graph_id, KgEdge.target == node_id) \
+        .order_by(KgEdge.position).all()
+    others = get_nodes(db, graph_id, {e.target for e in out_edges} | {e.source for e in in_edges})
+    return {
+        "children": [{"relation": e.relation, "node": others.get(e.target, {"id": e.target})} for e in out_edges],
+        "parents": [{"relation": e.relation, "node": others.get(e.source, {"id": e.source})} for e in in_edges],
+    }
+
+
+def backfill(batch_size: int = 50) -> int:
+    """
+    Copy graphs that have no rows yet from their JSON blobs. Safe to run in
+    several processes at once (duplicate rows are ignored). Returns graphs copied.
+    """
+    db = SessionLocal()
+    copied = 0
+    try:
+        while True:
+            rows = db.execute(
+                sql_text("""
+                    SELECT id, node_data, edge_data FROM knowledge_graph
+                    WHERE node_data IS NOT NULL AND node_data NOT IN ('', '[]')
+                      AND id NOT IN (SELECT DISTINCT graph_id FROM kg_nodes)
+                    LIMIT :n
+                """),
+                {"n": batch_size}
+            ).fetchall()
+            if not rows:
+                break
+            for graph_id, node_data, edge_data in rows:
+                try:
+                    nodes = json.loads(node_data)
+                    edges = json.loads(edge_data) if edge_data else []
+                except (TypeError, ValueError):
+                    nodes, edges = [], []
+                node_rows = list(_node_rows(graph_id, nodes))
+                if not node_rows:
+                    # unparseable: a placeholder row stops it being picked up again
+                    node_rows = [{"graph_id": graph_id, "node_id": "", "position": -1,
+                                  "label": None, "level": None, "data": None}]
+                db.execute(KgNode.__table__.insert().prefix_with("OR IGNORE"), node_rows)
+                edge_rows = list(_edge_rows(graph_id, edges))
+                if edge_rows:
+                    db.execute(KgEdge.__table__.insert().prefix_with("OR IGNORE"), edge_rows)
+                copied += 1
+            db.commit()
+    finally:
+        db.close()
+    if copied:
+        print(f"[DB] Copied {copied} knowledge graph(s) into kg_nodes/kg_edges")
+    return copied
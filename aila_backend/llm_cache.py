@@ -0,0 +1,165 @@
+# aila_backend/llm_cache.py
+"""
+Persistent, content-addressed cache of LLM responses.
+
+Entries are keyed on (model, sha256(prompt), generation params) and live in
+a small SQLite file next to the uploads, separate from the application DB so
+cache churn never contends with quiz writes. Eviction is LRU on last access,
+bounded by both age and total response size.
+
+Whether a call may use the cache is decided per call site: callers pass a
+``call_site`` name and the cache answers ``site_enabled(call_site)``. Sites
+can be switched off without a code change via AILA_LLM_CACHE_DISABLED_SITES
+(comma-separated), or the whole cache via AILA_LLM_CACHE=off.
+
+The quiz-generation sites (UNCACHED_SITES) are off unless that variable
+says otherwise: their output is appended to a quiz's bank, so a cached
+response would insert the same questions again.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+CACHE_PATH      = os.environ.get("AILA_LLM_CACHE_PATH", "db/llm_cache.sqlite3")
+CACHE_MAX_BYTES = int(os.environ.get("AILA_LLM_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+CACHE_MAX_AGE   = float(os.environ.get("AILA_LLM_CACHE_MAX_AGE_DAYS", 30)) * 86400
+EVICT_EVERY     = 50  # run eviction after this many writes
+UNCACHED_SITES  = ("mcq_batch", "mcq_kg")  # default for AILA_LLM_CACHE_DISABLED_SITES
+
+
+def cache_key(model_name: str, prompt: str, params: dict = None) -> str:
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    material = json.dumps(
+        {"model": model_name, "prompt": prompt_hash, "params": params or {}},
+        sort_keys=True,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    def __init__(self, path: str = CACHE_PATH, max_bytes: int = CACHE_MAX_BYTES,
+                 max_age: float = CACHE_MAX_AGE, disabled_sites=None, enabled: bool = True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.enabled = enabled
+        self.disabled_sites = set(disabled_sites or [])
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5)
+        if not self._ready:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key         TEXT PRIMARY KEY,
+                    model       TEXT,
+                    call_site   TEXT,
+                    response    TEXT NOT NULL,
+                    size        INTEGER NOT NULL,
+                    created_at  REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_last_access ON llm_cache (last_access)")
+            conn.commit()
+            self._ready = True
+        return conn
+
+    def site_enabled(self, call_site: str = None) -> bool:
+        return self.enabled and call_site not in self.disabled_sites
+
+    def get(self, key: str):
+        """Return the cached response text, or None. Expired entries count as misses."""
+        with self._lock:
+            conn = self._connect()
+            try:
+                row = conn.execute(
+                    "SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)
+                ).fetchone()
+                now = time.time()
+                if row is None or now - row[1] > self.max_age:
+                    self.misses += 1
+                    return None
+                conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+                conn.commit()
+                self.hits += 1
+                return row[0]
+            finally:
+                conn.close()
+
+    def put(self, key: str, response: str, model_name: str = None, call_site: str = None):
+        with self._lock:
+            conn = self._connect()
+            try:
+                now = time.time()
+                conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache "
+                    "(key, model, call_site, response, size, created_at, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, model_name, call_site, response, len(response.encode("utf-8")), now, now),
+                )
+                conn.commit()
+                self._writes += 1
+                if self._writes % EVICT_EVERY == 0:
+                    self._evict(conn)
+            finally:
+                conn.close()
+
+    def _evict(self, conn: sqlite3.Connection):
+        """Drop expired entries, then least-recently-used ones until under max_bytes."""
+        cur = conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - self.max_age,))
+        evicted = cur.rowcount
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        if total > self.max_bytes:
+            excess = total - self.max_bytes
+            freed = 0
+            doomed = []
+            for key, size in conn.execute("SELECT key, size FROM llm_cache ORDER BY last_access"):
+                if freed >= excess:
+                    break
+                doomed.append((key,))
+                freed += size
+            conn.executemany("DELETE FROM llm_cache WHERE key = ?", doomed)
+            evicted += len(doomed)
+        conn.commit()
+        self.evictions += evicted
+
+    def stats(self) -> dict:
+        with self._lock:
+            conn = self._connect()
+            try:
+                entries, size = conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache"
+                ).fetchone()
+            finally:
+                conn.close()
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "disabled_sites": sorted(self.disabled_sites),
+        }
+
+
+llm_cache = LLMCache(
+    enabled=os.environ.get("AILA_LLM_CACHE", "on").lower() not in ("0", "off", "false"),
+    disabled_sites=[s.strip() for s in os.environ.get("AILA_LLM_CACHE_DISABLED_SITES", ",".join(UNCACHED_SITES)).split(",")
+                    if s.strip()],
+)
@@ -0,0 +1,436 @@
+# aila_backend/llm_client.py
+"""
+Asyncio-native client for all Gemini traffic.
+
+Every request has to take a token from the bucket of the model it targets
+before it is sent. Waiting for a token is an ``await`` on the client's own
+event loop, so a throttled call costs one suspended coroutine instead of a
+blocked uvicorn worker.
+
+The client owns a private event loop running on a daemon thread:
+  - async endpoints use ``await llm_client.generate(...)``. The request is
+    handed to the client loop and the endpoint awaits the result without
+    blocking its own loop.
+  - the background lecture pipeline runs in plain threads and uses
+    ``llm_client.generate_sync(...)``, which blocks only the calling thread.
+Keeping every bucket on one loop means the limiter state is never shared
+between loops or threads. The tokens themselves are shared with the other
+processes on the host (web server, worker.py) through llm_quota.py, so
+RATE_LIMIT_RPM is one budget for all of them.
+
+Before any token is spent the response cache (llm_cache.py) is consulted,
+so byte-identical prompts from call sites that allow caching cost no quota,
+and concurrent identical prompts are coalesced onto a single request.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+
+from aila_backend.llm_cache import llm_cache, cache_key
+from aila_backend.llm_providers import get_provider
+from aila_backend.llm_quota import shared_quota
+from aila_backend.prompt_builder import count_tokens, prompt_log
+from aila_backend.metrics import metrics, SIZE_BUCKETS, COUNT_BUCKETS
+
+
+# Free tier: 20 req/min. We cap at 15 to leave headroom.
+#
+# Model fallback chain (each has its own independent free-tier quota bucket):
+#   Primary:  gemini-2.5-flash  (best quality)
+#   Fallback: gemini-1.5-flash  (separate quota — used when 2.5 is exhausted)
+# When the primary model's DAILY quota is exhausted, we automatically switch
+# to the fallback for the rest of the session.
+MODEL_PRIMARY  = "models/gemini-2.5-flash"
+MODEL_FALLBACK = "models/gemini-1.5-flash"
+
+RATE_LIMIT_RPM = 15            # max requests per minute, per model
+MAX_QUEUED     = 100           # callers allowed to wait for a token, per model and lane
+MAX_RETRIES    = 3             # retry on 429 up to this many times (short — we fallback instead)
+RETRY_BACKOFF  = [15, 30, 60]  # seconds to wait before each retry
+
+# Priority lanes. Student-facing calls are "interactive"; the lecture pipeline
+# and bulk quiz generation are "batch" and only use quota interactive traffic
+# is not claiming. INTERACTIVE_RESERVED tokens per model are held back from batch.
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH       = "batch"
+PRIORITY_LANES       = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+INTERACTIVE_RESERVED = 3
+
+
+class RateLimitQueueFull(RuntimeError):
+    """Raised when too many callers are already waiting for a model's quota."""
+
+
+def _is_rate_limit_error(err: Exception) -> bool:
+    err_str = str(err)
+    return "429" in err_str or "quota" in err_str.lower() or "rate" in err_str.lower()
+
+
+class TokenBucket:
+    """
+    Awaitable token bucket with priority lanes.
+
+    Holds up to ``capacity`` tokens and refills at ``rpm`` tokens per minute.
+    Waiters queue FIFO within their lane, and lanes are strictly ordered:
+      - interactive waiters are always granted before any batch waiter;
+      - batch waiters only get a token while ``reserved`` tokens would still
+        be left over, so a student request arriving mid-upload finds quota
+        ready instead of queueing behind a lecture's Pass 2 calls.
+    At most ``max_waiters`` may queue per lane; beyond that ``acquire`` fails
+    fast with RateLimitQueueFull. Must only be used from a single event loop.
+
+    With ``shared`` (an llm_quota.SharedQuota) the tokens come from the row
+    ``key`` of the shared store instead of this object, so every process's
+    bucket for a model draws on one budget, and the interactive lane is ahead
+    of batch lanes in other processes too.
+    """
+
+    def __init__(self, rpm: int, capacity: int = None, max_waiters: int = MAX_QUEUED,
+                 reserved: int = INTERACTIVE_RESERVED, shared=None, key: str = None):
+        self.rate = rpm / 60.0
+        self.capacity = capacity or rpm
+        self.max_waiters = max_waiters
+        self.reserved = min(reserved, self.capacity - 1)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lanes = {lane: deque() for lane in PRIORITY_LANES}
+        self._timer = None
+        self._retry_in = 0.0
+        self.shared = shared
+        self.key = key
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def available(self) -> float:
+        if self.shared is not None:
+            return self.shared.peek(self.key, self.rate, self.capacity)[0]
+        self._refill()
+        return self._tokens
+
+    @property
+    def held_for_interactive(self) -> bool:
+        """True while another process has interactive callers waiting for this model."""
+        return self.shared is not None and self.shared.peek(self.key, self.rate, self.capacity)[1]
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(q) for q in self._lanes.values())
+
+    def lane_depths(self) -> dict:
+        return {lane: len(q) for lane, q in self._lanes.items()}
+
+    def _take(self, lane: str) -> bool:
+        """Take one token for ``lane`` if it may have one; otherwise note when to retry."""
+        if self.shared is not None:
+            try:
+                granted, self._retry_in = self.shared.take(self.key, lane, self.rate, self.capacity,
+                                                           self.reserved)
+            except Exception as e:  # store locked or unreadable: keep the waiters, retry shortly
+                print(f"[RATE LIMIT] shared quota unavailable for {self.key}: {e}")
+                granted, self._retry_in = False, 1.0
+            return granted
+        self._refill()
+        needed = 1 if lane == PRIORITY_INTERACTIVE else 1 + self.reserved
+        if self._tokens >= needed:
+            self._tokens -= 1
+            return True
+        self._retry_in = max(0.0, (needed - self._tokens) / self.rate)
+        return False
+
+    def _give_back(self):
+        if self.shared is not None:
+            self.shared.give_back(self.key, self.capacity)
+        else:
+            self._tokens += 1
+
+    def _dispatch(self):
+        """Grant tokens to waiters in priority order; arm a timer for the next refill."""
+        interactive, batch = self._lanes[PRIORITY_INTERACTIVE], self._lanes[PRIORITY_BATCH]
+        while interactive and self._take(PRIORITY_INTERACTIVE):
+            interactive.popleft().set_result(None)
+        while not interactive and batch and self._take(PRIORITY_BATCH):
+            batch.popleft().set_result(None)
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if interactive or batch:
+            # the last _take was the refused one, for the lane at the head
+            self._timer = asyncio.get_running_loop().call_later(self._retry_in, self._dispatch)
+
+    async def acquire(self, priority: str = PRIORITY_INTERACTIVE) -> float:
+        """Wait for one token in the given lane. Returns the seconds spent waiting."""
+        started = time.monotonic()
+        lane = self._lanes[priority]
+        if len(lane) >= self.max_waiters:
+            raise RateLimitQueueFull(
+                f"{len(lane)} {priority} requests already waiting for LLM quota"
+            )
+
+        ticket = asyncio.get_running_loop().create_future()
+        lane.append(ticket)
+        self._dispatch()
+        try:
+            await ticket  # resolved by _dispatch once a token is ours
+        except asyncio.CancelledError:
+            if ticket in lane:
+                lane.remove(ticket)
+            elif ticket.done() and not ticket.cancelled():
+                self._give_back()  # granted but never used — hand it back
+            self._dispatch()
+            raise
+        return time.monotonic() - started
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key onto one in-flight task.
+
+    The first caller for a key starts the work; everyone arriving while it is
+    still running awaits the same task instead of repeating the work. The task
+    is shielded, so a caller that disconnects does not cancel it for the rest.
+    Must only be used from a single event loop.
+    """
+
+    def __init__(self, name: str = "flight"):
+        self.name = name
+        self.coalesced = 0
+        self._inflight = {}
+
+    @property
+    def inflight(self) -> int:
+        return len(self._inflight)
+
+    async def run(self, key, work):
+        """Await ``work()`` — or the already-running call for ``key``."""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(work())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _t, k=key: self._inflight.pop(k, None))
+        else:
+            self.coalesced += 1
+            print(f"[SINGLE-FLIGHT] {self.name}: joined in-flight call ({self.coalesced} coalesced so far)")
+            metrics.inc("single_flight_coalesced_total", flight=self.name)
+        return await asyncio.shield(task)
+
+
+class LLMClient:
+    """
+    Rate-limited Gemini client with one token bucket per model.
+    If the primary model's daily quota is exhausted, requests for it are
+    transparently redirected to the fallback model for the rest of the session.
+    The text itself comes from a provider (llm_providers.py) — Gemini, or the
+    local fake for offline load tests.
+    """
+
+    def __init__(self, rpm: int = RATE_LIMIT_RPM, max_waiters: int = MAX_QUEUED, cache=llm_cache,
+                 provider=None, quota=shared_quota):
+        self.rpm = rpm
+        self.quota = quota  # None: this process's buckets only
+        self.max_waiters = max_waiters
+        self.cache = cache
+        self.provider = provider or get_provider()
+        self.active_model = MODEL_PRIMARY  # flips to fallback on daily quota exhaustion
+        self.flight = SingleFlight("llm prompt")  # identical prompts share one request
+        self._buckets = {}
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
+    # ── event loop plumbing ───────────────────────────────────────────────
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._loop_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="llm-client", daemon=True)
+                thread.start()
+                self._loop = loop
+        return self._loop
+
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def bucket(self, model_name: str) -> TokenBucket:
+        if model_name not in self._buckets:
+            self._buckets[model_name] = TokenBucket(self.rpm, max_waiters=self.max_waiters,
+                                                    shared=self.quota, key=model_name)
+        return self._buckets[model_name]
+
+    # ── generation ────────────────────────────────────────────────────────
+    def _call_model(self, model_name: str, prompt: str, params: dict = None,
+                    call_site: str = None) -> str:
+        return self.provider.generate(model_name, prompt, params, call_site=call_site)
+
+    async def _generate(self, model_name: str, prompt: str, call_site: str = None,
+                        cache: bool = None, params: dict = None,
+                        priority: str = PRIORITY_INTERACTIVE) -> str:
+        """
+        Runs on the client loop: consult the cache, join an identical in-flight
+        request if there is one, otherwise acquire a token, call, retry on 429.
+        """
+        use_cache = self.cache is not None and (
+            self.cache.site_enabled(call_site) if cache is None else (cache and self.cache.enabled)
+        )
+        # Responses from a non-Gemini provider must never answer real traffic
+        cache_model = model_name if self.provider.name == "gemini" else f"{self.provider.name}:{model_name}"
+        key = cache_key(cache_model, prompt, params)
+        started = time.monotonic()
+        prompt_tokens = await asyncio.to_thread(count_tokens, prompt)
+        if use_cache:
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is not None:
+                prompt_log.record(call_site, model_name, prompt_tokens,
+                                  time.monotonic() - started, cached=True)
+                metrics.inc("llm_calls_total", call_site=call_site or "unnamed",
+                            model=model_name, outcome="cache_hit")
+                return cached
+
+        async def _produce():
+            text = await self._generate_uncached(model_name, prompt, params, priority, call_site,
+                                                 prompt_tokens)
+            prompt_log.record(call_site, model_name, prompt_tokens, time.monotonic() - started)
+            if use_cache and text:
+                await asyncio.to_thread(self.cache.put, key, text, model_name, call_site)
+            return text
+
+        return await self.flight.run(key, _produce)
+
+    async def _generate_uncached(self, model_name: str, prompt: str, params: dict = None,
+                                 priority: str = PRIORITY_INTERACTIVE, call_site: str = None,
+                                 prompt_tokens: int = None) -> str:
+        # If caller passed the primary model name but we've already fallen back,
+        # silently use the fallback so all callers benefit without changing their code.
+        model_name = self._resolve_model(model_name)
+        site = call_site or "unnamed"
+        started = time.monotonic()
+        limiter_wait = model_time = 0.0
+        retries = 0
+        outcome, text = "error", ""
+
+        try:
+            for attempt in range(MAX_RETRIES + 1):
+                bucket = self.bucket(model_name)
+                waited = await bucket.acquire(priority)
+                limiter_wait += waited
+                if waited > 1:
+                    print(f"[RATE LIMIT] {model_name}: {priority} call waited {waited:.1f}s for a slot "
+                          f"(queued: {bucket.lane_depths()})")
+                call_started = time.monotonic()
+                try:
+                    # The SDK call itself is blocking network I/O — keep it off the loop.
+                    text = await asyncio.to_thread(self._call_model, model_name, prompt, params, call_site)
+                    model_time += time.monotonic() - call_started
+                    outcome = "ok"
+                    return text
+                except Exception as e:
+                    model_time += time.monotonic() - call_started
+                    if not _is_rate_limit_error(e):
+                        raise  # non-rate-limit error — bubble up
+                    metrics.inc("llm_rate_limited_total", call_site=site, model=model_name)
+                    # If we're on the primary model and have retried enough, switch to fallback
+                    if model_name == MODEL_PRIMARY and attempt >= 1:
+                        print(f"[GEMINI] Primary model quota exhausted — switching to fallback {MODEL_FALLBACK}")
+                        metrics.inc("llm_fallback_switches_total", call_site=site, model=model_name)
+                        self.active_model = MODEL_FALLBACK
+                        model_name = MODEL_FALLBACK
+                        # Don't count this as a retry — immediately try fallback
+                        continue
+                    retries += 1
+                    wait = RETRY_BACKOFF[min(attempt, len(RETRY_BACKOFF) - 1)]
+                    print(f"[GEMINI 429] Attempt {attempt+1}/{MAX_RETRIES} on {model_name} — retrying in {wait}s")
+                    await asyncio.sleep(wait)
+            outcome = "exhausted"
+            raise RuntimeError(f"[GEMINI] Exceeded {MAX_RETRIES} retries on {model_name} — quota exhausted on all models")
+        finally:
+            # One set of observations per logical call, success or not
+            labels = {"call_site": site, "model": model_name}
+            metrics.inc("llm_calls_total", outcome=outcome, **labels)
+            metrics.observe("llm_latency_seconds", time.monotonic() - started, **labels)
+            metrics.observe("llm_model_seconds", model_time, **labels)
+            metrics.observe("llm_limiter_wait_seconds", limiter_wait, **labels)
+            metrics.observe("llm_retries", retries, buckets=COUNT_BUCKETS, **labels)
+            metrics.observe("llm_prompt_chars", len(prompt), buckets=SIZE_BUCKETS, **labels)
+            if prompt_tokens is not None:
+                metrics.observe("llm_prompt_tokens", prompt_tokens, buckets=SIZE_BUCKETS, **labels)
+            if text:
+                metrics.observe("llm_response_chars", len(text), buckets=SIZE_BUCKETS, **labels)
+
+    async def generate(self, model_name: str, prompt: str, call_site: str = None,
+                       cache: bool = None, params: dict = None,
+                       priority: str = PRIORITY_INTERACTIVE) -> str:
+        """
+        Awaitable entry point for code running on any event loop.
+        cache=None defers to the call site's cache policy; True/False forces it.
+        """
+        return await asyncio.wrap_future(
+            self._submit(self._generate(model_name, prompt, call_site, cache, params, priority))
+        )
+
+    def generate_sync(self, model_name: str, prompt: str, call_site: str = None,
+                      cache: bool = None, params: dict = None,
+                      priority: str = PRIORITY_BATCH) -> str:
+        """Blocking shim for worker threads (lecture pipeline). Never call from a loop."""
+        return self._submit(
+            self._generate(model_name, prompt, call_site, cache, params, priority)
+        ).result()
+
+    # ── pacing for batch work ─────────────────────────────────────────────
+    def _resolve_model(self, model_name: str) -> str:
+        if model_name == MODEL_PRIMARY and self.active_model == MODEL_FALLBACK:
+            return MODEL_FALLBACK
+        return model_name
+
+    async def _batch_budget(self, model_name: str) -> int:
+        bucket = self.bucket(self._resolve_model(model_name))
+        if bucket.queue_depth or bucket.held_for_interactive:
+            return 0
+        return max(0, int(bucket.available - bucket.reserved))
+
+    def batch_budget(self, model_name: str) -> int:
+        """Batch-lane calls that could start on this model right now without waiting."""
+        return self._submit(self._batch_budget(model_name)).result()
+
+    async def _wait_for_budget(self, model_name: str, tokens: int, max_wait: float) -> float:
+        started = time.monotonic()
+        bucket = self.bucket(self._resolve_model(model_name))
+        # Never ask for more than batch work can ever have at once
+        tokens = max(1, min(tokens, int(bucket.capacity - bucket.reserved)))
+        while time.monotonic() - started < max_wait:
+            deficit = tokens - (bucket.available - bucket.reserved)
+            if deficit <= 0 and not bucket.queue_depth and not bucket.held_for_interactive:
+                break
+            await asyncio.sleep(min(max(deficit, 1) / bucket.rate, max_wait))
+        return time.monotonic() - started
+
+    def wait_for_budget(self, model_name: str, tokens: int, max_wait: float = 60.0) -> float:
+        """
+        Block until ``tokens`` batch-lane calls could start back-to-back (or
+        ``max_wait`` passes). Consumes nothing — it only paces the caller so a
+        fan-out starts when quota is there rather than queueing one by one.
+        """
+        return self._submit(self._wait_for_budget(model_name, tokens, max_wait)).result()
+
+    # ── introspection ─────────────────────────────────────────────────────
+    async def _limiter_stats(self) -> dict:
+        return {
+            model_name: {
+                "available_tokens": round(bucket.available, 2),
+                "capacity": bucket.capacity,
+                "reserved_for_interactive": bucket.reserved,
+                "queue_depth": bucket.lane_depths(),
+                "shared": bucket.shared is not None,
+            }
+            for model_name, bucket in self._buckets.items()
+        }
+
+    def limiter_stats(self) -> dict:
+        """Per-model token and per-lane queue depth snapshot (read on the client loop)."""
+        return self._submit(self._limiter_stats()).result(timeout=5)
+
+
+llm_client = LLMClient()
@@ -0,0 +1,266 @@
+# aila_backend/llm_providers.py
+"""
+Backends that actually produce LLM text, behind the LLMClient.
+
+The client (llm_client.py) owns rate limiting, caching, coalescing and
+retries; a provider only turns (model, prompt) into text, blocking:
+
+  - GeminiProvider  — Google's SDK. Configured on first use, so importing
+                      the app no longer needs GOOGLE_API_KEY.
+  - FakeProvider    — deterministic local stand-in for load tests and
+                      offline benchmarks. Recognises each pipeline prompt by
+                      its call site and returns schema-valid JSON for it.
+
+Pick one with AILA_LLM_PROVIDER=gemini|fake (default gemini). The fake is
+tuned with:
+  AILA_FAKE_LLM_LATENCY_MS   mean simulated latency per call (default 200)
+  AILA_FAKE_LLM_JITTER_MS    +/- uniform jitter (default 50)
+  AILA_FAKE_LLM_ERROR_RATE   fraction of calls raising a generic error (default 0)
+  AILA_FAKE_LLM_429_RATE     fraction of calls raising a 429 quota error (default 0)
+  AILA_FAKE_LLM_SEED         seed for latency/fault injection (default 0)
+"""
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+
+
+class LLMProvider:
+    """Blocking text generation. Subclasses implement generate()."""
+    name = "base"
+
+    def generate(self, model_name: str, prompt: str, params: dict = None,
+                 call_site: str = None) -> str:
+        raise NotImplementedError
+
+
+class GeminiProvider(LLMProvider):
+    name = "gemini"
+
+    def __init__(self, api_key: str = None):
+        self._api_key = api_key
+        self._configured = False
+        self._lock = threading.Lock()
+
+    def _configure(self):
+        with self._lock:
+            if self._configured:
+                return
+            import google.generativeai as genai
+            api_key = self._api_key or os.environ.get("GOOGLE_API_KEY")
+            if not api_key:
+                raise RuntimeError("GOOGLE_API_KEY is not set (or use AILA_LLM_PROVIDER=fake)")
+            genai.configure(api_key=api_key)
+            self._genai = genai
+            self._configured = True
+
+    def generate(self, model_name: str, prompt: str, params: dict = None,
+                 call_site: str = None) -> str:
+        if not self._configured:
+            self._configure()
+        model = self._genai.GenerativeModel(model_name)
+        resp = model.generate_content(prompt, generation_config=params or None)
+        return getattr(resp, "text", str(resp))
+
+
+class FakeQuotaError(RuntimeError):
+    """Injected by FakeProvider; its message matches what the client treats as a 429."""
+
+
+class FakeProvider(LLMProvider):
+    """
+    Deterministic stand-in: the same prompt always yields the same response.
+    Latency and fault injection come from a seeded RNG, so a benchmark run is
+    reproducible call-for-call.
+    """
+    name = "fake"
+
+    _BLOOMS = ["Remember", "Understand", "Apply", "Analyze", "Evaluate", "Create"]
+    _DIFFICULTIES = ["Easy", "Medium", "Hard"]
+    _RELATIONS = ["has_part", "uses", "requires", "enables", "extends"]
+    # Varied vocabulary so fake concepts don't all collapse in near-duplicate matching
+    _QUALIFIERS = ["Recursive", "Amortized", "Balanced", "Lazy", "Immutable", "Concurrent",
+                   "Probabilistic", "Greedy", "Persistent", "Streaming", "Sparse", "Ordered"]
+    _NOUNS = ["Invariant", "Traversal", "Allocation", "Partitioning", "Encoding", "Scheduling",
+              "Hashing", "Caching", "Rotation", "Compaction", "Serialization", "Pruning"]
+
+    def __init__(self, latency_ms: float = 200, jitter_ms: float = 50,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.calls = 0
+        self.injected_errors = 0
+        self.injected_429s = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            latency_ms=float(os.environ.get("AILA_FAKE_LLM_LATENCY_MS", 200)),
+            jitter_ms=float(os.environ.get("AILA_FAKE_LLM_JITTER_MS", 50)),
+            error_rate=float(os.environ.get("AILA_FAKE_LLM_ERROR_RATE", 0)),
+            rate_limit_rate=float(os.environ.get("AILA_FAKE_LLM_429_RATE", 0)),
+            seed=int(os.environ.get("AILA_FAKE_LLM_SEED", 0)),
+        )
+
+    def generate(self, model_name: str, prompt: str, params: dict = None,
+                 call_site: str = None) -> str:
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self.latency_ms + self._rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            roll = self._rng.random()
+        time.sleep(delay)
+        if roll < self.rate_limit_rate:
+            with self._lock:
+                self.injected_429s += 1
+            raise FakeQuotaError("429 Resource has been exhausted (fake quota)")
+        if roll < self.rate_limit_rate + self.error_rate:
+            with self._lock:
+                self.injected_errors += 1
+            raise RuntimeError("500 Internal error (fake provider)")
+
+        rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).hexdigest())
+        handler = {
+            "pass1_structure": self._structure,
+            "pass1_map":       self._structure,
+            "pass1_reduce":    self._reduce,
+            "pass2_subtopic":  self._subtopic,
+            "mcq_kg":          self._mcq_list,
+            "mcq_concept":     self._mcq_list,
+            "mcq_batch":       self._mcq_batch,
+            "quiz_title":      self._title,
+            "kg_single_pass":  self._single_pass_kg,
+        }.get(call_site, self._generic)
+        return handler(prompt, rng)
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "injected_errors": self.injected_errors,
+            "injected_429s": self.injected_429s,
+        }
+
+    # ── canned responses ──────────────────────────────────────────────────
+    @staticmethod
+    def _slides(prompt: str) -> list:
+        """(title, slide_num) for each '--- Title (Slide N) ---' header in the prompt."""
+        return [(t.strip(), int(n)) for t, n in re.findall(r"--- (.+?) \(Slide (\d+)\) ---", prompt)]
+
+    def _structure(self, prompt: str, rng: random.Random) -> str:
+        slides = self._slides(prompt)
+        m = re.search(r'FILE: "(.+?)"', prompt)
+        main_topic = re.sub(r"\.\w+$", "", m.group(1)) if m else "Lecture"
+        seen, sub_topics = set(), []
+        for title, num in slides:
+            if title.lower() in seen or title.lower().startswith("slide "):
+                continue
+            seen.add(title.lower())
+            sub_topics.append({
+                "name": title,
+                "slide_depth": 1,
+                "slide_nums": [num],
+                "summary": f"{title} is a core idea within {main_topic}.",
+            })
+        if not sub_topics:
+            sub_topics = [{"name": f"{main_topic} Concept {i + 1}", "slide_depth": 2,
+                           "slide_nums": [], "summary": "A concept of the lecture."} for i in range(3)]
+        edges = [
+            {"source": a["name"], "target": b["name"], "relation": rng.choice(self._RELATIONS)}
+            for a, b in zip(sub_topics, sub_topics[1:])
+        ]
+        return json.dumps({"main_topic": main_topic, "sub_topics": sub_topics, "inter_topic_edges": edges})
+
+    def _reduce(self, prompt: str, rng: random.Random) -> str:
+        """Union the partial structures listed after 'Parts (JSON):' by sub-topic name."""
+        m = re.search(r"Parts \(JSON\):\s*(\[.*\])", prompt, re.S)
+        parts = json.loads(m.group(1)) if m else []
+        merged, edges = {}, []
+        for part in parts:
+            for st in part.get("sub_topics", []):
+                key = st["name"].lower()
+                if key in merged:
+                    merged[key]["slide_nums"] = sorted(set(merged[key]["slide_nums"]) | set(st["slide_nums"]))
+                else:
+                    merged[key] = dict(st)
+            edges.extend(part.get("inter_topic_edges", []))
+        main_topic = parts[0].get("main_topic", "Lecture") if parts else "Lecture"
+        return json.dumps({"main_topic": main_topic, "sub_topics": list(merged.values()),
+                           "inter_topic_edges": edges})
+
+    def _subtopic(self, prompt: str, rng: random.Random) -> str:
+        m = re.search(r'CHILD CONCEPTS of "(.+?)"', prompt)
+        name = m.group(1) if m else "Topic"
+        m = re.search(r'"source": "(.+?)", "target": "snake_case_unique_id"', prompt)
+        parent_id = m.group(1) if m else re.sub(r"\W+", "_", name.lower()).strip("_")
+        slide_nums = [n for _, n in self._slides(prompt)]
+        nodes, edges = [], []
+        labels = rng.sample([f"{q} {n}" for q in self._QUALIFIERS for n in self._NOUNS], rng.randint(2, 5))
+        for label in labels:
+            node_id = re.sub(r"\W+", "_", label.lower())
+            nodes.append({
+                "id": node_id, "label": label, "type": rng.choice(["concept", "detail", "algorithm"]),
+                "summary": f"{label} is a component of {name}.", "slide_nums": slide_nums[:2],
+            })
+            edges.append({"source": parent_id, "target": node_id, "relation": rng.choice(self._RELATIONS)})
+        return json.dumps({"nodes": nodes, "edges": edges})
+
+    def _mcqs(self, concept: str, n: int, rng: random.Random) -> list:
+        out = []
+        for i in range(n):
+            options = [f"{concept} option {chr(65 + j)}{i + 1}" for j in range(4)]
+            out.append({
+                "question": f"Which statement about {concept} is correct? (#{i + 1})",
+                "options": options,
+                "answer": rng.choice(options),
+                "difficulty": rng.choice(self._DIFFICULTIES),
+                "bloom_level": rng.choice(self._BLOOMS),
+            })
+        return out
+
+    @staticmethod
+    def _requested_count(prompt: str, default: int = 3) -> int:
+        m = re.search(r"Generate (\d+) diverse questions", prompt)
+        return int(m.group(1)) if m else default
+
+    def _mcq_list(self, prompt: str, rng: random.Random) -> str:
+        m = re.search(r"""for the concept ["'](.+?)["']""", prompt)
+        concept = m.group(1) if m else "the concept"
+        return json.dumps(self._mcqs(concept, self._requested_count(prompt), rng))
+
+    def _mcq_batch(self, prompt: str, rng: random.Random) -> str:
+        n = self._requested_count(prompt)
+        keys = re.findall(r'=== CONCEPT KEY: "(.+?)"', prompt)
+        return json.dumps({key: self._mcqs(key, n, rng) for key in keys})
+
+    def _title(self, prompt: str, rng: random.Random) -> str:
+        m = re.search(r"covering these topics: (.+?)\. Return", prompt)
+        first = m.group(1).split(",")[0].strip() if m else "Course Concepts"
+        return f"{rng.choice(['Foundations of', 'Exploring', 'Review of'])} {first}"
+
+    def _single_pass_kg(self, prompt: str, rng: random.Random) -> str:
+        m = re.search(r'lecture content from "(.+?)"', prompt)
+        main_topic = m.group(1) if m else "Lecture"
+        labels = rng.sample([f"{q} {n}" for q in self._QUALIFIERS for n in self._NOUNS], rng.randint(3, 6))
+        return json.dumps({
+            "main_topic": main_topic,
+            "nodes": [{"id": label, "label": label} for label in labels],
+            "edges": [{"source": main_topic, "target": label, "relation": "has_part"} for label in labels],
+        })
+
+    def _generic(self, prompt: str, rng: random.Random) -> str:
+        return json.dumps({"text": f"fake response {rng.randint(0, 10**6)}"})
+
+
+def get_provider(name: str = None) -> LLMProvider:
+    name = (name or os.environ.get("AILA_LLM_PROVIDER", "gemini")).lower()
+    if name == "fake":
+        return FakeProvider.from_env()
+    if name == "gemini":
+        return GeminiProvider()
+    raise ValueError(f"Unknown AILA_LLM_PROVIDER '{name}' (expected 'gemini' or 'fake')")
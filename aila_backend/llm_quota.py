@@ -0,0 +1,125 @@
+# aila_backend/llm_quota.py
+"""
+Per-model LLM quota shared by every process on the host.
+
+Production runs the web server and `worker.py --processes 2` as separate
+processes, and each one builds its own LLMClient. With process-local token
+buckets every process could spend the full RATE_LIMIT_RPM, and a worker's
+Pass 2 calls had no way of seeing a student request waiting in the web
+server. So the bucket state lives in one row per model in a small SQLite
+file (AILA_LLM_QUOTA_PATH) and every grant is a BEGIN IMMEDIATE
+read-refill-take on that row:
+
+  - interactive takes a token whenever one is there;
+  - batch only takes one while ``reserved`` would be left over, and not
+    while any process has interactive callers waiting (``interactive_until``).
+    A process whose interactive waiter can't be served sets that mark to
+    just past the time its next token is due.
+
+Waiters still queue in each process's own lanes (llm_client.TokenBucket);
+only the tokens are shared. Every take returns how long the lane has to
+wait before a token could be there, which the bucket uses for its retry
+timer.
+
+Each take is one short transaction on the LLM client's loop. Set
+AILA_LLM_QUOTA_PATH= (empty) to go back to per-process buckets, e.g. for a
+single-process dev server. The file is per host; with the redis job backend
+spread over several machines, divide RATE_LIMIT_RPM by the number of hosts.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+
+QUOTA_PATH = os.environ.get("AILA_LLM_QUOTA_PATH", "db/llm_quota.sqlite3")
+MIN_RETRY  = 0.05  # seconds; floor for the retry timer so waiters never spin
+
+
+class SharedQuota:
+    def __init__(self, path: str = QUOTA_PATH):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_quota (
+                    model             TEXT PRIMARY KEY,
+                    tokens            REAL NOT NULL,
+                    updated           REAL NOT NULL,
+                    interactive_until REAL NOT NULL DEFAULT 0
+                )
+            """)
+            self._conn = conn
+        return self._conn
+
+    def _load(self, conn, model: str, rate: float, capacity: float, now: float):
+        row = conn.execute(
+            "SELECT tokens, updated, interactive_until FROM llm_quota WHERE model = ?", (model,)
+        ).fetchone()
+        if row is None:
+            conn.execute("INSERT INTO llm_quota (model, tokens, updated) VALUES (?, ?, ?)",
+                         (model, float(capacity), now))
+            return float(capacity), 0.0
+        tokens, updated, interactive_until = row
+        return min(capacity, tokens + max(0.0, now - updated) * rate), interactive_until
+
+    def take(self, model: str, lane: str, rate: float, capacity: float, reserved: int):
+        """
+        Try to take one token for ``lane`` ("interactive" or "batch").
+        Returns (granted, seconds until the lane could be granted).
+        """
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                tokens, interactive_until = self._load(conn, model, rate, capacity, now)
+                if lane == "interactive":
+                    granted = tokens >= 1
+                    wait = 0.0 if granted else (1 - tokens) / rate
+                    if not granted:  # hold other processes' batch lanes until our token is due
+                        interactive_until = max(interactive_until, now + wait + MIN_RETRY)
+                else:
+                    held = interactive_until - now
+                    granted = held <= 0 and tokens >= 1 + reserved
+                    wait = 0.0 if granted else max(held, (1 + reserved - tokens) / rate)
+                if granted:
+                    tokens -= 1
+                conn.execute(
+                    "UPDATE llm_quota SET tokens = ?, updated = ?, interactive_until = ? WHERE model = ?",
+                    (tokens, now, interactive_until, model),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return granted, max(MIN_RETRY, wait)
+
+    def give_back(self, model: str, capacity: float):
+        """Return a token that was granted but never used."""
+        with self._lock:
+            self._connect().execute(
+                "UPDATE llm_quota SET tokens = MIN(?, tokens + 1) WHERE model = ?", (float(capacity), model)
+            )
+
+    def peek(self, model: str, rate: float, capacity: float):
+        """(tokens available now, True if some process has interactive callers waiting). Takes nothing."""
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            row = conn.execute(
+                "SELECT tokens, updated, interactive_until FROM llm_quota WHERE model = ?", (model,)
+            ).fetchone()
+        if row is None:
+            return float(capacity), False
+        tokens, updated, interactive_until = row
+        return min(capacity, tokens + max(0.0, now - updated) * rate), interactive_until > now
+
+
+shared_quota = SharedQuota(QUOTA_PATH) if QUOTA_PATH else None
@@ -3,7 +3,8 @@ import os
 # Load .env from the same directory as this file, regardless of where uvicorn is launched from
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), ".env"))
 
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, BackgroundTasks, Body
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, Body, Request
+from fastapi.responses import StreamingResponse
 from fastapi import WebSocket, WebSocketDisconnect, Path
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -15,13 +16,13 @@ from sqlalchemy import text as sql_text
 from sqlalchemy import or_
 
 from pydantic import BaseModel, Field
-from pptx import Presentation
 from typing import List, Optional, Dict, Set
 from collections import deque, defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import asyncio
-import fitz  # PyMuPDF
+import copy
 import hashlib
 import traceback
 import random
@@ -30,11 +31,29 @@ import shutil
 import json
 import re
 import logging
-import google.generativeai as genai
 
-from aila_backend.database import SessionLocal, Base, engine
+from aila_backend.database import SessionLocal, Base, engine, ensure_columns, ensure_indexes
+from aila_backend.job_queue import enqueue_lecture, queue_stats, start_embedded_workers
 import threading
 import time as _time
+from aila_backend.llm_client import llm_client, SingleFlight, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+from aila_backend.llm_cache import llm_cache
+from aila_backend.metrics import metrics, SIZE_BUCKETS
+from aila_backend.metrics_share import metrics_share, start_publishing
+from aila_backend.slide_extraction import extract_slides
+from aila_backend.upload_store import store_upload
+from aila_backend.progress_bus import publish as publish_progress, hub as progress_hub, TERMINAL_STATUSES
+from aila_backend.merge_scheduler import request_merge, run_when_due
+from aila_backend.kg_index import LabelIndex, NearestLabelIndex
+from aila_backend import kg_store
+from aila_backend.kg_cache import kg_cache
+from aila_backend import mcq_bank
+from aila_backend import mastery
+from aila_backend.mcq_bank import BankReplenisher
+from aila_backend.write_queue import db_writer
+from aila_backend.prompt_builder import (
+    SITE_BUDGETS, budget_for, count_tokens, fit_tokens, pack_blocks, prompt_log,
+)
 from aila_backend.models import (
     User,
     Course,
@@ -42,6 +61,7 @@ from aila_backend.models import (
     LectureUpload,
     LectureProcessing,
     Segment,
+    LectureVersion,
     KnowledgeGraph,
     Quiz,
     MCQ,
@@ -52,85 +72,107 @@ from aila_backend.models import (
 
 UPLOAD_DIR = "db/uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
-
-# ── Gemini rate limiter ─────────────────────────────────────────────────────
-# Free tier: 20 req/min. We cap at 15 to leave headroom.
-# All calls to Gemini MUST go through gemini_generate() below.
-#
-# Model fallback chain (each has its own independent free-tier quota bucket):
-#   Primary:  gemini-2.5-flash  (best quality)
-#   Fallback: gemini-1.5-flash  (separate quota — used when 2.5 is exhausted)
-# When the primary model's DAILY quota is exhausted, we automatically switch
-# to the fallback for the rest of the session.
-_MODEL_PRIMARY  = "models/gemini-2.5-flash"
-_MODEL_FALLBACK = "models/gemini-1.5-flash"
-_active_model   = _MODEL_PRIMARY   # flips to fallback on daily quota exhaustion
-
-_RATE_LIMIT_RPM = 15          # max requests per minute
-_RATE_WINDOW    = 60.0        # seconds
-_MAX_RETRIES    = 3           # retry on 429 up to this many times (short — we fallback instead)
-_RETRY_BACKOFF  = [15, 30, 60]  # seconds to wait before each retry
-
-_rate_lock       = threading.Lock()
-_request_times: list = []     # timestamps of recent requests
-
-def _wait_for_rate_slot():
-    """Block until we are allowed to send one more request."""
-    while True:
-        with _rate_lock:
-            now = _time.monotonic()
-            cutoff = now - _RATE_WINDOW
-            while _request_times and _request_times[0] < cutoff:
-                _request_times.pop(0)
-            if len(_request_times) < _RATE_LIMIT_RPM:
-                _request_times.append(now)
-                return
-            wait_secs = _RATE_WINDOW - (now - _request_times[0]) + 0.1
-        print(f"[RATE LIMIT] {len(_request_times)}/{_RATE_LIMIT_RPM} req in window — waiting {wait_secs:.1f}s")
-        _time.sleep(wait_secs)
 
-def gemini_generate(model_name: str, prompt: str) -> str:
+# ── Gemini access ───────────────────────────────────────────────────────────
+# All calls to Gemini MUST go through gemini_generate() / gemini_generate_async()
+# below. Rate limiting, retries and model fallback live in llm_client.py; the
+# backend itself (Gemini, or a local fake via AILA_LLM_PROVIDER=fake) lives in
+# llm_providers.py and is configured on first call, not at import.
+
+# call_site names the caller for the response cache (see llm_cache.py);
+# cache=False opts a single call out, e.g. when a *different* answer is wanted.
+
+# priority picks the limiter lane: "interactive" (students waiting on the
+# response) is always served before "batch" (lecture pipeline, bulk generation).
+
+def gemini_generate(model_name: str, prompt: str, call_site: str = None, cache: bool = None,
+                    priority: str = PRIORITY_BATCH) -> str:
     """
-    Single entry point for ALL Gemini text generation.
-    Enforces the rate limit and retries on 429.
-    If the primary model's daily quota is exhausted, automatically falls back
-    to gemini-1.5-flash (separate quota bucket) for the rest of the session.
+    Blocking entry point for Gemini text generation, for the background
+    lecture pipeline (runs in a worker thread, never on the event loop).
     Returns the response text string.
     """
-    global _active_model
+    return llm_client.generate_sync(model_name, prompt, call_site=call_site, cache=cache, priority=priority)
 
-    # If caller passed the primary model name but we've already fallen back,
-    # silently use the fallback so all callers benefit without changing their code.
-    if model_name == _MODEL_PRIMARY and _active_model == _MODEL_FALLBACK:
-        model_name = _MODEL_FALLBACK
 
-    for attempt in range(_MAX_RETRIES + 1):
-        _wait_for_rate_slot()
-        try:
-            model = genai.GenerativeModel(model_name)
-            resp  = model.generate_content(prompt)
-            return getattr(resp, "text", str(resp))
-        except Exception as e:
-            err_str = str(e)
-            if "429" in err_str or "quota" in err_str.lower() or "rate" in err_str.lower():
-                # If we're on the primary model and have retried enough, switch to fallback
-                if model_name == _MODEL_PRIMARY and attempt >= 1:
-                    print(f"[GEMINI] Primary model quota exhausted — switching to fallback {_MODEL_FALLBACK}")
-                    _active_model = _MODEL_FALLBACK
-                    model_name    = _MODEL_FALLBACK
-                    # Don't count this as a retry — immediately try fallback
-                    continue
-                wait = _RETRY_BACKOFF[min(attempt, len(_RETRY_BACKOFF) - 1)]
-                print(f"[GEMINI 429] Attempt {attempt+1}/{_MAX_RETRIES} on {model_name} — retrying in {wait}s")
-                _time.sleep(wait)
-                continue
-            raise  # non-rate-limit error — bubble up
-    raise RuntimeError(f"[GEMINI] Exceeded {_MAX_RETRIES} retries on {model_name} — quota exhausted on all models")
+async def gemini_generate_async(model_name: str, prompt: str, call_site: str = None, cache: bool = None,
+                                priority: str = PRIORITY_INTERACTIVE) -> str:
+    """
+    Awaitable entry point for Gemini text generation, for async endpoints.
+    Waiting for a rate-limit slot suspends only the calling request.
+    """
+    return await llm_client.generate(model_name, prompt, call_site=call_site, cache=cache, priority=priority)
 
 Base.metadata.create_all(bind=engine)
+# Columns added since the tables were first created (no migration tool)
+ensure_columns("lecture_processing", {
+    "file_path": "VARCHAR",
+    "upload_id": "VARCHAR",
+    "attempts": "INTEGER DEFAULT 0",
+    "max_attempts": "INTEGER DEFAULT 3",
+    "available_at": "FLOAT",
+    "claimed_at": "FLOAT",
+    "lease_expires_at": "FLOAT",
+    "worker_id": "VARCHAR",
+    "backend_job_id": "VARCHAR",
+    "stats": "JSON",
+    "content_hash": "VARCHAR",
+})
+ensure_columns("knowledge_graph", {"version": "INTEGER DEFAULT 0"})
+ensure_columns("mcq", {"difficulty_rank": "INTEGER", "bloom_rank": "INTEGER"})
+ensure_indexes({
+    "ix_lecture_processing_queue": "lecture_processing (status, available_at)",
+    "ix_lecture_processing_content_hash": "lecture_processing (content_hash)",
+    "ix_mcq_quiz_concept_rank": "mcq (quiz_id, concept_id, bloom_rank, difficulty_rank)",
+    "ix_mcq_quiz_rank": "mcq (quiz_id, bloom_rank, difficulty_rank)",
+    "ix_quiz_attempts_student_quiz": "quiz_attempts (student_id, quiz_id, completed)",
+})
+# mcq_responses tables from before the composite key (surrogate id column)
+# have no unique (attempt_id, mcq_id), which the submit upsert's ON CONFLICT
+# needs. Keep the newest of any duplicate answers, then add the constraint.
+with engine.begin() as _conn:
+    if not _conn.execute(sql_text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ux_mcq_responses_attempt_mcq'"
+    )).first():
+        _dropped = _conn.execute(sql_text("""
+            DELETE FROM mcq_responses WHERE rowid IN (
+                SELECT rowid FROM (
+                    SELECT rowid, ROW_NUMBER() OVER (
+                        PARTITION BY attempt_id, mcq_id ORDER BY answered_at DESC, rowid DESC
+                    ) AS n FROM mcq_responses
+                ) WHERE n > 1
+            )
+        """)).rowcount
+        if _dropped:
+            print(f"[DB] Dropped {_dropped} duplicate mcq_responses row(s)")
+ensure_indexes({"ux_mcq_responses_attempt_mcq": "mcq_responses (attempt_id, mcq_id)"}, unique=True)
+# Ranks of MCQs saved before the rank columns existed (same rules as models.difficulty_rank / bloom_rank)
+with engine.begin() as _conn:
+    _conn.execute(sql_text("""
+        UPDATE mcq SET
+            difficulty_rank = CASE lower(trim(COALESCE(difficulty, 'Medium')))
+                WHEN 'easy' THEN 1 WHEN 'hard' THEN 3 ELSE 2 END,
+            bloom_rank = CASE lower(trim(COALESCE(bloom_level, 'Remember')))
+                WHEN 'remember' THEN 1 WHEN 'understand' THEN 2 WHEN 'apply' THEN 3
+                WHEN 'analyze' THEN 4 WHEN 'evaluate' THEN 5 WHEN 'create' THEN 6 ELSE 0 END
+        WHERE difficulty_rank IS NULL OR bloom_rank IS NULL
+    """))
+# Graphs stored as JSON blobs only, from before kg_nodes/kg_edges existed
+kg_store.backfill()
+# Mastery counts of attempts completed before student_mastery existed
+mastery.backfill()
 
 app = FastAPI()
+
+# Lecture jobs run in worker.py processes; for a bare `uvicorn main:app` on
+# one box, a worker thread inside the web process keeps uploads flowing.
+EMBEDDED_WORKERS = int(os.environ.get("AILA_EMBEDDED_WORKERS", 1))
+
+@app.on_event("startup")
+def _start_embedded_workers():
+    if EMBEDDED_WORKERS:
+        start_embedded_workers(EMBEDDED_WORKERS)
+    start_publishing("web")  # other uvicorn workers merge this process's metrics too
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "http://127.0.0.1:3000"],
@@ -322,7 +364,7 @@ def repair_json(json_str):
             return {}
 
 # --- HELPER: PASS 1 — COMBINED SLIDE READING + DOMAIN ENRICHMENT ---
-def identify_structure(full_text, file_name):
+def identify_structure(full_text, file_name, part=None):
     """
     Single combined pass that does TWO things simultaneously:
 
@@ -339,15 +381,34 @@ def identify_structure(full_text, file_name):
     Doing both in ONE pass ensures the LLM sees the full slide text while
     applying domain reasoning — preventing the two-step hallucination problem
     where a blind enrichment pass invents topics that contradict slide content.
+
+    part=(i, n) runs the map step of identify_structure_chunked on window i of
+    n: step B is left to the reduce step, which sees every part at once.
     """
-    print(f"🧠 [PASS 1] Reading slides + domain enrichment for {file_name}...")
+    if part:
+        print(f"🧠 [PASS 1] Reading slide window {part[0]}/{part[1]} of {file_name}...")
+        scope = (f"\n    NOTE: this is part {part[0]} of {part[1]} of a long lecture. Other parts are\n"
+                 f"    read separately and merged afterwards, so only report what THESE slides cover.\n")
+        step_b = """===== STEP B — SKIPPED =====
+    Do NOT add inferred (slide_depth = 3) concepts here; domain enrichment is
+    applied once to the whole lecture when the parts are merged."""
+    else:
+        print(f"🧠 [PASS 1] Reading slides + domain enrichment for {file_name}...")
+        scope = ""
+        step_b = """===== STEP B — APPLY DOMAIN KNOWLEDGE =====
+    Now think as a CS educator: given the main topic, are there canonical
+    sub-concepts that belong to it in standard CS curriculum but are COMPLETELY
+    ABSENT from the slides (not even mentioned)?
+    - If yes, add them with slide_depth = 3 ("inferred — not in slides at all")
+    - Only add if you are CONFIDENT they are canonical to this topic
+    - Do NOT add speculative or loosely related topics"""
 
     prompt = f"""
     You are an expert Computer Science and Information Science educator.
     You are building a concept map (knowledge graph) for a CS/IS lecture.
 
     FILE: "{file_name}"
-
+{scope}
     ===== STEP A — READ THE SLIDES =====
     Read the slide content below carefully.
     Extract every CONCEPT the lecture covers, whether it appears as:
@@ -361,13 +422,7 @@ def identify_structure(full_text, file_name):
       - Record slide_nums where it appears
       - Set slide_depth = 1 if it has a dedicated section, 2 if only mentioned
 
-    ===== STEP B — APPLY DOMAIN KNOWLEDGE =====
-    Now think as a CS educator: given the main topic, are there canonical
-    sub-concepts that belong to it in standard CS curriculum but are COMPLETELY
-    ABSENT from the slides (not even mentioned)?
-    - If yes, add them with slide_depth = 3 ("inferred — not in slides at all")
-    - Only add if you are CONFIDENT they are canonical to this topic
-    - Do NOT add speculative or loosely related topics
+    {step_b}
 
     ===== STEP C — RELATIONSHIPS =====
     For every pair of sub-topics that have a meaningful CS relationship
@@ -408,12 +463,20 @@ def identify_structure(full_text, file_name):
     }}
 
     Slide content:
-    {full_text[:18000]}
+    {full_text}
     """
 
-    resp = gemini_generate("models/gemini-2.5-flash", prompt)
-    raw = repair_json(resp)
+    call_site = "pass1_map" if part else "pass1_structure"
+    resp = gemini_generate("models/gemini-2.5-flash", prompt, call_site=call_site)
+    with metrics.timed("llm_parse_seconds", call_site=call_site):
+        raw = repair_json(resp)
+    return _normalise_structure(raw, "Pass 1 window" if part else "Pass 1")
 
+
+def _normalise_structure(raw, label="Pass 1"):
+    """Coerce a Pass 1 style response into {main_topic, sub_topics, inter_topic_edges}."""
+    if not isinstance(raw, dict):
+        raw = {}
     # Normalize sub_topics — handle old plain-string format gracefully
     sub_topics_raw = raw.get("sub_topics", [])
     sub_topics_normalised = []
@@ -433,7 +496,7 @@ def identify_structure(full_text, file_name):
     raw["sub_topics"] = sub_topics_normalised
     # Ensure inter_topic_edges key exists
     raw.setdefault("inter_topic_edges", [])
-    print(f"  ✓ Pass 1 complete: main_topic='{raw.get('main_topic')}' | "
+    print(f"  ✓ {label} complete: main_topic='{raw.get('main_topic')}' | "
           f"{len(sub_topics_normalised)} sub-topics "
           f"({sum(1 for s in sub_topics_normalised if s['slide_depth']==1)} rich, "
           f"{sum(1 for s in sub_topics_normalised if s['slide_depth']==2)} mentioned, "
@@ -441,6 +504,192 @@ def identify_structure(full_text, file_name):
           f"| {len(raw['inter_topic_edges'])} lateral edges")
     return raw
 
+# --- HELPER: STEP 1 (LONG LECTURES) - MAP-REDUCE STRUCTURE PASS ---
+# Lectures whose slides don't fit the Pass 1 budget are split into windows of
+# whole slides; each window gets its own Pass 1 call (map, concurrently) and
+# the partial structures are reconciled into one (reduce). Prompt size stays
+# bounded however long the deck is, and no slide is silently dropped.
+PASS1_MODEL       = "models/gemini-2.5-flash"
+PASS1_MAX_WORKERS = int(os.environ.get("AILA_PASS1_MAX_WORKERS", 4))
+# Sub-topics kept for Pass 2: this many per Pass 1 window, at most MAX_SUBTOPICS
+SUBTOPICS_PER_WINDOW = 8
+MAX_SUBTOPICS        = int(os.environ.get("AILA_MAX_SUBTOPICS", 40))
+
+
+def _slide_windows(slide_blocks, budget):
+    """Group consecutive slide blocks into windows of at most `budget` tokens."""
+    windows, current, used = [], [], 0
+    for block in slide_blocks:
+        tokens = count_tokens(block)
+        if tokens > budget:
+            block, tokens = fit_tokens(block, budget), budget
+        if current and used + tokens > budget:
+            windows.append(current)
+            current, used = [], 0
+        current.append(block)
+        used += tokens
+    if current:
+        windows.append(current)
+    return windows
+
+
+def _merge_structures_fallback(partials, file_name):
+    """
+    Deterministic reduce: sub-topics with the same normalized name are merged
+    (slide_nums unioned, richest slide_depth kept), the most common main topic
+    wins. Used when the LLM reduce fails or returns nothing usable.
+    """
+    topics = Counter(p.get("main_topic") for p in partials if p.get("main_topic"))
+    main_topic = topics.most_common(1)[0][0] if topics else file_name
+    merged, names = {}, {}
+    for p in partials:
+        for st in p.get("sub_topics", []):
+            key = normalize_id(st["name"])
+            if not key:
+                continue
+            names.setdefault(key, st["name"])
+            if key not in merged:
+                merged[key] = dict(st, name=names[key], slide_nums=list(st.get("slide_nums") or []))
+                continue
+            m = merged[key]
+            m["slide_nums"] = sorted(set(m["slide_nums"]) | set(st.get("slide_nums") or []))
+            m["slide_depth"] = min(m.get("slide_depth", 3), st.get("slide_depth", 3))
+            m["inferred"] = m["slide_depth"] == 3
+            if not m.get("summary"):
+                m["summary"] = st.get("summary", "")
+    edges, seen = [], set()
+    for p in partials:
+        for e in p.get("inter_topic_edges", []):
+            src = names.get(normalize_id(e.get("source", "")), e.get("source"))
+            tgt = names.get(normalize_id(e.get("target", "")), e.get("target"))
+            if src and tgt and src != tgt and (src, tgt) not in seen:
+                seen.add((src, tgt))
+                edges.append({"source": src, "target": tgt, "relation": e.get("relation", "uses")})
+    return {"main_topic": main_topic, "sub_topics": list(merged.values()), "inter_topic_edges": edges}
+
+
+def _reduce_structures_llm(partials, file_name):
+    """One LLM reduce over a group of partial structures (compact JSON in the prompt)."""
+    compact = [{
+        "main_topic": p.get("main_topic"),
+        "sub_topics": [{k: st.get(k) for k in ("name", "slide_depth", "slide_nums", "summary")}
+                       for st in p.get("sub_topics", [])],
+        "inter_topic_edges": p.get("inter_topic_edges", []),
+    } for p in partials]
+    prompt = f"""
+    You are an expert Computer Science and Information Science educator.
+    A long lecture, FILE: "{file_name}", was read in {len(partials)} consecutive parts.
+    Below are the concept structures found in each part, in slide order.
+
+    Merge them into ONE structure for the whole lecture:
+      - main_topic: the canonical CS name for the subject of the WHOLE lecture
+      - sub_topics: merge duplicates and synonyms into one canonical name, union
+        their slide_nums, keep the lowest slide_depth and the best summary
+      - Then apply domain knowledge: add canonical sub-concepts of the main topic
+        that NO part covers, with slide_depth = 3 and slide_nums = [] (only if confident)
+      - inter_topic_edges: keep the correct ones (renamed to the merged names) and
+        add relationships between sub-topics that came from different parts
+
+    Return JSON only (no markdown, no extra text), same schema as the parts:
+    {{"main_topic": "...", "sub_topics": [{{"name": "...", "slide_depth": 1, "slide_nums": [1], "summary": "..."}}],
+      "inter_topic_edges": [{{"source": "...", "target": "...", "relation": "uses"}}]}}
+
+    Parts (JSON):
+    {json.dumps(compact)}
+    """
+    resp = gemini_generate(PASS1_MODEL, prompt, call_site="pass1_reduce")
+    with metrics.timed("llm_parse_seconds", call_site="pass1_reduce"):
+        raw = repair_json(resp)
+    structure = _normalise_structure(raw, "Pass 1 reduce")
+    if not structure.get("sub_topics"):
+        raise ValueError("reduce returned no sub-topics")
+    return structure
+
+
+def _reduce_structures(partials, file_name, stats):
+    """Reduce partial structures, in groups that fit the reduce budget, until one is left."""
+    budget = budget_for(PASS1_MODEL, "pass1_reduce")
+    while len(partials) > 1:
+        groups, current, used = [], [], 0
+        for p in partials:
+            tokens = count_tokens(json.dumps(p))
+            if current and used + tokens > budget:
+                groups.append(current)
+                current, used = [], 0
+            current.append(p)
+            used += tokens
+        groups.append(current)
+        if len(groups) == len(partials):
+            # every partial is alone in its group — the LLM can't merge them, fold deterministically
+            stats["reduce"] = "fallback"
+            return _merge_structures_fallback(partials, file_name)
+        reduced = []
+        for group in groups:
+            if len(group) == 1:
+                reduced.append(group[0])
+                continue
+            started = _time.perf_counter()
+            try:
+                reduced.append(_reduce_structures_llm(group, file_name))
+            except Exception as e:
+                print(f"  ✗ [PASS 1 REDUCE] LLM merge failed ({e}); merging deterministically")
+                stats["reduce"] = "fallback"
+                reduced.append(_merge_structures_fallback(group, file_name))
+            stats["reduce_calls"] = stats.get("reduce_calls", 0) + 1
+            stats["reduce_seconds"] = round(stats.get("reduce_seconds", 0) + _time.perf_counter() - started, 3)
+        partials = reduced
+    return partials[0]
+
+
+def identify_structure_chunked(slide_blocks, file_name, stats_out=None):
+    """
+    Pass 1 for a lecture of any length. Fits in one window → identical to
+    identify_structure. Otherwise map over slide windows concurrently and
+    reduce. stats_out (dict) receives mode, chunk count and per-chunk latency.
+    """
+    stats = {"mode": "single", "chunks": 1}
+    budget = budget_for(PASS1_MODEL, "pass1_structure")
+    windows = _slide_windows(slide_blocks, budget)
+    started = _time.perf_counter()
+
+    if len(windows) <= 1:
+        # windows[0], not slide_blocks: _slide_windows trims single over-budget slides
+        structure = identify_structure("\n\n".join(windows[0] if windows else slide_blocks), file_name)
+        stats["chunk_seconds"] = [round(_time.perf_counter() - started, 3)]
+    else:
+        n = len(windows)
+        workers = max(1, min(n, PASS1_MAX_WORKERS, llm_client.batch_budget(PASS1_MODEL)))
+        print(f"🧩 [PASS 1] {n} slide windows (≤{budget} tokens each), {workers} parallel")
+
+        def _map(indexed):
+            i, window = indexed
+            t0 = _time.perf_counter()
+            try:
+                part = identify_structure("\n\n".join(window), file_name, part=(i + 1, n))
+            except Exception as e:
+                print(f"  ✗ [PASS 1] window {i + 1}/{n} failed: {e}")
+                part = None
+            return part, round(_time.perf_counter() - t0, 3)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pass1") as pool:
+            results = list(pool.map(_map, enumerate(windows)))
+        partials = [p for p, _ in results if p and p.get("sub_topics")]
+        stats.update({
+            "mode": "map_reduce",
+            "chunks": n,
+            "chunk_seconds": [secs for _, secs in results],
+            "chunk_tokens": [count_tokens("\n\n".join(w)) for w in windows],
+            "failed_chunks": n - len(partials),
+            "reduce": "llm" if len(partials) > 1 else "none",
+        })
+        structure = _reduce_structures(partials, file_name, stats) if partials else None
+
+    stats["seconds"] = round(_time.perf_counter() - started, 3)
+    if stats_out is not None:
+        stats_out.update(stats)
+    return structure
+
+
 # --- HELPER: STEP 2a - SINGLE SUB-TOPIC EXTRACTION ---
 def extract_concepts_for_subtopic(main_topic, sub_topic_name, sub_topic_id, text_slice, slide_depth=1):
     """
@@ -524,22 +773,25 @@ def extract_concepts_for_subtopic(main_topic, sub_topic_name, sub_topic_id, text
     }}
 
     Lecture text:
-    {text_slice[:10000]}
+    {text_slice}
     """
-    resp = gemini_generate("models/gemini-2.5-flash", prompt)
-    result = repair_json(resp)
+    resp = gemini_generate(PASS2_MODEL, prompt, call_site="pass2_subtopic")
+    with metrics.timed("llm_parse_seconds", call_site="pass2_subtopic"):
+        result = repair_json(resp)
     nodes = result.get('nodes', [])
     edges = result.get('edges', [])
     print(f"  ✓ [{sub_topic_name}] → {len(nodes)} child nodes, {len(edges)} edges")
     return result
 
 
-def _get_slide_anchored_slice(full_text, slide_nums, fallback_keyword, window=10000):
+def _get_slide_anchored_slice(full_text, slide_nums, fallback_keyword, budget=None):
     """
-    Build the best possible text slice for a sub-topic.
+    Build the best possible text slice for a sub-topic, within a token budget.
     Priority: use the slide numbers from identify_structure.
     Fallback: keyword search.
     """
+    if budget is None:
+        budget = budget_for(PASS2_MODEL, "pass2_subtopic")
     if slide_nums:
         # Extract the blocks for those specific slide numbers from full_text
         # Slide blocks are formatted as: "--- Title (Slide N) ---\n..."
@@ -551,30 +803,39 @@ def _get_slide_anchored_slice(full_text, slide_nums, fallback_keyword, window=10
             if m and int(m.group(1)) in slide_nums:
                 matched.append(block)
         if matched:
-            result = "\n\n".join(matched)
-            return result[:window]
+            return pack_blocks(matched, budget)
 
     # Fallback: find keyword in text
     idx = full_text.lower().find(fallback_keyword.lower())
     if idx == -1:
-        return full_text[:window]
+        return fit_tokens(full_text, budget)
     start = max(0, idx - 300)
-    return full_text[start: start + window]
+    return fit_tokens(full_text[start:], budget)
 
 
 # --- HELPER: STEP 2 - CONCEPT EXTRACTION (parallel per sub-topic) ---
-def extract_concepts(structure, full_text):
+PASS2_MODEL        = "models/gemini-2.5-flash"
+PASS2_MAX_WORKERS  = int(os.environ.get("AILA_PASS2_MAX_WORKERS", 6))
+PASS2_MAX_PACING   = 30.0  # seconds to wait for limiter budget before Pass 2
+
+
+def extract_concepts(structure, full_text, reuse_expansions=None, expansions_out=None, on_progress=None):
     """
     Pass 2: Expand each sub-topic from Pass 1 into child concept nodes.
     Uses slide_depth from Pass 1 to calibrate how much domain knowledge
     vs slide content to use for each sub-topic.
+
+    reuse_expansions: {sub_topic name: {nodes, edges}} from a previous version
+    of the lecture — those sub-topics are not sent to the LLM again.
+    expansions_out: if given, filled with this run's per-sub-topic results.
+    on_progress(done, total, sub_topic_name): called from the worker threads
+    as each expansion finishes.
     """
+    reuse_expansions = reuse_expansions or {}
     main_topic        = structure.get("main_topic", "Lecture")
     sub_topics        = structure.get("sub_topics", [])  # {name, slide_depth, slide_nums, summary, inferred}
     inter_topic_edges = structure.get("inter_topic_edges", [])
 
-    print(f"🧠 [PASS 2] Extracting child concepts for {len(sub_topics)} sub-topics sequentially...")
-
     if not sub_topics:
         sub_topics = [{"name": main_topic, "slide_nums": [], "slide_depth": 1, "inferred": False}]
 
@@ -599,14 +860,26 @@ def extract_concepts(structure, full_text):
             "slide_depth": slide_depth
         })
 
-    # Run child-concept extractions sequentially to avoid overwhelming the
-    # Gemini free-tier quota (20 req/min). The rate limiter handles pacing;
-    # parallel workers would race to grab slots and still burst past the cap.
-    results_by_topic = {}
-    for st in sub_topics:
+    # Expand sub-topics concurrently, but only as wide as the limiter can
+    # actually serve right now: every worker beyond the batch budget would
+    # just sit in the limiter queue. Cache hits don't spend tokens, so a
+    # re-run of a known lecture still finishes quickly at low width.
+    to_expand = [st for st in sub_topics if st["name"] not in reuse_expansions]
+    budget = llm_client.batch_budget(PASS2_MODEL)
+    workers = max(1, min(len(to_expand), PASS2_MAX_WORKERS, budget))
+    print(f"🧠 [PASS 2] Extracting child concepts for {len(to_expand)} sub-topics "
+          f"({workers} parallel, limiter budget {budget})"
+          + (f", reusing {len(sub_topics) - len(to_expand)} unchanged..." if reuse_expansions else "..."))
+
+    finished = []
+    finished_lock = threading.Lock()
+
+    def _expand(st):
         st_name = st["name"]
+        if st_name in reuse_expansions:
+            return copy.deepcopy(reuse_expansions[st_name])
         try:
-            results_by_topic[st_name] = extract_concepts_for_subtopic(
+            return extract_concepts_for_subtopic(
                 main_topic,
                 st_name,
                 sub_topic_id_map[st_name],
@@ -615,7 +888,22 @@ def extract_concepts(structure, full_text):
             )
         except Exception as e:
             print(f"  ✗ [{st_name}] extraction failed: {e}")
-            results_by_topic[st_name] = {"nodes": [], "edges": []}
+            return {"nodes": [], "edges": []}
+        finally:
+            if on_progress:
+                with finished_lock:  # held across the callback so events go out in order
+                    finished.append(st_name)
+                    on_progress(len(finished), len(to_expand), st_name)
+
+    # executor.map yields in input order, so the merge below sees sub-topics
+    # in Pass 1 order no matter which expansion finishes first.
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pass2") as pool:
+        results_by_topic = {
+            st["name"]: result for st, result in zip(sub_topics, pool.map(_expand, sub_topics))
+        }
+    if expansions_out is not None:
+        # Failed (empty) expansions are left out so the next version retries them
+        expansions_out.update({name: copy.deepcopy(r) for name, r in results_by_topic.items() if r.get("nodes")})
 
     # Build final graph
     merged_nodes = []
@@ -687,72 +975,298 @@ def extract_concepts(structure, full_text):
 
 
 # --- MAIN PIPELINE FUNCTION ---
-def process_lecture_and_kg(filepath, upload_id, course_id, week, file_name, processing_id):
+def _stage_done(stage: str, started: float) -> float:
+    """Record how long a lecture-pipeline stage took; returns the next stage's start."""
+    now = _time.perf_counter()
+    metrics.observe("lecture_stage_seconds", now - started, stage=stage)
+    return now
+
+
+def _report_progress(db, processing_id, stage, progress, **detail):
+    """Store progress on the status row (snapshot for new subscribers) and push it to subscribers."""
+    db.query(LectureProcessing).filter(LectureProcessing.id == processing_id).update({"progress": progress})
+    db.commit()
+    publish_progress(processing_id, stage, progress=progress, **detail)
+
+
+def rebuild_master_graph(db, course_id, week):
+    """
+    Re-merge every file graph of a course week into that week's master graph.
+    Call through schedule_master_merge, which serialises and debounces merges.
+    """
+    print(f"🔄 [MERGE] Merging into Week {week} Master Graph...")
+    started = _time.perf_counter()
+
+    all_files = db.execute(
+        sql_text("SELECT node_data, edge_data FROM knowledge_graph WHERE course_id=:c AND week=:w AND graph_type='file'"),
+        {"c": course_id, "w": week}
+    ).fetchall()
+    
+    graphs_to_merge = []
+    for row in all_files:
+        try:
+            graphs_to_merge.append({
+                "nodes": json.loads(row[0]),
+                "edges": json.loads(row[1])
+            })
+        except:
+            continue
+    
+    # Use our Robust Merge
+    master_data = merge_graphs(graphs_to_merge, week)
+    
+    # Update/Create Master
+    master_node_json = json.dumps(master_data['nodes'])
+    master_edge_json = json.dumps(master_data['edges'])
+    
+    existing_master = db.execute(
+        sql_text("SELECT id FROM knowledge_graph WHERE course_id=:c AND week=:w AND graph_type='master'"),
+        {"c": course_id, "w": week}
+    ).fetchone()
+
+    # One statement swaps nodes, edges and version together, and the node/edge
+    # rows change in the same transaction — readers never see a half-written master
+    master_id = existing_master[0] if existing_master else str(uuid.uuid4())
+    if existing_master:
+        db.execute(
+            sql_text("UPDATE knowledge_graph SET node_data=:n, edge_data=:e, version=COALESCE(version, 0) + 1 WHERE id=:id"),
+            {"n": master_node_json, "e": master_edge_json, "id": master_id}
+        )
+    else:
+        db.execute(
+            sql_text("INSERT INTO knowledge_graph (id, course_id, week, node_data, edge_data, graph_type, version) VALUES (:id, :c, :w, :n, :e, 'master', 1)"),
+            {"id": master_id, "c": course_id, "w": week, "n": master_node_json, "e": master_edge_json}
+        )
+    kg_store.save_graph(db, master_id, master_data['nodes'], master_data['edges'])
+    version = db.execute(
+        sql_text("SELECT version FROM knowledge_graph WHERE course_id=:c AND week=:w AND graph_type='master'"),
+        {"c": course_id, "w": week}
+    ).scalar()
+    db.commit()
+    seconds = _time.perf_counter() - started
+    metrics.observe("master_merge_seconds", seconds)
+    print(f"  ✓ Week {week} master v{version}: {len(graphs_to_merge)} file graph(s), "
+          f"{len(master_data['nodes'])} nodes in {seconds:.2f}s")
+    return {"version": version, "files": len(graphs_to_merge), "nodes": len(master_data["nodes"]),
+            "seconds": round(seconds, 3)}
+
+
+def schedule_master_merge(course_id, week):
+    """
+    Request a master merge for the week and return once a merge covering it
+    is done — by this caller (returns its stats) or by a concurrent upload's
+    caller whose merge came later (returns {"coalesced": True}).
+    """
+    seq = request_merge(course_id, week)
+    stats = run_when_due(course_id, week, seq, lambda db: rebuild_master_graph(db, course_id, week))
+    if stats is None:
+        metrics.inc("master_merges_total", outcome="coalesced")
+        return {"coalesced": True}
+    metrics.inc("master_merges_total", outcome="merged")
+    return stats
+
+
+# --- INCREMENTAL RE-UPLOADS ---
+# A re-upload of the same file (same course, week and file name) is diffed
+# slide by slide against the previous version (LectureVersion). If few
+# enough slides changed, Pass 1 is skipped and the previous structure is
+# kept, so sub-topic and concept IDs — and the MCQs keyed on them — stay
+# the same; only sub-topics whose slide_nums touch a changed slide go back
+# through Pass 2.
+INCREMENTAL_MAX_CHANGED = float(os.environ.get("AILA_INCREMENTAL_MAX_CHANGED", 0.5))
+
+
+def slide_fingerprints(segments_data) -> dict:
+    """{"<slide_num>": sha256 of title + text} for extracted slides."""
+    return {
+        str(s["slide_num"]): hashlib.sha256(f"{s.get('title', '')}\n{s['text']}".encode("utf-8")).hexdigest()
+        for s in segments_data
+    }
+
+
+def _changed_slides(old_hashes: dict, new_hashes: dict) -> set:
+    """Slide numbers that were edited, added or removed."""
+    return {int(n) for n in set(old_hashes) | set(new_hashes) if old_hashes.get(n) != new_hashes.get(n)}
+
+
+def plan_incremental(db, course_id, week, file_name, processing_id, new_hashes):
+    """
+    Return (previous LectureVersion, changed slide numbers) when this upload
+    can be processed incrementally, else (None, None). Falls back to a full
+    run when there is no previous version, slides were added (their content
+    has no place in the old structure) or too much of the deck changed.
+    """
+    prev = db.query(LectureVersion).filter(
+        LectureVersion.course_id == course_id,
+        LectureVersion.week == week,
+        LectureVersion.file_name == file_name,
+        LectureVersion.id != processing_id,
+    ).order_by(LectureVersion.created_at.desc()).first()
+    if not prev or not prev.slide_hashes or not (prev.structure or {}).get("sub_topics"):
+        return None, None
+    changed = _changed_slides(prev.slide_hashes, new_hashes)
+    added = set(new_hashes) - set(prev.slide_hashes)
+    if added or len(changed) > INCREMENTAL_MAX_CHANGED * max(1, len(new_hashes)):
+        print(f"[INCREMENTAL] {file_name}: {len(changed)} changed / {len(added)} added slides "
+              f"vs {prev.id} — full re-processing")
+        return None, None
+    return prev, changed
+
+
+def retire_previous_versions(db, course_id, week, file_name, keep_id):
+    """
+    Drop the file graphs, segments and version rows of older uploads of the
+    same file in this course week, so the master graph merges only the
+    latest version. Caller commits.
+    """
+    old_ids = [row[0] for row in db.query(LectureProcessing.id).filter(
+        LectureProcessing.course_id == course_id,
+        LectureProcessing.week == week,
+        LectureProcessing.file_name == file_name,
+        LectureProcessing.id != keep_id,
+        LectureProcessing.status == "done",
+    ).all()]
+    if old_ids:
+        db.query(Segment).filter(Segment.upload_id.in_(old_ids)).delete(synchronize_session=False)
+        db.query(LectureVersion).filter(LectureVersion.id.in_(old_ids)).delete(synchronize_session=False)
+    # Graphs saved before file graphs were keyed by processing id only match by name
+    old_graphs = [row[0] for row in db.execute(
+        sql_text("""
+            SELECT id FROM knowledge_graph
+            WHERE course_id = :c AND week = :w AND graph_type = 'file' AND source_file = :fname AND id != :keep
+        """),
+        {"c": course_id, "w": week, "fname": file_name, "keep": keep_id}
+    ).fetchall()]
+    if old_graphs:
+        db.query(KnowledgeGraph).filter(KnowledgeGraph.id.in_(old_graphs)).delete(synchronize_session=False)
+        kg_store.delete_graphs(db, old_graphs)
+    if old_ids:
+        print(f"🗂️ [VERSION] Retired {len(old_ids)} older upload(s) of {file_name}")
+
+
+def reuse_processed_upload(source_id, processing_id, course_id, week, file_name, content_hash, file_path):
+    """
+    Dedup path for a byte-identical re-upload: copy the segments and file
+    graph of an already processed upload into this course/week, and queue a
+    merge-only job for the master graph (merge_deduplicated_upload), so the
+    upload request doesn't wait for the merge. Returns False (caller falls
+    back to the full pipeline) if the source's artefacts are gone.
+    """
+    started = _time.perf_counter()
     db = SessionLocal()
+    try:
+        source = db.query(LectureProcessing).filter(LectureProcessing.id == source_id).first()
+        if not source:
+            return False
+        segments = db.query(Segment).filter(Segment.upload_id == (source.upload_id or source.id)).all()
+        file_graph = db.query(KnowledgeGraph).filter(
+            KnowledgeGraph.id == source.id, KnowledgeGraph.graph_type == "file"
+        ).first()
+        if not segments or not file_graph:
+            return False
+
+        for seg in segments:
+            db.add(Segment(
+                id=str(uuid.uuid4()), upload_id=processing_id, course_id=course_id, week=week,
+                segment_index=seg.segment_index, title=seg.title, content=seg.content,
+                keywords=seg.keywords, summary=seg.summary,
+            ))
+        db.execute(
+            sql_text("""
+                INSERT INTO knowledge_graph (id, course_id, week, node_data, edge_data, graph_type, source_file, version)
+                VALUES (:id, :c, :w, :n, :e, 'file', :fname, 1)
+            """),
+            {"id": processing_id, "c": course_id, "w": week,
+             "n": file_graph.node_data, "e": file_graph.edge_data, "fname": file_name}
+        )
+        kg_store.copy_graph(db, file_graph.id, processing_id)
+        version = db.query(LectureVersion).filter(LectureVersion.id == source.id).first()
+        if version:
+            db.add(LectureVersion(
+                id=processing_id, course_id=course_id, week=week, file_name=file_name,
+                slide_hashes=version.slide_hashes, structure=version.structure, expansions=version.expansions,
+            ))
+        retire_previous_versions(db, course_id, week, file_name, keep_id=processing_id)
+
+        # The job row commits together with the copies, so the merge never runs without them
+        seconds = _time.perf_counter() - started
+        enqueue_lecture(db, processing_id, file_path, course_id, week, file_name, content_hash=content_hash,
+                        progress=50, stats={"dedup": {"source_id": source.id, "segments": len(segments),
+                                                      "seconds": round(seconds, 3)}})
+        print(f"♻️ [DEDUP] {file_name} matches {source.id} — reused {len(segments)} segments "
+              f"and the file graph in {seconds * 1000:.0f}ms; master merge queued")
+        return True
+    except Exception as e:
+        db.rollback()
+        print(f"[DEDUP] Reuse of {source_id} failed, processing normally: {e}")
+        db.query(LectureProcessing).filter(LectureProcessing.id == processing_id).delete()
+        db.query(Segment).filter(Segment.upload_id == processing_id).delete()
+        db.query(LectureVersion).filter(LectureVersion.id == processing_id).delete()
+        db.execute(sql_text("DELETE FROM knowledge_graph WHERE id = :id"), {"id": processing_id})
+        kg_store.delete_graphs(db, [processing_id])
+        db.commit()
+        return False
+    finally:
+        db.close()
+
+
+def merge_deduplicated_upload(processing_id, course_id, week):
+    """
+    Queue job for a deduplicated upload (reuse_processed_upload): segments and
+    file graph are already in place, only the master merge is left.
+    """
+    merge = schedule_master_merge(course_id, week)
+    db = SessionLocal()
+    try:
+        job = db.query(LectureProcessing).filter(LectureProcessing.id == processing_id).first()
+        job.stats = {**(job.stats or {}), "merge": merge}
+        job.status, job.progress = "done", 100
+        db.commit()
+    finally:
+        db.close()
+    publish_progress(processing_id, "done", progress=100, status="done", deduplicated=True)
+
+
+def process_lecture_and_kg(filepath, upload_id, course_id, week, file_name, processing_id,
+                           raise_on_error=False):
+    """
+    Full lecture pipeline for one upload. Run by queue workers (job_queue.py),
+    which pass raise_on_error=True so a failure can be retried; the queue then
+    owns the error status. Safe to re-run for the same processing_id.
+    """
+    db = SessionLocal()
+    pipeline_started = stage_started = _time.perf_counter()
 
     try:
         # 0. Init Status
         db.query(LectureProcessing).filter(LectureProcessing.id == processing_id).update({
             "status": "processing", "progress": 5, "error_message": None
         })
+        # A retried attempt starts clean — drop anything a previous attempt saved
+        db.query(Segment).filter(Segment.upload_id == upload_id).delete(synchronize_session=False)
         db.commit()
+        publish_progress(processing_id, "started", progress=5, status="processing")
 
         # ---------- 1. Extract Slides (Robust Text Extraction) ----------
-        segments_data = []
-        ext = os.path.splitext(filepath)[-1].lower()
-        
-        if ext == ".pdf":
-            doc = fitz.open(filepath)
-            for i, page in enumerate(doc):
-                text = page.get_text(sort=True)
-                if not text.strip():
-                    continue
-                # Extract title: largest-font span on the page
-                page_title = f"Slide {i + 1}"
-                try:
-                    blocks = page.get_text("dict")["blocks"]
-                    spans = [
-                        s for b in blocks
-                        for l in b.get("lines", [])
-                        for s in l.get("spans", [])
-                        if s.get("text", "").strip()
-                    ]
-                    if spans:
-                        biggest = max(spans, key=lambda s: s["size"])
-                        candidate = biggest["text"].strip()
-                        if len(candidate) > 3:  # ignore single chars / page numbers
-                            page_title = candidate
-                except Exception:
-                    pass
-                segments_data.append({"slide_num": i + 1, "text": text, "title": page_title})
-        elif ext == ".pptx":
-            prs = Presentation(filepath)
-            for i, slide in enumerate(prs.slides):
-                slide_title = f"Slide {i + 1}"
-                lines = []
-                for shape in slide.shapes:
-                    # Extract title from the first non-empty text frame
-                    if hasattr(shape, "text") and shape.text.strip():
-                        if slide_title == f"Slide {i + 1}":  # not yet set
-                            slide_title = shape.text.strip().splitlines()[0][:120]
-                        lines.append(shape.text)
-                    # Also extract table cells
-                    if shape.has_table:
-                        for row_idx in range(shape.table.rows.count):
-                            row_cells = [
-                                shape.table.cell(row_idx, c).text.strip()
-                                for c in range(shape.table.columns.count)
-                            ]
-                            row_text = "\t".join(cell for cell in row_cells if cell)
-                            if row_text:
-                                lines.append(row_text)
-                content = "\n".join(lines)
-                if content.strip():
-                    segments_data.append({"slide_num": i + 1, "text": content, "title": slide_title})
+        # Big decks are sharded across a process pool (slide_extraction.py)
+        segments_data, extract_stats = extract_slides(filepath)
+        metrics.observe("slide_extraction_pages_per_second", extract_stats["pages_per_sec"] or 0,
+                        buckets=SIZE_BUCKETS)
+        job_stats = {"extraction": extract_stats}
+        db.query(LectureProcessing).filter(LectureProcessing.id == processing_id).update({
+            "stats": dict(job_stats)
+        })
+        db.commit()
 
         if not segments_data:
             raise ValueError("No readable slides found")
 
+        # Re-upload of a known file? Diff its slides against the previous version
+        slide_hashes = slide_fingerprints(segments_data)
+        prev_version, changed_slides = plan_incremental(
+            db, course_id, week, file_name, processing_id, slide_hashes
+        )
+
         # Save Segments
         print(f"[PROCESS] Saving {len(segments_data)} segments...")
         for seg in segments_data:
@@ -769,61 +1283,88 @@ def process_lecture_and_kg(filepath, upload_id, course_id, week, file_name, proc
             )
             db.add(new_seg)
         db.commit()
-
-        # Prepare Text — slide-boundary-aware truncation
-        # Each slide is formatted with its real title so the LLM can see headings.
-        def smart_truncate(segments, char_limit=28000):
-            """Pack whole slides up to char_limit. Never cuts mid-slide."""
-            budget = char_limit
-            chunks = []
-            for s in segments:
-                slide_title = s.get("title", f"Slide {s['slide_num']}")
-                block = f"--- {slide_title} (Slide {s['slide_num']}) ---\n{s['text']}"
-                if len(block) > budget:
-                    # If we have nothing yet, include a truncated version of the first slide
-                    # rather than sending an empty string
-                    if not chunks:
-                        chunks.append(block[:budget])
-                    break
-                chunks.append(block)
-                budget -= len(block)
-            return "\n\n".join(chunks)
-
-        full_text = smart_truncate(segments_data)
-        total_chars = sum(len(s["text"]) for s in segments_data)
-        if total_chars > 28000:
-            covered = len(segments_data[:len(full_text.split("--- ")) - 1])
-            print(f"⚠️ [WARN] Lecture {total_chars} chars. Fitting {len(full_text)} chars into LLM window (slide-boundary safe).")
-        print(f"📄 [TEXT] {len(full_text)} chars across {len(segments_data)} slides")
+        stage_started = _stage_done("extract", stage_started)
+        _report_progress(db, processing_id, "extracted", 15, slides=len(segments_data))
+
+        # Prepare Text — each slide is formatted with its real title so the LLM
+        # can see headings. Pass 1 windows the slides if they exceed its budget
+        # (identify_structure_chunked); Pass 2 slices per sub-topic from all of it.
+        slide_blocks = []
+        for s in segments_data:
+            slide_title = s.get("title", f"Slide {s['slide_num']}")
+            slide_blocks.append(f"--- {slide_title} (Slide {s['slide_num']}) ---\n{s['text']}")
+        full_text = "\n\n".join(slide_blocks)
+        print(f"📄 [TEXT] {len(full_text)} chars (~{count_tokens(full_text)} tokens) across {len(segments_data)} slides")
 
         # ---------- 2. TWO-PASS GENERATION ----------
         
-        # Pass 1: Identify Structure
-        structure = identify_structure(full_text, file_name)
-        if not structure:
-             # Fallback structure if LLM fails
-             structure = {"main_topic": file_name, "sub_topics": []}
-
-        # Cap sub-topics before Pass 2 to stay within free-tier quota.
-        # Priority: slide_depth=1 (dedicated section) > slide_depth=2 (mentioned)
-        # Skip slide_depth=3 (inferred/not in slides) — they cost a call but
-        # add the least value since there's no slide text to anchor them.
-        _MAX_SUBTOPICS = 8
-        all_subs = structure.get("sub_topics", [])
-        rich   = [s for s in all_subs if s.get("slide_depth", 1) == 1]
-        mentioned = [s for s in all_subs if s.get("slide_depth", 1) == 2]
-        inferred  = [s for s in all_subs if s.get("slide_depth", 1) == 3]
-        capped = (rich + mentioned)[:_MAX_SUBTOPICS]
-        if len(all_subs) > _MAX_SUBTOPICS:
-            print(f"⚠️ [QUOTA] Capping sub-topics {len(all_subs)}→{len(capped)} "
-                  f"(skipping {len(inferred)} inferred + overflow) to stay under free-tier limit")
-        structure["sub_topics"] = capped
-
-        # Brief pause so Pass 1's quota usage doesn't immediately collide with Pass 2
-        _time.sleep(5)
+        reuse_expansions = {}
+        if prev_version:
+            # Incremental: keep the previous structure (stable names → stable IDs)
+            # and reuse the expansion of every sub-topic off the changed slides
+            structure = copy.deepcopy(prev_version.structure)
+            capped = structure.get("sub_topics", [])
+            for st in capped:
+                touched = {int(n) for n in st.get("slide_nums", []) if str(n).isdigit()} & changed_slides
+                if not touched and st["name"] in (prev_version.expansions or {}):
+                    reuse_expansions[st["name"]] = prev_version.expansions[st["name"]]
+            job_stats["incremental"] = {
+                "previous": prev_version.id,
+                "changed_slides": sorted(changed_slides),
+                "reexpanded": len(capped) - len(reuse_expansions),
+                "reused": len(reuse_expansions),
+            }
+            print(f"🔁 [INCREMENTAL] {len(changed_slides)} changed slide(s) vs {prev_version.id}: "
+                  f"re-expanding {len(capped) - len(reuse_expansions)}/{len(capped)} sub-topics, skipping Pass 1")
+        else:
+            # Pass 1: Identify Structure (map-reduce over slide windows for long decks)
+            pass1_stats = {}
+            structure = identify_structure_chunked(slide_blocks, file_name, stats_out=pass1_stats)
+            job_stats["pass1"] = pass1_stats
+            if not structure:
+                 # Fallback structure if LLM fails
+                 structure = {"main_topic": file_name, "sub_topics": []}
+
+            # Cap sub-topics before Pass 2 to stay within free-tier quota.
+            # The cap grows with the number of Pass 1 windows, so long decks
+            # read in several windows don't lose most of their sections.
+            # Priority: slide_depth=1 (dedicated section) > slide_depth=2 (mentioned)
+            # Skip slide_depth=3 (inferred/not in slides) — they cost a call but
+            # add the least value since there's no slide text to anchor them.
+            _MAX_SUBTOPICS = min(MAX_SUBTOPICS, SUBTOPICS_PER_WINDOW * pass1_stats.get("chunks", 1))
+            all_subs = structure.get("sub_topics", [])
+            rich   = [s for s in all_subs if s.get("slide_depth", 1) == 1]
+            mentioned = [s for s in all_subs if s.get("slide_depth", 1) == 2]
+            inferred  = [s for s in all_subs if s.get("slide_depth", 1) == 3]
+            capped = (rich + mentioned)[:_MAX_SUBTOPICS]
+            if len(all_subs) > _MAX_SUBTOPICS:
+                print(f"⚠️ [QUOTA] Capping sub-topics {len(all_subs)}→{len(capped)} "
+                      f"(skipping {len(inferred)} inferred + overflow) to stay under free-tier limit")
+            structure["sub_topics"] = capped
+        stage_started = _stage_done("pass1", stage_started)
+        _report_progress(db, processing_id, "pass1", 35, sub_topics=len(capped),
+                         incremental=bool(prev_version))
+
+        # Let the limiter refill enough for Pass 2's fan-out before starting it,
+        # instead of a fixed pause that is too long on a warm bucket and too
+        # short on a drained one.
+        waited = llm_client.wait_for_budget(
+            PASS2_MODEL, min(len(capped) - len(reuse_expansions), PASS2_MAX_WORKERS), max_wait=PASS2_MAX_PACING
+        )
+        if waited >= 0.5:
+            print(f"⏳ [PASS 2] Paced {waited:.1f}s for limiter budget")
+        stage_started = _stage_done("pacing", stage_started)
 
         # Pass 2: Extract Concepts based on Structure
-        graph_data = extract_concepts(structure, full_text)
+        expansions = {}
+
+        def _subtopic_done(done, total, name):
+            publish_progress(processing_id, "pass2", progress=35 + int(45 * done / max(1, total)),
+                             done=done, total=total, sub_topic=name)
+
+        graph_data = extract_concepts(structure, full_text, reuse_expansions=reuse_expansions,
+                                      expansions_out=expansions, on_progress=_subtopic_done)
+        stage_started = _stage_done("pass2", stage_started)
         
         main_topic = structure.get("main_topic", file_name)
         # sub_topics is now list of {name, slide_nums} — extract names for logging
@@ -864,80 +1405,69 @@ def process_lecture_and_kg(filepath, upload_id, course_id, week, file_name, proc
                     gathered_text.append(slide_text_map[num])
             node["contents"] = "\n...\n".join(gathered_text)[:1500]
 
+        stage_started = _stage_done("postprocess", stage_started)
+        _report_progress(db, processing_id, "postprocess", 85, nodes=len(final_nodes), edges=len(final_edges))
+
         # ---------- 4. SAVE & MERGE ----------
         
         # A. Save FILE Graph
         node_json = json.dumps(final_nodes)
         edge_json = json.dumps(final_edges)
         
+        # Keyed by processing_id so a retried job replaces its own file graph;
+        # the version still moves on, so cached copies of the old one are dropped
+        previous_version = db.execute(
+            sql_text("SELECT version FROM knowledge_graph WHERE id = :id"), {"id": processing_id}
+        ).scalar()
+        db.execute(sql_text("DELETE FROM knowledge_graph WHERE id = :id"), {"id": processing_id})
         db.execute(
             sql_text("""
-                INSERT INTO knowledge_graph (id, course_id, week, node_data, edge_data, graph_type, source_file) 
-                VALUES (:id, :c, :w, :n, :e, 'file', :fname)
+                INSERT INTO knowledge_graph (id, course_id, week, node_data, edge_data, graph_type, source_file, version) 
+                VALUES (:id, :c, :w, :n, :e, 'file', :fname, :v)
             """),
             {
-                "id": str(uuid.uuid4()), "c": course_id, "w": week, 
-                "n": node_json, "e": edge_json, "fname": file_name
+                "id": processing_id, "c": course_id, "w": week, 
+                "n": node_json, "e": edge_json, "fname": file_name, "v": (previous_version or 0) + 1
             }
         )
+        kg_store.save_graph(db, processing_id, final_nodes, final_edges)
+        # Fingerprints + LLM output, for diffing the next upload of this file
+        db.query(LectureVersion).filter(LectureVersion.id == processing_id).delete()
+        db.add(LectureVersion(
+            id=processing_id, course_id=course_id, week=week, file_name=file_name,
+            slide_hashes=slide_hashes, structure=structure, expansions=expansions,
+        ))
+        retire_previous_versions(db, course_id, week, file_name, keep_id=processing_id)
         db.commit()
 
-        # B. Merge
-        print(f"🔄 [MERGE] Merging into Week {week} Master Graph...")
-        
-        all_files = db.execute(
-            sql_text("SELECT node_data, edge_data FROM knowledge_graph WHERE course_id=:c AND week=:w AND graph_type='file'"),
-            {"c": course_id, "w": week}
-        ).fetchall()
-        
-        graphs_to_merge = []
-        for row in all_files:
-            try:
-                graphs_to_merge.append({
-                    "nodes": json.loads(row[0]),
-                    "edges": json.loads(row[1])
-                })
-            except:
-                continue
-        
-        # Use our Robust Merge
-        master_data = merge_graphs(graphs_to_merge, week)
-        
-        # Update/Create Master
-        master_node_json = json.dumps(master_data['nodes'])
-        master_edge_json = json.dumps(master_data['edges'])
-        
-        existing_master = db.execute(
-            sql_text("SELECT id FROM knowledge_graph WHERE course_id=:c AND week=:w AND graph_type='master'"),
-            {"c": course_id, "w": week}
-        ).fetchone()
-
-        if existing_master:
-            db.execute(
-                sql_text("UPDATE knowledge_graph SET node_data=:n, edge_data=:e WHERE id=:id"),
-                {"n": master_node_json, "e": master_edge_json, "id": existing_master[0]}
-            )
-        else:
-            db.execute(
-                sql_text("INSERT INTO knowledge_graph (id, course_id, week, node_data, edge_data, graph_type) VALUES (:id, :c, :w, :n, :e, 'master')"),
-                {"id": str(uuid.uuid4()), "c": course_id, "w": week, "n": master_node_json, "e": master_edge_json}
-            )
-        db.commit()
+        # B. Merge (debounced: a burst of uploads to one week shares a merge)
+        job_stats["merge"] = schedule_master_merge(course_id, week)
+        publish_progress(processing_id, "merged", progress=95, version=job_stats["merge"].get("version"))
 
         # Finish
         db.query(LectureProcessing).filter(LectureProcessing.id == processing_id).update({
-            "status": "done", "progress": 100
+            "status": "done", "progress": 100, "stats": job_stats
         })
         db.commit()
+        _stage_done("save_merge", stage_started)
+        publish_progress(processing_id, "done", progress=100, status="done")
+        metrics.observe("lecture_total_seconds", _time.perf_counter() - pipeline_started)
+        metrics.inc("lectures_processed_total", status="done")
         print(f"✅ [COMPLETE] Saved & Merged.")
 
     except Exception as e:
         print(f"❌ [ERROR] {str(e)}")
         traceback.print_exc()
+        db.rollback()
+        if raise_on_error:
+            metrics.inc("lectures_processed_total", status="attempt_failed")
+            raise
         db.query(LectureProcessing).filter(LectureProcessing.id == processing_id).update({
             "status": "error", "progress": 0, "error_message": str(e)[:500]
         })
         db.commit()
+        publish_progress(processing_id, "error", progress=0, status="error", error=str(e)[:500])
+        metrics.inc("lectures_processed_total", status="error")
     finally:
         db.close()
 
@@ -1026,8 +1556,11 @@ def compute_levels(nodes, edges, explicit_root=None):
                 queue.append((child, depth + 1))
 
     # 5. Rescue Orphans — try semantic parent first, fall back to root
-    # Build list of already-reachable nodes for similarity comparison
-    reachable_nodes = [n for n in nodes if levels.get(n["id"], -1) != -1]
+    # Index already-reachable labels once; orphans are added as they attach
+    parent_index = NearestLabelIndex(_normalize_label)
+    for n in nodes:
+        if levels.get(n["id"], -1) != -1 and n["id"] != explicit_root:
+            parent_index.add(n["id"], n.get("label", n["id"]))
 
     new_edges = []
     if explicit_root:
@@ -1038,26 +1571,12 @@ def compute_levels(nodes, edges, explicit_root=None):
 
             orphan_label = node.get("label", nid)
 
-            # Try to find the best semantic parent among reachable nodes
-            best_parent_id = explicit_root  # default fallback
-            best_score = 0.0
-            for candidate in reachable_nodes:
-                if candidate["id"] == explicit_root:
-                    continue
-                candidate_label = candidate.get("label", candidate["id"])
-                from difflib import SequenceMatcher
-                score = SequenceMatcher(
-                    None,
-                    _normalize_label(orphan_label),
-                    _normalize_label(candidate_label)
-                ).ratio()
-                if score > best_score:
-                    best_score = score
-                    best_parent_id = candidate["id"]
+            # Best semantic parent among the reachable nodes most likely to match
+            best_parent_id, best_score = parent_index.best(orphan_label)
 
             # Only use the semantic parent if it's a reasonable match
             # (threshold 0.4 — loose, just avoids completely unrelated attachment)
-            if best_score < 0.4:
+            if best_parent_id is None or best_score < 0.4:
                 best_parent_id = explicit_root
 
             parent_level = levels.get(best_parent_id, 0)
@@ -1069,7 +1588,7 @@ def compute_levels(nodes, edges, explicit_root=None):
             levels[nid] = parent_level + 1
             node["isRoot"] = False
             # Add to reachable so subsequent orphans can attach to this one
-            reachable_nodes.append(node)
+            parent_index.add(nid, orphan_label)
 
     # 6. Finalize
     for node in nodes:
@@ -1100,7 +1619,10 @@ def _similar_labels(a: str, b: str, threshold: float = 0.85) -> bool:
     # Short labels need exact match; longer ones use similarity ratio
     if min(len(na), len(nb)) < 4:
         return na == nb
-    return SequenceMatcher(None, na, nb).ratio() >= threshold
+    matcher = SequenceMatcher(None, na, nb)
+    # the quick ratios are cheap upper bounds of ratio(): same answer, fewer full matches
+    return (matcher.real_quick_ratio() >= threshold and matcher.quick_ratio() >= threshold
+            and matcher.ratio() >= threshold)
 
 
 def merge_graphs(graphs_list, week_number):
@@ -1120,6 +1642,10 @@ def merge_graphs(graphs_list, week_number):
         "summary": "Overview of all topics covered this week."
     }
     merged_nodes[week_root_id] = week_root
+    # merged nodes except the week root; corpus ranks bigrams by rarity for the index
+    label_index = LabelIndex(_normalize_label, corpus=[
+        n.get('label', n.get('id')) for g in graphs_list for n in g.get('nodes', [])
+    ])
 
     for g in graphs_list:
         local_nodes = {n['id']: n for n in g.get('nodes', [])}
@@ -1153,14 +1679,9 @@ def merge_graphs(graphs_list, week_number):
         for nid, node in local_nodes.items():
             label = node.get('label', nid)
 
-            # Check if a node with a similar label already exists
-            canonical_id = None
-            for existing_id, existing_node in merged_nodes.items():
-                if existing_id == week_root_id:
-                    continue
-                if _similar_labels(label, existing_node.get('label', existing_id)):
-                    canonical_id = existing_id
-                    break
+            # Check if a node with a similar label already exists — the index
+            # narrows the search to plausible labels, earliest merged node wins
+            canonical_id = label_index.find(label, _similar_labels)
 
             if canonical_id:
                 # Duplicate found — remap this ID to the canonical one
@@ -1175,6 +1696,8 @@ def merge_graphs(graphs_list, week_number):
                 # New unique concept
                 id_remap[nid] = nid
                 merged_nodes[nid] = node
+                if nid != week_root_id:
+                    label_index.add(nid, node.get('label', nid))
 
         # 5. Merge Edges (rewrite IDs through remap table)
         for edge in local_edges:
@@ -1289,44 +1812,34 @@ def pick_next_concept(concept_ids, responses, graph_nodes_map, include_spaced=Tr
 
 @app.post("/api/upload-lecture/")
 async def upload_lecture(
-    background_tasks: BackgroundTasks, # Import BackgroundTasks from fastapi
     file: UploadFile = File(...),
     course_id: str = Form(...),
     week: int = Form(...),
     db: Session = Depends(get_db)
 ):
-    # 1. Save File
+    # 1. Stream to the content-addressed store, hashing as we go
     file_id = str(uuid.uuid4())
-    safe_filename = f"{file_id}_{file.filename}"
-    file_path = os.path.join(UPLOAD_DIR, safe_filename)
-    
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-
-    # 2. Create DB Record
-    processing_record = LectureProcessing(
-        id=file_id,
-        course_id=course_id,
-        week=week,
-        file_name=file.filename,
-        status="pending",
-        progress=0
-    )
-    db.add(processing_record)
-    db.commit()
+    content_hash, file_path, _ = await store_upload(file)
+
+    # 2. Same bytes already processed (any course)? Reuse its segments and
+    #    file graph and go straight to the merge — no extraction, no LLM calls.
+    twin = db.query(LectureProcessing).filter(
+        LectureProcessing.content_hash == content_hash,
+        LectureProcessing.status == "done",
+    ).order_by(LectureProcessing.created_at.desc()).first()
+    if twin:
+        reused = await asyncio.to_thread(
+            reuse_processed_upload, twin.id, file_id, course_id, week, file.filename, content_hash, file_path
+        )
+        if reused:
+            metrics.inc("lecture_uploads_total", dedup="hit")
+            return {"message": "Upload matched existing content", "processing_id": file_id, "deduplicated": True}
 
-    # 3. Trigger Background Processing (Calls your GOOD function)
-    background_tasks.add_task(
-        process_lecture_and_kg, # The big function above
-        file_path,
-        file_id, 
-        course_id, 
-        week, 
-        file.filename, 
-        file_id  # using file_id as processing_id for simplicity
-    )
+    # 3. Create the status row and queue the job (worker.py picks it up)
+    enqueue_lecture(db, file_id, file_path, course_id, week, file.filename, content_hash=content_hash)
+    metrics.inc("lecture_uploads_total", dedup="miss")
 
-    return {"message": "Upload started", "processing_id": file_id}
+    return {"message": "Upload queued", "processing_id": file_id}
 
 
 @app.get("/api/lecture-status/")
@@ -1338,9 +1851,84 @@ async def lecture_status(processing_id: str, db: Session = Depends(get_db)):
         "status": job.status,
         "progress": job.progress,
         "error": job.error_message,
-        "file_name": job.file_name
+        "file_name": job.file_name,
+        "attempts": job.attempts or 0,
+        "stats": job.stats or {},
     }
 
+
+def _lecture_snapshot(processing_id: str):
+    """Current status row as a progress event, or None if the job doesn't exist."""
+    db = SessionLocal()
+    try:
+        job = db.query(LectureProcessing).filter(LectureProcessing.id == processing_id).first()
+        if not job:
+            return None
+        return {
+            "type": "snapshot", "processing_id": processing_id, "status": job.status,
+            "progress": job.progress, "error": job.error_message, "file_name": job.file_name,
+            "attempts": job.attempts or 0,
+        }
+    finally:
+        db.close()
+
+
+async def _lecture_events(processing_id: str, is_disconnected=None):
+    """
+    Snapshot on connect, then pushed progress events until the job is done
+    or errored. Yields None as a keep-alive when nothing happened for a while.
+    """
+    queue = await progress_hub.subscribe(processing_id)
+    try:
+        snapshot = await asyncio.to_thread(_lecture_snapshot, processing_id)
+        if snapshot is None:
+            yield {"type": "error", "processing_id": processing_id, "status": "error", "error": "Job not found"}
+            return
+        yield snapshot
+        if snapshot["status"] in TERMINAL_STATUSES:
+            return
+        while not (is_disconnected and await is_disconnected()):
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=15)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            yield dict(event, type="progress")
+            if event.get("status") in TERMINAL_STATUSES:
+                return
+    finally:
+        progress_hub.unsubscribe(processing_id, queue)
+
+
+@app.get("/api/lecture-status/stream")
+async def lecture_status_stream(processing_id: str, request: Request):
+    """Server-Sent Events for one lecture job (replaces polling /api/lecture-status/)."""
+    async def _sse():
+        async for event in _lecture_events(processing_id, request.is_disconnected):
+            yield ": keep-alive\n\n" if event is None else f"data: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(_sse(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.websocket("/ws/lecture-status/{processing_id}")
+async def lecture_status_ws(websocket: WebSocket, processing_id: str):
+    """Same event stream as /api/lecture-status/stream, over a WebSocket."""
+    await websocket.accept()
+    try:
+        async for event in _lecture_events(processing_id):
+            # keep-alives double as the dead-client check
+            await websocket.send_json(event if event is not None else {"type": "keepalive"})
+        await websocket.close()
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+
+
+@app.get("/api/jobs/stats")
+def job_stats(db: Session = Depends(get_db)):
+    """Lecture queue depth by status and course, plus expired leases (dead workers)."""
+    return queue_stats(db)
+
 @app.get("/api/lecture-history/")
 async def lecture_history(course_id: str, db: Session = Depends(get_db)):
     jobs = db.query(LectureProcessing).filter(LectureProcessing.course_id == course_id).all()
@@ -1417,27 +2005,32 @@ def get_knowledge_graph(
     source_file: str = None,
     db: Session = Depends(get_db)
 ):
-    query = db.query(KnowledgeGraph).filter(
-        KnowledgeGraph.course_id == courseid,
-        KnowledgeGraph.week == week
-    )
-    
+    # Parsed once per graph version (kg_cache.py), not on every request
     if source_file:
-        query = query.filter(KnowledgeGraph.source_file == source_file, KnowledgeGraph.graph_type == "file")
+        kg = kg_cache.get(db, courseid, week, "file", source_file)
     else:
-        query = query.filter(KnowledgeGraph.graph_type == graph_type)
-        
-    kg = query.first()
+        kg = kg_cache.get(db, courseid, week, graph_type)
     
     if not kg:
         return {"nodes": [], "edges": []}
         
     return {
-        "nodes": json.loads(kg.node_data),
-        "edges": json.loads(kg.edge_data)
+        "nodes": kg.nodes,
+        "edges": kg.edges,
+        "version": kg.version,
     }
 
 
+@app.get("/api/knowledge-graph/node")
+def get_knowledge_graph_node(courseid: str, week: int, node_id: str, db: Session = Depends(get_db)):
+    """One concept of the week's master graph with its parents and children (indexed lookups)."""
+    graph_id = kg_store.master_graph_id(db, courseid, week)
+    node = kg_store.get_node(db, graph_id, node_id)
+    if not node:
+        raise HTTPException(status_code=404, detail="Concept not found")
+    return {"node": node, **kg_store.neighbours(db, graph_id, node_id)}
+
+
 # ==== RETRIEVAL PRACTICE: MCQ GENERATION (basic stub) ====
 @app.post("/api/generate-mcqs/")
 async def generate_mcqs(payload: MCQConceptModel = Body(...)):
@@ -1450,11 +2043,11 @@ async def generate_mcqs(payload: MCQConceptModel = Body(...)):
         "Make sure EACH QUESTION is accompanied by exactly 4 numbered options, and provide the correct answer as an 'answer' field (the text matching one of the options, not the letter/number). "
         "Respond ONLY as a JSON list in the format:"
         '[{"question": "...", "options": ["A", "B", "C", "D"], "answer": "..."}]\n'
-        f"\nConcept summary:\n{payload.summary[:600]}"
-        f"\n\nRelated contents (for MCQ details):\n{payload.contents[:1200]}"
+        f"\nConcept summary:\n{fit_tokens(payload.summary, SITE_BUDGETS['mcq_summary'])}"
+        f"\n\nRelated contents (for MCQ details):\n{fit_tokens(payload.contents, SITE_BUDGETS['mcq_contents'])}"
     )
     try:
-        model_output = gemini_generate("models/gemini-2.5-flash", prompt)
+        model_output = await gemini_generate_async("models/gemini-2.5-flash", prompt, call_site="mcq_concept")
         mcqs = extract_mcqs_from_response(model_output)
         out = []
         for item in mcqs:
@@ -1473,8 +2066,115 @@ async def generate_mcqs(payload: MCQConceptModel = Body(...)):
         }]}
 
 
+_MCQ_DIFFICULTIES = ["Easy", "Medium", "Hard"]
+_BLOOM_HIERARCHY = ["Remember", "Understand", "Apply", "Analyze", "Evaluate", "Create"]
+_HALLUCINATION_PHRASES = ["provided text", "according to", "the text states", "in the passage", "based on the passage"]
+_GENERATION_BLOOM_STR = ", ".join([f"'{x}'" for x in _BLOOM_HIERARCHY])
+_BLOOM_INSTRUCTION = f"""
+    BLOOM'S TAXONOMY REQUIREMENT:
+    - Generate questions across ALL cognitive levels: {_GENERATION_BLOOM_STR}
+    - Bloom hierarchy: Remember < Understand < Apply < Analyze < Evaluate < Create
+    - Create a DIVERSE mix of questions at different cognitive levels
+    - Include at least one question for each Bloom level if possible
+    - IMPORTANT: You MUST include the 'bloom_level' field for every question
+    """
+
+
+def _find_concept_nodes(db: Session, course_id, week, concept_ids) -> dict:
+    """
+    {concept_id: node or None} from the week's master graph. Indexed kg_nodes
+    lookups, falling back to normalize_id in case IDs diverged.
+    """
+    concept_ids = list(concept_ids)
+    try:
+        graph_id = kg_store.master_graph_id(db, course_id, week)
+        found = kg_store.get_nodes(db, graph_id, concept_ids)
+        normalized = {cid: normalize_id(cid or "") for cid in concept_ids if str(cid) not in found}
+        by_normalized = kg_store.get_nodes(db, graph_id, normalized.values())
+    except Exception as e:
+        print(f"[MCQ GEN] KG Lookup Error: {e}")
+        return {cid: None for cid in concept_ids}
+    if graph_id is None:
+        print(f"[MCQ GEN] Warning: no master KG for course {course_id}, week {week}.")
+
+    nodes = {}
+    for cid in concept_ids:
+        node = found.get(str(cid))
+        if node is None and cid in normalized:
+            node = by_normalized.get(normalized[cid])
+            if node:
+                print(f"[MCQ GEN] Matched concept via normalize_id: {cid} -> {normalized[cid]}")
+        if node:
+            print(f"[MCQ GEN] Found KG node '{node.get('label')}'")
+        elif graph_id is not None:
+            print(f"[MCQ GEN] WARNING: concept_id '{cid}' not found in KG nodes.")
+        nodes[cid] = node
+    return nodes
+
+
+def _concept_context(node) -> tuple:
+    """(summary, contents) used to ground MCQ generation for a KG node, trimmed to token budgets."""
+    if not node:
+        return "", ""
+    summary = node.get('summary', '') or ''
+    # Fall back to label if both summary and contents are empty
+    contents = node.get('contents') or summary or node.get('label', '')
+    return (fit_tokens(summary, SITE_BUDGETS["mcq_summary"]),
+            fit_tokens(contents, SITE_BUDGETS["mcq_contents"]))
+
+
+def _clean_generated_mcqs(mcqs: list, concept_id) -> list:
+    """Validate raw LLM MCQs: backfill difficulty/bloom, drop malformed and text-referencing ones."""
+    out = []
+    for idx, item in enumerate(mcqs):
+        if not (isinstance(item, dict) and 'question' in item and 'options' in item and 'answer' in item):
+            print(f"[MCQ GEN] Skipping malformed MCQ at index {idx}: {item}")
+            continue
+
+        # ✅ Ensure difficulty exists and is valid
+        if item.get('difficulty') not in _MCQ_DIFFICULTIES:
+            item['difficulty'] = random.choice(_MCQ_DIFFICULTIES)
+            print(f"[MCQ GEN] MCQ {idx}: Set default difficulty -> {item['difficulty']}")
+
+        # ✅ Ensure bloom_level exists and is valid
+        if item.get('bloom_level') not in _BLOOM_HIERARCHY:
+            item['bloom_level'] = random.choice(_BLOOM_HIERARCHY)
+            print(f"[MCQ GEN] MCQ {idx}: Set default bloom_level -> {item['bloom_level']}")
+
+        # Check for hallucinations (questions that reference "the text")
+        q_text = str(item['question']).lower()
+        if any(phrase in q_text for phrase in _HALLUCINATION_PHRASES):
+            print(f"[MCQ GEN] Skipping hallucinated question: {item['question'][:60]}...")
+            continue
+
+        # ✅ Attach concept_id
+        item['concept_id'] = concept_id
+        out.append(item)
+    return out
+
+
+# Concurrent requests for the same (course, week, concept, quiz) generation
+# share one LLM call — e.g. a class hitting an empty concept at the same time.
+_mcq_generation_flight = SingleFlight("mcq generation")
+
+
 @app.post("/api/generate-mcqs-kg")
-async def generate_mcqs_kg(payload: dict = Body(...), db: Session = Depends(get_db)):
+async def generate_mcqs_kg(payload: dict = Body(...)):
+    key = (
+        payload.get("course_id"),
+        payload.get("week"),
+        payload.get("concept_id") or payload.get("segment_id"),
+        payload.get("quiz_id"),
+        int(payload.get("num_questions", 5)),
+        payload.get("use_cache"),
+    )
+    # The flight outlives the first caller's request, so it reads through its own session
+    result = await _mcq_generation_flight.run(key, lambda: _generate_mcqs_kg(payload))
+    # Every caller gets its own copy — callers tag and mutate the MCQ dicts
+    return copy.deepcopy(result)
+
+
+async def _generate_mcqs_kg(payload: dict):
     course_id = payload.get("course_id")
     week = payload.get("week")
     concept_id = payload.get("concept_id") or payload.get("segment_id")
@@ -1484,71 +2184,23 @@ async def generate_mcqs_kg(payload: dict = Body(...), db: Session = Depends(get_
     
     print(f"[MCQ GEN] Starting generation for concept: {concept_id}, quiz: {quiz_id}, target: {num_questions} Qs")
     
-    # 1. Determine Difficulty Range (NOT affected by settings - always generate all)
-    all_difficulties = ["Easy", "Medium", "Hard"]
-    
-    # 2. Determine Bloom Level Range (NOT affected by settings - always generate all)
-    bloom_hierarchy = ["Remember", "Understand", "Apply", "Analyze", "Evaluate", "Create"]
-    
-    # ✅ GENERATION should ALWAYS create all Bloom levels and difficulties
+    # 1-2. ✅ GENERATION should ALWAYS create all Bloom levels and difficulties
     # ✅ FILTERING happens later in student quiz start endpoint
-    generation_bloom_levels = bloom_hierarchy[:]
-    generation_bloom_str = ", ".join([f"'{x}'" for x in generation_bloom_levels])
-    
+    generation_bloom_str = _GENERATION_BLOOM_STR
+
     print(f"[MCQ GEN] Will generate across ALL Bloom levels: {generation_bloom_str}")
-    print(f"[MCQ GEN] Will generate across ALL difficulties: {all_difficulties}")
+    print(f"[MCQ GEN] Will generate across ALL difficulties: {_MCQ_DIFFICULTIES}")
 
-    # 3. Fetch KG Context (Robust Attribute Access)
-    kg_entry = None
+    # 3. Fetch KG Context
+    db = SessionLocal()
     try:
-        kg_entry = db.query(KnowledgeGraph).filter(
-            KnowledgeGraph.course_id == course_id,
-            KnowledgeGraph.week == week,
-            KnowledgeGraph.graph_type == "master"  # Use the master merged graph
-        ).first()
-    except Exception as e:
-        print(f"[MCQ GEN] KG Lookup Error: {e}")
-
-    selected_summary = ""
-    selected_contents = ""
-
-    if kg_entry:
-        try:
-            raw_node_data = kg_entry.node_data
-            
-            if raw_node_data:
-                kg_nodes = json.loads(raw_node_data)
-                # BUG FIX: also try normalize_id fallback in case IDs diverged
-                selected_node = next((n for n in kg_nodes if n.get('id') == concept_id), None)
-                if not selected_node:
-                    norm_cid = normalize_id(concept_id)
-                    selected_node = next((n for n in kg_nodes if n.get('id') == norm_cid), None)
-                    if selected_node:
-                        print(f"[MCQ GEN] Matched concept via normalize_id: {concept_id} -> {norm_cid}")
-                if selected_node:
-                    selected_summary = selected_node.get('summary', '')
-                    # BUG FIX: fall back to label if both summary and contents are empty
-                    selected_contents = selected_node.get('contents') or selected_summary or selected_node.get('label', '')
-                    print(f"[MCQ GEN] Found KG node '{selected_node.get('label')}' — summary={len(selected_summary)} chars, contents={len(selected_contents)} chars")
-                else:
-                    print(f"[MCQ GEN] WARNING: concept_id '{concept_id}' not found in KG nodes. Available IDs: {[n.get('id') for n in kg_nodes[:10]]}")
-            else:
-                print("[MCQ GEN] Warning: KG entry found but no node data.")
-                
-        except json.JSONDecodeError:
-            print("[MCQ GEN] Error decoding KG JSON")
-        except Exception as e:
-            print(f"[MCQ GEN] Error parsing KG nodes: {e}")
+        selected_node = _find_concept_nodes(db, course_id, week, [concept_id])[concept_id]
+    finally:
+        db.close()
+    selected_summary, selected_contents = _concept_context(selected_node)
 
     # 4. ✅ Build Bloom Instruction (GENERATE ALL LEVELS - no constraints)
-    bloom_instruction = f"""
-    BLOOM'S TAXONOMY REQUIREMENT:
-    - Generate questions across ALL cognitive levels: {generation_bloom_str}
-    - Bloom hierarchy: Remember < Understand < Apply < Analyze < Evaluate < Create
-    - Create a DIVERSE mix of questions at different cognitive levels
-    - Include at least one question for each Bloom level if possible
-    - IMPORTANT: You MUST include the 'bloom_level' field for every question
-    """
+    bloom_instruction = _BLOOM_INSTRUCTION
 
     # 5. Prompt Generation
     prompt = f"""
@@ -1584,49 +2236,27 @@ Response Format (EXACT JSON):
 ]
 
 --- CONCEPT CONTEXT ---
-Summary: {selected_summary[:800] if selected_summary else "No summary available."}
-Details: {selected_contents[:1200] if selected_contents else "No additional details."}
+Summary: {selected_summary or "No summary available."}
+Details: {selected_contents or "No additional details."}
 
 Generate {num_questions} diverse questions covering different Bloom levels and difficulties.
 """
 
     try:
-        model_output = gemini_generate('models/gemini-2.5-flash', prompt)
+        model_output = await gemini_generate_async(
+            'models/gemini-2.5-flash', prompt,
+            call_site="mcq_kg",
+            # Uncached by default (llm_cache.UNCACHED_SITES); use_cache=True forces the cache on
+            cache=payload.get("use_cache"),
+        )
         print(f"[MCQ GEN] Raw LLM output length: {len(model_output)}")
         
         mcqs = extract_mcqs_from_response(model_output)
         
         print(f"[MCQ GEN] Extracted {len(mcqs)} raw MCQs from response")
 
-        out = []
-        
-        for idx, item in enumerate(mcqs):
-            if isinstance(item, dict) and 'question' in item and 'options' in item and 'answer' in item:
-                
-                # ✅ Ensure difficulty exists and is valid
-                if 'difficulty' not in item or item['difficulty'] not in all_difficulties:
-                    item['difficulty'] = random.choice(all_difficulties)
-                    print(f"[MCQ GEN] MCQ {idx}: Set default difficulty -> {item['difficulty']}")
-                
-                # ✅ Ensure bloom_level exists and is valid
-                if 'bloom_level' not in item or item['bloom_level'] not in bloom_hierarchy:
-                    item['bloom_level'] = random.choice(bloom_hierarchy)
-                    print(f"[MCQ GEN] MCQ {idx}: Set default bloom_level -> {item['bloom_level']}")
-                else:
-                    print(f"[MCQ GEN] MCQ {idx}: bloom_level = {item['bloom_level']}, difficulty = {item['difficulty']}")
-                
-                # Check for hallucinations (questions that reference "the text")
-                q_text = item['question'].lower()
-                if any(phrase in q_text for phrase in ["provided text", "according to", "the text states", "in the passage", "based on the passage"]):
-                    print(f"[MCQ GEN] Skipping hallucinated question: {item['question'][:60]}...")
-                    continue
-
-                # ✅ Attach concept_id
-                item['concept_id'] = concept_id
-                out.append(item)
-            else:
-                print(f"[MCQ GEN] Skipping malformed MCQ at index {idx}: {item}")
-        
+        out = _clean_generated_mcqs(mcqs, concept_id)
+
         # ✅ Log distribution
         bloom_distribution = {}
         difficulty_distribution = {}
@@ -1648,6 +2278,144 @@ Generate {num_questions} diverse questions covering different Bloom levels and d
 
 
 
+# ── Batched multi-concept generation ───────────────────────────────────────
+# Packs several concepts into one prompt with a keyed JSON response, so a
+# 10-concept quiz costs a couple of rate-limited calls instead of ten.
+# Batch size adapts to both the prompt budget (concept context) and the
+# expected response size (questions per concept).
+_MCQ_BATCH_PROMPT_TOKENS = SITE_BUDGETS["mcq_batch"]  # concept context per batch prompt
+_MCQ_BATCH_OUTPUT_TOKENS = 7000    # expected response size per batch
+_MCQ_TOKENS_PER_QUESTION = 150     # rough size of one generated MCQ in JSON
+_MCQ_BATCH_MAX_ROUNDS    = 3       # failed concepts are re-queued, batch cap halves each round
+
+
+def _mcq_concept_block(concept_id, node) -> str:
+    summary, contents = _concept_context(node)
+    label = node.get("label", concept_id) if node else concept_id
+    return (
+        f'=== CONCEPT KEY: "{concept_id}" (label: {label}) ===\n'
+        f'Summary: {summary or "No summary available."}\n'
+        f'Details: {contents or "No additional details."}\n'
+    )
+
+
+def _pack_mcq_batches(blocks: dict, num_questions: int, max_concepts: int) -> list:
+    """Greedily group concept IDs so each batch fits the prompt and output budgets."""
+    output_cap = max(1, _MCQ_BATCH_OUTPUT_TOKENS // (_MCQ_TOKENS_PER_QUESTION * max(1, num_questions)))
+    cap = max(1, min(max_concepts, output_cap))
+    batches, current, used = [], [], 0
+    for cid, block in blocks.items():
+        cost = count_tokens(block)
+        if current and (len(current) >= cap or used + cost > _MCQ_BATCH_PROMPT_TOKENS):
+            batches.append(current)
+            current, used = [], 0
+        current.append(cid)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+async def _generate_mcq_batch(concept_ids: list, blocks: dict, num_questions: int,
+                              priority: str = PRIORITY_BATCH, cache: bool = None) -> dict:
+    """One LLM call for several concepts. Returns {concept_id: [clean mcqs]}; failures map to []."""
+    prompt = f"""
+As an expert computer science instructor, create high-quality multiple-choice questions (MCQs)
+for EACH of the {len(concept_ids)} concepts below.
+
+TARGET DIFFICULTIES: Generate questions at Easy, Medium, and Hard levels (mix them)
+
+{_BLOOM_INSTRUCTION}
+
+STRICT FORMATTING RULES:
+1. Questions must be stand-alone and not reference "the text" or "according to..."
+2. Provide exactly 4 options per question (as a list)
+3. REQUIRED: Include 'difficulty' field with one of: "Easy", "Medium", "Hard"
+4. REQUIRED: Include 'bloom_level' field with one of: {_GENERATION_BLOOM_STR}
+5. Each question must be about the concept it is listed under — never mix concepts
+6. Respond ONLY as a valid JSON object (no markdown, no backticks, no code blocks)
+   whose keys are EXACTLY the concept keys given below
+
+Response Format (EXACT JSON):
+{{
+  "<concept key>": [
+    {{
+      "question": "What is the time complexity of binary search?",
+      "options": ["O(1)", "O(log n)", "O(n)", "O(n²)"],
+      "answer": "O(log n)",
+      "difficulty": "Medium",
+      "bloom_level": "Remember"
+    }}
+  ]
+}}
+
+--- CONCEPTS ---
+{chr(10).join(blocks[cid] for cid in concept_ids)}
+
+Generate {num_questions} diverse questions for EACH concept covering different Bloom levels and difficulties.
+"""
+    try:
+        model_output = await gemini_generate_async(
+            'models/gemini-2.5-flash', prompt, call_site="mcq_batch", priority=priority, cache=cache
+        )
+    except Exception as ex:
+        print(f"[MCQ BATCH] ❌ Call failed for {len(concept_ids)} concepts: {ex}")
+        return {cid: [] for cid in concept_ids}
+
+    with metrics.timed("llm_parse_seconds", call_site="mcq_batch"):
+        parsed = repair_json(model_output)
+    if not isinstance(parsed, dict):
+        parsed = {}
+    results = {}
+    for cid in concept_ids:
+        raw = parsed.get(cid)
+        if raw is None:
+            # LLMs sometimes normalise keys — accept a normalize_id match
+            raw = next((v for k, v in parsed.items() if normalize_id(str(k)) == normalize_id(cid)), None)
+        results[cid] = _clean_generated_mcqs(raw, cid) if isinstance(raw, list) else []
+    return results
+
+
+async def generate_mcqs_kg_batch(course_id, week, concept_ids: list, num_questions: int,
+                                 db: Session, max_concepts: int = 8,
+                                 priority: str = PRIORITY_BATCH, cache: bool = None) -> dict:
+    """
+    Generate MCQs for many concepts using as few LLM calls as possible.
+    Concepts whose slice of a response is missing or unusable are re-queued
+    into smaller batches; after _MCQ_BATCH_MAX_ROUNDS they are given up on.
+    Returns {concept_id: [mcq dicts]} for every requested concept.
+    """
+    kg_nodes = _find_concept_nodes(db, course_id, week, concept_ids)
+    blocks = {cid: _mcq_concept_block(cid, kg_nodes[cid]) for cid in concept_ids}
+
+    results = {cid: [] for cid in concept_ids}
+    pending = list(concept_ids)
+    for round_no in range(1, _MCQ_BATCH_MAX_ROUNDS + 1):
+        if not pending:
+            break
+        batches = _pack_mcq_batches({cid: blocks[cid] for cid in pending}, num_questions, max_concepts)
+        print(f"[MCQ BATCH] Round {round_no}: {len(pending)} concepts in {len(batches)} call(s) "
+              f"(≤{max_concepts} per call)")
+        batch_results = await asyncio.gather(
+            *[_generate_mcq_batch(batch, blocks, num_questions, priority, cache) for batch in batches]
+        )
+        failed = []
+        for batch_result in batch_results:
+            for cid, mcqs in batch_result.items():
+                if mcqs:
+                    results[cid] = mcqs
+                else:
+                    failed.append(cid)
+        if failed:
+            print(f"[MCQ BATCH] Re-queueing {len(failed)} failed concept(s): {failed}")
+        pending = failed
+        max_concepts = max(1, max_concepts // 2)
+
+    if pending:
+        print(f"[MCQ BATCH] ⚠️ Gave up on {len(pending)} concept(s) after {_MCQ_BATCH_MAX_ROUNDS} rounds: {pending}")
+    return results
+
+
 @app.get("/api/mcqs/")
 async def get_mcqs(segment_id: str, db: Session = Depends(get_db)):
     # Return MCQs for the segment
@@ -1789,11 +2557,14 @@ def delete_upload(upload_id: str, db: Session = Depends(get_db)):
     if not record:
         raise HTTPException(status_code=404, detail="Upload not found")
     
-    # DELETE GRAPH LOGIC
-    db.query(KnowledgeGraph).filter(
+    # DELETE GRAPH LOGIC — the kg_nodes / kg_edges rows go in the same transaction
+    graph_ids = [row[0] for row in db.query(KnowledgeGraph.id).filter(
         KnowledgeGraph.course_id == record.course_id,
         KnowledgeGraph.week == record.week
-    ).delete()
+    ).all()]
+    if graph_ids:
+        db.query(KnowledgeGraph).filter(KnowledgeGraph.id.in_(graph_ids)).delete(synchronize_session=False)
+        kg_store.delete_graphs(db, graph_ids)
     
     db.delete(record)
     db.commit()
@@ -1824,6 +2595,7 @@ async def delete_quiz(quiz_id: str, db: Session = Depends(get_db)):
 
     # 5. Delete the Quiz itself
     db.delete(quiz)
+    mastery.delete_quiz(db, quiz_id)
     
     try:
         db.commit()
@@ -1914,6 +2686,15 @@ async def start_quiz_attempt(
     db.add(new_attempt)
     db.commit()
     db.refresh(new_attempt)
+
+    # Warm the bank before the first question is asked for
+    quiz = db.query(Quiz).filter(Quiz.id == quiz_id).first()
+    if quiz and quiz.concept_ids:
+        buckets = _quiz_buckets(db.query(QuizSettings).filter_by(quiz_id=quiz_id).first())
+        depth = mcq_bank.bank_depth(db, quiz_id)
+        low = [cid for cid in quiz.concept_ids if mcq_bank.needs_topup(depth.get(cid, Counter()), buckets)]
+        if low:
+            mcq_replenisher.schedule(quiz_id, low)
     return {"attempt_id": new_attempt.id, "resume": False}
 
 # --- 4. Fetch next adaptive MCQ (students; Gemini/KG) ---
@@ -1936,14 +2717,10 @@ async def get_next_mcq_gemini(attempt_id: str, db: Session = Depends(get_db)):
     kg_nodes_map = {} # Default to empty dict
     
     try:
-        kg_row = db.execute(
-            sql_text("SELECT node_data FROM knowledge_graph WHERE course_id=:c AND week=:w"),
-            {"c": quiz.course_id, "w": quiz.week}
-        ).fetchone()
-
-        if kg_row and kg_row[0]:
-            nodes = json.loads(kg_row[0])
-            kg_nodes_map = {n['id']: n for n in nodes}
+        # Cached parse of the master graph, re-read only when its version changes
+        kg = kg_cache.get(db, quiz.course_id, quiz.week)
+        if kg:
+            kg_nodes_map = kg.by_id
     except Exception as e:
         print(f"[WARNING] Graph load failed for Quiz {quiz.id}: {e}")
         # Proceed with empty map - logic will fallback to random choice
@@ -1956,19 +2733,23 @@ async def get_next_mcq_gemini(attempt_id: str, db: Session = Depends(get_db)):
         include_spaced=(settings.include_spaced if settings else False)
     )
 
-    # 4. Try Cached MCQs First
-    existing_mcqs = db.query(MCQ).filter(
-        MCQ.quiz_id == quiz.id, 
-        MCQ.concept_id == next_concept_id
-    ).all()
-    
-    # Filter out already answered
+    # 4. Serve from the bank only — generation happens in the background
     answered_ids = set(responses.keys())
-    valid_mcqs = [m for m in existing_mcqs if m.id not in answered_ids]
+    buckets = _quiz_buckets(settings)
+    unused = db.query(MCQ).filter(MCQ.quiz_id == quiz.id, ~MCQ.id.in_(answered_ids))
+    valid_mcqs = unused.filter(MCQ.concept_id == next_concept_id).all()
+
+    if not valid_mcqs:
+        # The picked concept ran dry: serve another concept now, refill this one
+        mcq_replenisher.schedule(quiz.id, [next_concept_id], urgent=True)
+        valid_mcqs = unused.all()
+        if valid_mcqs:
+            metrics.inc("mcq_bank_stalls_total", reason="concept_empty")
 
     if valid_mcqs:
         # Pick one (random or by difficulty if you implemented that)
         selected = random.choice(valid_mcqs)
+        mcq_replenisher.after_serve(db, quiz.id, selected.concept_id, answered_ids | {selected.id}, buckets)
         return {
             "mcq_id": selected.id,
             "question": selected.question,
@@ -1978,48 +2759,86 @@ async def get_next_mcq_gemini(attempt_id: str, db: Session = Depends(get_db)):
             "concept_id": selected.concept_id
         }
 
-    # 5. Generate New if None Exist
-    print(f"⚡ Generating fresh MCQ for {next_concept_id}...")
-    # BUG FIX: kg_payload was referencing new_mcq (undefined at this point)
-    kg_payload = {
-        "course_id": quiz.course_id,
-        "week": quiz.week,
-        "concept_id": next_concept_id,
-        "quiz_id": quiz.id,
-    }
-    
+    # 5. Nothing unanswered in the whole bank: ask the client to come back
+    # once the top-up lands, unless generation keeps failing
+    metrics.inc("mcq_bank_stalls_total", reason="bank_empty")
+    if mcq_replenisher.exhausted(quiz.id, concept_ids) and not mcq_replenisher.busy(quiz.id, concept_ids):
+        return {"done": True, "reason": "generation_failed"}
+    mcq_replenisher.schedule(quiz.id, concept_ids, urgent=True)
+    return {"done": False, "pending": True, "reason": "bank_warming", "retry_after": 2}
+
+
+def _quiz_buckets(settings) -> list:
+    """(bloom_level, difficulty) pairs a quiz's settings allow — the bank keeps each of them stocked."""
+    def span(levels, low, high):
+        lo = levels.index(low) if low in levels else 0
+        hi = levels.index(high) if high in levels else len(levels) - 1
+        return levels[min(lo, hi):max(lo, hi) + 1]
+    blooms = span(_BLOOM_HIERARCHY, getattr(settings, "min_bloom_level", None), getattr(settings, "max_bloom_level", None))
+    difficulties = span(_MCQ_DIFFICULTIES, getattr(settings, "min_difficulty", None), getattr(settings, "max_difficulty", None))
+    return [(b, d) for b in blooms for d in difficulties]
+
+
+async def _top_up_bank(quiz_id, concept_ids, urgent) -> dict:
+    """Replenisher fill function: generate fresh MCQs for concepts and save them to the quiz bank."""
+    db = SessionLocal()
     try:
-        gen_resp = await generate_mcqs_kg(kg_payload, db)
-        new_mcqs_data = gen_resp.get("mcqs", [])
-        
-        if new_mcqs_data:
-            # SAVE IT IMMEDIATELY so it has a real ID
-            first_q = new_mcqs_data[0]
-            # BUG FIX: item["bloom_level"] was undefined — use first_q
-            new_mcq = MCQ(
-                id=str(uuid.uuid4()),
-                quiz_id=quiz.id,
-                concept_id=next_concept_id,
-                question=first_q["question"],
-                options=first_q["options"],
-                answer=first_q["answer"],
-                difficulty=first_q.get("difficulty", "Medium"),
-                bloom_level=first_q.get("bloom_level", "Remember"),
-            )
-            db.add(new_mcq)
-            db.commit()
-            
-            return {
-                "mcq_id": new_mcq.id,
-                "question": new_mcq.question,
-                "options": new_mcq.options,
-                "concept_id": new_mcq.concept_id
+        quiz = db.query(Quiz).filter(Quiz.id == quiz_id).first()
+        if not quiz:
+            return {}
+        # answered questions are already in the bank — cached responses would repeat them
+        generated = await generate_mcqs_kg_batch(
+            quiz.course_id, quiz.week, concept_ids, mcq_bank.TOPUP_SIZE, db,
+            priority=PRIORITY_INTERACTIVE if urgent else PRIORITY_BATCH, cache=False,
+        )
+        saved = {}
+        for cid, items in generated.items():
+            for item in items:
+                db.add(MCQ(
+                    id=str(uuid.uuid4()),
+                    quiz_id=quiz.id,
+                    concept_id=cid,
+                    question=item["question"],
+                    options=item["options"],
+                    answer=item["answer"],
+                    difficulty=item.get("difficulty", "Medium"),
+                    bloom_level=item.get("bloom_level", "Remember"),
+                ))
+            saved[cid] = len(items)
+        db.commit()
+        mcq_replenisher.publish_depth(db, quiz.id)
+        return saved
+    finally:
+        db.close()
+
+
+mcq_replenisher = BankReplenisher(_top_up_bank)
+
+
+@app.get("/api/quiz/{quiz_id}/bank")
+def get_quiz_bank(quiz_id: str, attempt_id: str = None, db: Session = Depends(get_db)):
+    """Question-bank depth per concept and (bloom, difficulty), optionally excluding an attempt's answers."""
+    quiz = db.query(Quiz).filter(Quiz.id == quiz_id).first()
+    if not quiz:
+        raise HTTPException(status_code=404, detail="Quiz not found")
+    answered = []
+    if attempt_id:
+        attempt = db.query(QuizAttempt).filter_by(id=attempt_id).first()
+        answered = list((attempt.responses or {}).keys()) if attempt else []
+    buckets = _quiz_buckets(db.query(QuizSettings).filter_by(quiz_id=quiz_id).first())
+    depth = mcq_bank.bank_depth(db, quiz_id, answered)
+    return {
+        "quiz_id": quiz_id,
+        "low_water": mcq_bank.LOW_WATER,
+        "concepts": {
+            cid: {
+                "unused": sum(depth.get(cid, {}).values()),
+                "needs_topup": mcq_bank.needs_topup(depth.get(cid, Counter()), buckets),
+                "buckets": {f"{b}/{d}": n for (b, d), n in sorted(depth.get(cid, {}).items(), key=str)},
             }
-            
-    except Exception as e:
-        print(f"Gen Failed: {e}")
-    
-    return {"done": True, "reason": "generation_failed"}
+            for cid in (quiz.concept_ids or [])
+        },
+    }
 
 @app.post("/api/quiz/{quiz_id}/mcqs")  # or whatever
 async def add_generated_mcqs(quiz_id: str, payload: dict, db):
@@ -2069,25 +2888,29 @@ async def submit_mcq_answer(
     else:
         raise HTTPException(status_code=400, detail="No answer key for this MCQ")
 
-    responses = attempt.responses or {}
-    responses[mcq_id] = {
-        "selected": selected,
-        "correct": correct,
-        "concept_id": concept_id_used,
-    }
-    attempt.responses = responses
-    db.commit()
+    def write(wdb):
+        # re-read under the writer so answers landing together don't overwrite each other
+        attempt = wdb.get(QuizAttempt, attempt_id)
+        responses = dict(attempt.responses or {})
+        responses[mcq_id] = {
+            "selected": selected,
+            "correct": correct,
+            "concept_id": concept_id_used,
+        }
+        attempt.responses = responses
+        if attempt.completed:
+            mastery.apply_attempt(wdb, attempt_id, -1)
+        _upsert_responses(wdb, [{
+            "attempt_id": attempt_id,
+            "mcq_id": mcq_id,
+            "question": question,
+            "selected_answer": selected,
+            "is_correct": correct,
+        }])
+        if attempt.completed:
+            mastery.apply_attempt(wdb, attempt_id, +1)
 
-    mcq_resp = MCQResponse(
-        id=str(uuid.uuid4()),
-        attempt_id=attempt_id,
-        mcq_id=mcq_id,
-        question=question,
-        selected=selected,
-        correct=correct,
-    )
-    db.add(mcq_resp)
-    db.commit()
+    await db_writer.run(write, release=db)
 
     return {"correct": correct, "answer": answer_val}
 
@@ -2157,6 +2980,35 @@ async def quiz_stats(quiz_id: str, db: Session = Depends(get_db)):
 async def root():
     return {"message": "AILA Backend (SQLite) is running"}
 
+@app.get("/api/llm/limiter")
+async def llm_limiter_stats():
+    """Available tokens and per-lane (interactive / batch) queue depth for each model."""
+    return await asyncio.to_thread(llm_client.limiter_stats)
+
+
+@app.get("/api/llm/cache-stats")
+async def llm_cache_stats():
+    """Hit/miss counters and size of the persistent LLM response cache."""
+    return await asyncio.to_thread(llm_cache.stats)
+
+@app.get("/api/metrics")
+async def get_metrics(prefix: str = None, scope: str = "all"):
+    """
+    Counters and histograms (latency, limiter wait, retries, prompt/response
+    size per call site and model; lecture pipeline stage timings).
+    ?prefix=llm_ narrows the output to one family. Worker processes' values
+    are merged in (see metrics_share.py); ?scope=local shows this process only.
+    """
+    if scope == "local":
+        return metrics.snapshot(prefix)
+    return await asyncio.to_thread(metrics_share.merged, prefix)
+
+@app.get("/api/llm/prompt-stats")
+async def llm_prompt_stats(limit: int = 50, scope: str = "all"):
+    """Prompt-token counts vs latency: per-call-site summary plus the most recent calls."""
+    log = prompt_log if scope == "local" else await asyncio.to_thread(metrics_share.merged_prompt_log)
+    return {"by_call_site": log.summary(), "recent": log.recent(limit)}
+
 # --- 9. Delete upload/file endpoint (optional housekeeping) ---
 @app.post("/api/delete-upload")
 async def delete_upload(uploadid: str = Form(...), db: Session = Depends(get_db)):
@@ -2273,7 +3125,7 @@ async def generate_quiz_title(payload: TitleGenRequest):
     )
 
     try:
-        raw_title = gemini_generate('models/gemini-2.5-flash', prompt)
+        raw_title = await gemini_generate_async('models/gemini-2.5-flash', prompt, call_site="quiz_title")
         title = raw_title.strip().replace('"', '').replace("'", "")
         return {"title": title}
     except Exception as e:
@@ -2292,21 +3144,13 @@ async def preview_quiz(
     if not quiz:
         raise HTTPException(status_code=404, detail="Quiz not found")
 
-    # Load KG once
-    kg_row = db.execute(
-        sql_text(
-            "SELECT node_data, edge_data FROM knowledge_graph "
-            "WHERE course_id=:c AND week=:w"
-        ),
-        {"c": quiz.course_id, "w": quiz.week},
-    ).fetchone()
-    kg_nodes = json.loads(kg_row[0]) if (kg_row and kg_row[0]) else []
-    kg_edges = json.loads(kg_row[1]) if (kg_row and kg_row[1]) else []
+    kg = kg_cache.get(db, quiz.course_id, quiz.week)
+    kg_nodes = kg.by_id if kg else {}
 
     previews = []
 
     for cid in quiz.concept_ids:
-        selected_node = next((n for n in kg_nodes if n["id"] == cid), None)
+        selected_node = kg_nodes.get(cid)
         if not selected_node:
             continue
 
@@ -2381,41 +3225,30 @@ async def generate_quiz_mcqs(quiz_id: str, payload: GenerateQuizMCQsRequest, db:
     num_per_concept = max(3, min(6, -(-max_q // num_concepts)))  # ceiling division
     print(f"[MCQ GEN] {num_concepts} concepts, max_q={max_q} → {num_per_concept} Qs per concept")
 
-    for cid in target_concepts:
-        kg_payload = {
-            "course_id": quiz.course_id,
-            "week": quiz.week,
-            "concept_id": cid,
-            "quiz_id": quiz.id,
-            "num_questions": num_per_concept,
-        }
+    # One LLM call per batch of concepts rather than one per concept
+    generated = await generate_mcqs_kg_batch(
+        quiz.course_id, quiz.week, target_concepts, num_per_concept, db
+    )
 
-        try:
-            gen_resp = await generate_mcqs_kg(kg_payload, db)
-            new_mcqs = gen_resp.get("mcqs", [])
-            print(f"[DEBUG] Generated {len(new_mcqs)} MCQs for concept {cid}")
-            
-            for m in new_mcqs:
-                if not m.get("question") or not m.get("options") or not m.get("answer"):
-                    print(f"[SKIP] Malformed MCQ skipped for concept {cid}")
-                    continue
-                # BUG FIX: pass quiz_id directly in constructor — no hasattr dance
-                new_mcq = MCQ(
-                    id=str(uuid.uuid4()),
-                    quiz_id=quiz.id,
-                    concept_id=cid,
-                    question=m["question"],
-                    options=m["options"],
-                    answer=m["answer"],
-                    difficulty=m.get("difficulty", "Medium"),
-                    bloom_level=m.get("bloom_level", "Remember"),
-                )
-                db.add(new_mcq)
-                count += 1
-        except Exception as e:
-            print(f"[ERROR] Failed to save MCQs for {cid}: {e}")
-            traceback.print_exc()
-            continue
+    for cid in target_concepts:
+        new_mcqs = generated.get(cid, [])
+        print(f"[DEBUG] Generated {len(new_mcqs)} MCQs for concept {cid}")
+        for m in new_mcqs:
+            if not m.get("question") or not m.get("options") or not m.get("answer"):
+                print(f"[SKIP] Malformed MCQ skipped for concept {cid}")
+                continue
+            new_mcq = MCQ(
+                id=str(uuid.uuid4()),
+                quiz_id=quiz.id,
+                concept_id=cid,
+                question=m["question"],
+                options=m["options"],
+                answer=m["answer"],
+                difficulty=m.get("difficulty", "Medium"),
+                bloom_level=m.get("bloom_level", "Remember"),
+            )
+            db.add(new_mcq)
+            count += 1
 
     db.commit()
     print(f"🎉 Quiz {quiz.id} + {count} MCQs SAVED")
@@ -2430,6 +3263,8 @@ async def delete_mcq(mcq_id: str, db: Session = Depends(get_db)):
     if not mcq:
         raise HTTPException(status_code=404, detail="MCQ not found")
     db.delete(mcq)
+    db.flush()
+    mastery.rebuild(db, mcq.quiz_id)  # its answers no longer count
     db.commit()
     return {"status": "deleted", "id": mcq_id}
 
@@ -2445,7 +3280,8 @@ async def regenerate_single_mcq(mcq_id: str, db: Session = Depends(get_db)):
         "course_id": quiz.course_id,
         "week": quiz.week,
         "concept_id": old_mcq.concept_id,
-        "quiz_id": quiz.id
+        "quiz_id": quiz.id,
+        "use_cache": False,  # a cached response would hand back the same question
     }
     
     try:
@@ -2462,6 +3298,8 @@ async def regenerate_single_mcq(mcq_id: str, db: Session = Depends(get_db)):
         old_mcq.answer = best_new["answer"]
         old_mcq.difficulty = best_new.get("difficulty", "Medium")
         old_mcq.bloom_level = best_new.get("bloom_level", "Remember")
+        db.flush()
+        mastery.rebuild(db, old_mcq.quiz_id)  # past answers now count under the new Bloom level
         
         db.commit()
         return {"status": "regenerated", "mcq": {
@@ -2510,15 +3348,6 @@ async def start_student_quiz(
     raw_min_bloom = (settings.min_bloom_level if settings and settings.min_bloom_level else "Remember").strip().title()
     raw_max_bloom = (settings.max_bloom_level if settings and settings.max_bloom_level else "Create").strip().title()
 
-    try:
-        bloom_start = BLOOM_LEVELS.index(raw_min_bloom)
-        bloom_end = BLOOM_LEVELS.index(raw_max_bloom)
-        if bloom_start > bloom_end:
-            bloom_start, bloom_end = bloom_end, bloom_start
-        allowed_blooms = set(BLOOM_LEVELS[bloom_start:bloom_end + 1])
-    except ValueError:
-        allowed_blooms = set(BLOOM_LEVELS)
-
     # --- Adaptive Bloom targeting ---
     # If the frontend sent a recommended_bloom_level (from /api/student/quiz/adaptive-bloom),
     # validate it falls within the instructor-set range and use it to bias selection.
@@ -2534,34 +3363,67 @@ async def start_student_quiz(
         adaptive_target_bloom = BLOOM_LEVELS[clamped_idx]
 
     print(f"[STUDENT QUIZ] Settings: max_q={max_q}, diff={raw_min}-{raw_max}, bloom={raw_min_bloom}-{raw_max_bloom}")
-    print(f"[STUDENT QUIZ] Allowed blooms: {allowed_blooms}, adaptive_target: {adaptive_target_bloom}")
-
-    def get_filtered_mcqs():
-        all_mcqs = db.query(MCQ).filter(MCQ.quiz_id == quiz_id).all()
-        valid = []
-        
-        print(f"[FILTER] Total MCQs in quiz: {len(all_mcqs)}")
-        
-        for m in all_mcqs:
-            # Difficulty filter
-            q_diff_str = (m.difficulty or "Medium").strip()
-            q_val = DIFF_LEVELS.get(q_diff_str.lower(), 2)
-            
-            if not (min_diff_val <= q_val <= max_diff_val):
-                print(f"[FILTER] Rejected MCQ {m.id[:8]} - difficulty {q_diff_str} outside range")
-                continue
+    print(f"[STUDENT QUIZ] Adaptive target: {adaptive_target_bloom}")
+
+    # Instructor range as rank bounds (models.difficulty_rank / bloom_rank).
+    # As before the rank columns: an inverted Bloom range is swapped, while an
+    # inverted difficulty range matches nothing and falls back to the whole bank.
+    if raw_min_bloom in BLOOM_LEVELS and raw_max_bloom in BLOOM_LEVELS:
+        bloom_lo = BLOOM_LEVELS.index(raw_min_bloom) + 1
+        bloom_hi = BLOOM_LEVELS.index(raw_max_bloom) + 1
+        if bloom_lo > bloom_hi:
+            bloom_lo, bloom_hi = bloom_hi, bloom_lo
+    else:
+        bloom_lo, bloom_hi = 1, len(BLOOM_LEVELS)
 
-            # Bloom filter — normalise to Title case to avoid casing mismatches
-            q_bloom = (m.bloom_level or "Remember").strip().title()
-            if q_bloom not in allowed_blooms:
-                print(f"[FILTER] Rejected MCQ {m.id[:8]} - bloom {q_bloom} not in {allowed_blooms}")
-                continue
+    def pick(query, n, exclude=()):
+        """Up to n random rows of query; only those rows are loaded."""
+        if n <= 0:
+            return []
+        if exclude:
+            query = query.filter(~MCQ.id.in_(list(exclude)))
+        return query.order_by(func.random()).limit(n).all()
 
-            print(f"[FILTER] ✅ Accepted MCQ {m.id[:8]} - {q_diff_str}, {q_bloom}")
-            valid.append(m)
-        
-        print(f"[FILTER] Final count: {len(valid)}/{len(all_mcqs)} MCQs passed filters")
-        return valid, all_mcqs
+    def select_questions():
+        """
+        Questions for an attempt, or None if the quiz has none. Filtering is
+        done with range queries on the indexed rank columns. The whole bank is
+        used if nothing matches the instructor's range.
+
+        When adaptive_target_bloom is set:
+          - ~70% of questions come from exactly the target level
+          - remaining ~30% come ONLY from levels BELOW the target
+            (never above — student hasn't earned those yet)
+          - if still short, pad with more target-level questions
+        Once the student masters the target (>=75%) the adaptive-bloom
+        endpoint will move the target up, so higher levels appear naturally.
+        """
+        bank = db.query(MCQ).filter(MCQ.quiz_id == quiz_id)
+        pool = bank.filter(
+            MCQ.difficulty_rank.between(min_diff_val, max_diff_val),
+            MCQ.bloom_rank.between(bloom_lo, bloom_hi),
+        )
+        if not db.query(pool.exists()).scalar():
+            if not db.query(bank.exists()).scalar():
+                return None
+            print(f"[FILTER] No MCQs within the quiz settings, using the whole bank")
+            pool = bank
+
+        if not adaptive_target_bloom:
+            selected = pick(pool, max_q)
+        else:
+            target_rank = BLOOM_LEVELS.index(adaptive_target_bloom) + 1
+            target_level = pool.filter(MCQ.bloom_rank == target_rank)
+            selected = pick(target_level, max(1, int(max_q * 0.7)))
+            target_count = len(selected)
+            selected += pick(pool.filter(MCQ.bloom_rank.between(1, target_rank - 1)), max_q - target_count)
+            below_count = len(selected) - target_count
+            if len(selected) < max_q:
+                selected += pick(target_level, max_q - len(selected), exclude=[m.id for m in selected])
+            print(f"[ADAPTIVE] Target='{adaptive_target_bloom}': {target_count} target + {below_count} below "
+                  f"= {len(selected)} questions (no above-target)")
+        print(f"[FILTER] Selected {len(selected)} MCQs (difficulty {min_diff_val}-{max_diff_val}, bloom {bloom_lo}-{bloom_hi})")
+        return selected
 
     # 2. Find existing attempts for this student+quiz
     attempts_q = db.query(QuizAttempt).filter(
@@ -2605,10 +3467,9 @@ async def start_student_quiz(
             else:
                 print("[RESUME] No stored question IDs, selecting fresh set")
             # Legacy resume: no stored IDs — re-select and save them
-            valid_mcqs, all_mcqs = get_filtered_mcqs()
-            target_pool = valid_mcqs if valid_mcqs else all_mcqs
+            selected_mcqs = select_questions()
 
-            if not target_pool:
+            if selected_mcqs is None:
                 return {
                     "attempt_id": active_attempt.id,
                     "questions": [],
@@ -2620,29 +3481,18 @@ async def start_student_quiz(
                     "retries_left": max(0, allowed_retries - completed_attempts)
                 }
 
-            if adaptive_target_bloom:
-                target_idx = BLOOM_LEVELS.index(adaptive_target_bloom)
-                target_bloom_mcqs = [m for m in target_pool
-                                      if (m.bloom_level or "Remember").strip().title() == adaptive_target_bloom]
-                below_target_mcqs = [m for m in target_pool
-                                      if (m.bloom_level or "Remember").strip().title() in BLOOM_LEVELS[:target_idx]]
-                random.shuffle(target_bloom_mcqs)
-                random.shuffle(below_target_mcqs)
-                target_count = min(len(target_bloom_mcqs), max(1, int(max_q * 0.7)))
-                below_count  = min(len(below_target_mcqs), max_q - target_count)
-                ordered_pool = target_bloom_mcqs[:target_count] + below_target_mcqs[:below_count]
-                if len(ordered_pool) < max_q:
-                    remaining = [m for m in target_bloom_mcqs if m not in ordered_pool]
-                    ordered_pool += remaining[:max_q - len(ordered_pool)]
-                selected_mcqs = ordered_pool[:max_q]
-            else:
-                selected_mcqs = random.sample(target_pool, min(len(target_pool), max_q))
-
             # Save question IDs + bloom target for stable, target-aware resume
-            stored_meta["__question_ids__"] = [m.id for m in selected_mcqs]
-            stored_meta["__bloom_target__"] = adaptive_target_bloom
-            active_attempt.responses = stored_meta
-            db.commit()
+            question_ids = [m.id for m in selected_mcqs]
+
+            def save_selection(wdb):
+                attempt = wdb.get(QuizAttempt, active_attempt.id)
+                attempt.responses = {
+                    **(attempt.responses or {}),
+                    "__question_ids__": question_ids,
+                    "__bloom_target__": adaptive_target_bloom,
+                }
+
+            await db_writer.run(save_selection, release=db)
 
         return {
             "attempt_id": active_attempt.id,
@@ -2668,10 +3518,9 @@ async def start_student_quiz(
         raise HTTPException(status_code=403, detail="No retries remaining")
 
     # 5. Create new attempt with filtering
-    valid_mcqs, all_mcqs = get_filtered_mcqs()
-    target_pool = valid_mcqs if valid_mcqs else all_mcqs
+    selected_mcqs = select_questions()
 
-    if not target_pool:
+    if selected_mcqs is None:
         return {
             "attempt_id": "error",
             "questions": [],
@@ -2679,55 +3528,24 @@ async def start_student_quiz(
             "retries_left": max(0, allowed_retries - completed_attempts)
         }
 
-    # ✅ Apply adaptive Bloom selection
-    # When adaptive_target_bloom is set:
-    #   - ~70% of questions come from exactly the target level
-    #   - remaining ~30% come ONLY from levels AT OR BELOW the target
-    #     (never above — student hasn't earned those yet)
-    # Once the student masters the target (>=75%) the adaptive-bloom
-    # endpoint will move the target up, so higher levels appear naturally.
-    if adaptive_target_bloom:
-        target_idx = BLOOM_LEVELS.index(adaptive_target_bloom)
-
-        # Partition pool by relationship to target (normalise casing)
-        target_bloom_mcqs = [m for m in target_pool
-                             if (m.bloom_level or "Remember").strip().title() == adaptive_target_bloom]
-        below_target_mcqs = [m for m in target_pool
-                             if (m.bloom_level or "Remember").strip().title() in BLOOM_LEVELS[:target_idx]]
-        # Never include questions ABOVE the target level
-        random.shuffle(target_bloom_mcqs)
-        random.shuffle(below_target_mcqs)
-
-        # ~70% from target level, ~30% from below only
-        target_count = min(len(target_bloom_mcqs), max(1, int(max_q * 0.7)))
-        below_count  = min(len(below_target_mcqs), max_q - target_count)
-        ordered_pool = target_bloom_mcqs[:target_count] + below_target_mcqs[:below_count]
-
-        # If still short (not enough questions at/below target), pad with target-level repeats
-        if len(ordered_pool) < max_q:
-            remaining = [m for m in target_bloom_mcqs if m not in ordered_pool]
-            ordered_pool += remaining[:max_q - len(ordered_pool)]
-
-        selected_mcqs = ordered_pool[:max_q]
-        print(f"[ADAPTIVE] Target='{adaptive_target_bloom}': {target_count} target + {below_count} below = {len(selected_mcqs)} questions (no above-target)")
-    else:
-        selected_mcqs = random.sample(target_pool, min(len(target_pool), max_q))
-    
     print(f"[STUDENT QUIZ] Serving {len(selected_mcqs)} questions to student")
 
     attempt_id = str(uuid.uuid4())
-    new_attempt = QuizAttempt(
-        id=attempt_id,
-        quiz_id=quiz_id,
-        student_id=student_id,
-        score=0,
-        total_questions=0,
-        completed=False,
-        # Store question IDs + bloom target so resume can detect if target advanced
-        responses={"__question_ids__": [m.id for m in selected_mcqs], "__bloom_target__": adaptive_target_bloom}
-    )
-    db.add(new_attempt)
-    db.commit()
+    question_ids = [m.id for m in selected_mcqs]
+
+    def create_attempt(wdb):
+        wdb.add(QuizAttempt(
+            id=attempt_id,
+            quiz_id=quiz_id,
+            student_id=student_id,
+            score=0,
+            total_questions=0,
+            completed=False,
+            # Store question IDs + bloom target so resume can detect if target advanced
+            responses={"__question_ids__": question_ids, "__bloom_target__": adaptive_target_bloom}
+        ))
+
+    await db_writer.run(create_attempt, release=db)
 
     return {
         "attempt_id": attempt_id,
@@ -2759,12 +3577,16 @@ async def update_mcq(mcq_id: str, payload: MCQUpdate, db: Session = Depends(get_
     if not mcq:
         raise HTTPException(status_code=404, detail="MCQ not found")
     
+    bloom_changed = payload.bloom_level != mcq.bloom_level
     mcq.question = payload.question
     mcq.options = payload.options
     mcq.answer = payload.answer
     mcq.bloom_level = payload.bloom_level 
     if payload.difficulty:
         mcq.difficulty = payload.difficulty
+    if bloom_changed:
+        db.flush()
+        mastery.rebuild(db, mcq.quiz_id)  # past answers now count under the new Bloom level
         
     db.commit()
     db.refresh(mcq)
@@ -2782,10 +3604,26 @@ async def update_mcq(mcq_id: str, payload: MCQUpdate, db: Session = Depends(get_
     }
 
 
+# One row per (attempt_id, mcq_id): a re-submitted answer updates the existing row.
+# Plain SQL so the statement is compiled once, not per write.
+_RESPONSE_UPSERT = sql_text("""
+    INSERT INTO mcq_responses (attempt_id, mcq_id, question, selected_answer, is_correct)
+    VALUES (:attempt_id, :mcq_id, :question, :selected_answer, :is_correct)
+    ON CONFLICT (attempt_id, mcq_id) DO UPDATE SET
+        selected_answer = excluded.selected_answer,
+        is_correct = excluded.is_correct
+""")
+
+
+def _upsert_responses(db, rows):
+    """Write MCQResponse rows (dicts of the columns above) in one statement."""
+    if rows:
+        db.execute(_RESPONSE_UPSERT, rows)
+
+
 @app.post("/api/student/quiz/submit")
 async def submit_quiz_attempt(payload: dict = Body(...), db: Session = Depends(get_db)):
-    print("SUBMIT payload:", payload)
-
+    started = _time.perf_counter()
     attempt_id = payload.get("attempt_id") or payload.get("attemptId")
     student_id = payload.get("student_id") or payload.get("studentId")
     quiz_id = payload.get("quiz_id") or payload.get("quizId")
@@ -2802,28 +3640,27 @@ async def submit_quiz_attempt(payload: dict = Body(...), db: Session = Depends(g
     if not attempt_id or not student_id or not quiz_id:
         raise HTTPException(status_code=400, detail="Missing required fields")
 
-    attempt = db.query(QuizAttempt).filter(QuizAttempt.id == attempt_id).first()
-    if not attempt:
-        attempt = QuizAttempt(
-            id=attempt_id,
-            quiz_id=quiz_id,
-            student_id=student_id,
-            score=0,
-            total_questions=0,
-            completed=False
-        )
-        db.add(attempt)
-        db.commit()
+    print(f"[SUBMIT] attempt={attempt_id} student={student_id} quiz={quiz_id} responses={len(responses)}")
+
+    # One IN query for every referenced MCQ (only the columns grading needs)
+    mcq_ids = {r["mcq_id"] for r in responses if r["mcq_id"]}
+    mcqs = {}
+    if mcq_ids:
+        mcqs = {
+            row.id: row for row in
+            db.query(MCQ.id, MCQ.answer, MCQ.question).filter(MCQ.id.in_(mcq_ids))
+        }
 
     correct_count = 0
     total = len(responses)
     per_question_results = []
+    rows = {}  # mcq_id -> response row; a repeated question keeps its last answer
 
     for resp in responses:
         mcq_id = resp["mcq_id"]
         selected = resp["selected_answer"]
 
-        mcq = db.query(MCQ).filter(MCQ.id == mcq_id).first()
+        mcq = mcqs.get(mcq_id)
         if not mcq:
             continue
 
@@ -2840,29 +3677,39 @@ async def submit_quiz_attempt(payload: dict = Body(...), db: Session = Depends(g
             "hint": None,
         })
 
-        # ✅ Save/update MCQResponse row (with question)
-        existing_response = db.query(MCQResponse).filter(
-            MCQResponse.attempt_id == attempt_id,
-            MCQResponse.mcq_id == mcq_id
-        ).first()
+        rows[mcq_id] = {
+            "attempt_id": attempt_id,
+            "mcq_id": mcq_id,
+            "question": mcq.question,           # ✅ required field
+            "selected_answer": selected,
+            "is_correct": is_correct,
+        }
 
-        if existing_response:
-            existing_response.selected_answer = selected
-            existing_response.is_correct = is_correct
-        else:
-            new_response = MCQResponse(
-                attempt_id=attempt_id,
-                mcq_id=mcq_id,
-                question=mcq.question,           # ✅ required field
-                selected_answer=selected,
-                is_correct=is_correct
+    def write(wdb):
+        attempt = wdb.get(QuizAttempt, attempt_id)
+        if not attempt:
+            attempt = QuizAttempt(
+                id=attempt_id,
+                quiz_id=quiz_id,
+                student_id=student_id,
+                score=0,
+                total_questions=0,
+                completed=False
             )
-            db.add(new_response)
-
-    attempt.score = correct_count
-    attempt.total_questions = total
-    attempt.completed = True
-    db.commit()
+            wdb.add(attempt)
+        elif attempt.completed:
+            mastery.apply_attempt(wdb, attempt_id, -1)  # re-submitted: its old answers come out first
+        # ✅ Save/update all MCQResponse rows in one statement
+        _upsert_responses(wdb, list(rows.values()))
+        attempt.score = correct_count
+        attempt.total_questions = total
+        attempt.completed = True
+        wdb.flush()
+        mastery.apply_attempt(wdb, attempt_id, +1)
+
+    # attempt row, responses and score land in one (group) commit
+    await db_writer.run(write, release=db)
+    metrics.observe("quiz_submit_seconds", _time.perf_counter() - started)
 
     # ✅ Broadcast to instructor dashboard
     await manager.broadcast(quiz_id, {
@@ -3025,7 +3872,8 @@ async def generate_knowledge_graph(course_id: str, week: int, processing_id: str
             print("[KG SKIP] No segments found.")
             return
 
-        full_text = "\n".join([s.content for s in segments if s.content])[:15000]
+        full_text = pack_blocks([s.content for s in segments if s.content],
+                                budget_for("models/gemini-2.5-flash", "kg_single_pass"), separator="\n")
         file_name = upload_record.file_name if upload_record else "Lecture Topic"
 
         # 2. Call LLM
@@ -3051,7 +3899,7 @@ async def generate_knowledge_graph(course_id: str, week: int, processing_id: str
         {full_text}
         """
 
-        raw_resp = gemini_generate("models/gemini-2.5-flash", prompt)
+        raw_resp = await gemini_generate_async("models/gemini-2.5-flash", prompt, call_site="kg_single_pass")
         # robust json cleaning
         cleaned_text = raw_resp.replace("```json", "").replace("```", "").strip()
         data = json.loads(cleaned_text)
@@ -3115,7 +3963,7 @@ async def generate_knowledge_graph(course_id: str, week: int, processing_id: str
 def get_student_performance(student_id: str, course_id: str, db: Session = Depends(get_db)):
     # Fetch all completed attempts for this student in the given course
     attempts = (
-        db.query(QuizAttempt)
+        db.query(QuizAttempt, Quiz)
         .join(Quiz, Quiz.id == QuizAttempt.quiz_id)
         .filter(
             QuizAttempt.student_id == student_id,
@@ -3136,8 +3984,7 @@ def get_student_performance(student_id: str, course_id: str, db: Session = Depen
 
     score_pcts = []
 
-    for attempt in attempts:
-        quiz = db.query(Quiz).filter(Quiz.id == attempt.quiz_id).first()
+    for attempt, quiz in attempts:
         quiz_name = quiz.title if quiz and hasattr(quiz, "title") else str(attempt.quiz_id)
 
         total = attempt.total_questions if attempt.total_questions else 0
@@ -3161,31 +4008,16 @@ def get_student_performance(student_id: str, course_id: str, db: Session = Depen
             "week": week_num,
         })
 
-        # Aggregate bloom and concept data from MCQResponses
-        responses = (
-            db.query(MCQResponse)
-            .filter(MCQResponse.attempt_id == attempt.id)
-            .all()
-        )
-
-        for resp in responses:
-            mcq = db.query(MCQ).filter(MCQ.id == resp.mcq_id).first()
-            if not mcq:
-                continue
-
-            bloom = mcq.bloom_level
-            concept = str(mcq.concept_id) if mcq.concept_id else "unknown"
+    # Bloom and concept data: one indexed read of the mastery rollup (mastery.py)
+    for concept, bloom, correct, total in mastery.by_concept_and_bloom(db, student_id, course_id):
+        if bloom in bloom_breakdown:
+            bloom_breakdown[bloom]["total"] += total
+            bloom_breakdown[bloom]["correct"] += correct
 
-            if bloom in bloom_breakdown:
-                bloom_breakdown[bloom]["total"] += 1
-                if resp.is_correct:
-                    bloom_breakdown[bloom]["correct"] += 1
-
-            if concept not in concept_map:
-                concept_map[concept] = {"correct": 0, "total": 0}
-            concept_map[concept]["total"] += 1
-            if resp.is_correct:
-                concept_map[concept]["correct"] += 1
+        if concept not in concept_map:
+            concept_map[concept] = {"correct": 0, "total": 0}
+        concept_map[concept]["total"] += total
+        concept_map[concept]["correct"] += correct
 
     # Compute overall score pct
     if score_pcts:
@@ -3248,35 +4080,12 @@ def get_adaptive_bloom(student_id: str, quiz_id: str, db: Session = Depends(get_
     max_idx = bloom_levels.index(max_bloom) if max_bloom in bloom_levels else len(bloom_levels) - 1
     allowed_levels = bloom_levels[min_idx: max_idx + 1]
 
-    # Fetch all completed attempts for this student + quiz
-    attempts = (
-        db.query(QuizAttempt)
-        .filter(
-            QuizAttempt.student_id == student_id,
-            QuizAttempt.quiz_id == quiz_id,
-            QuizAttempt.completed == True,
-        )
-        .all()
-    )
-
-    # Aggregate per-bloom accuracy
-    bloom_performance = {lvl: {"correct": 0, "total": 0, "pct": 0.0} for lvl in bloom_levels}
-
-    for attempt in attempts:
-        responses = (
-            db.query(MCQResponse)
-            .filter(MCQResponse.attempt_id == attempt.id)
-            .all()
-        )
-        for resp in responses:
-            mcq = db.query(MCQ).filter(MCQ.id == resp.mcq_id).first()
-            if not mcq:
-                continue
-            bloom = (mcq.bloom_level or "Remember").strip().title()
-            if bloom in bloom_performance:
-                bloom_performance[bloom]["total"] += 1
-                if resp.is_correct:
-                    bloom_performance[bloom]["correct"] += 1
+    # Per-bloom accuracy over completed attempts, from the mastery rollup (mastery.py)
+    counts = mastery.by_bloom(db, student_id, quiz_id)
+    bloom_performance = {}
+    for lvl in bloom_levels:
+        correct, total = counts.get(lvl, (0, 0))
+        bloom_performance[lvl] = {"correct": correct, "total": total, "pct": 0.0}
 
     for lvl in bloom_levels:
         t = bloom_performance[lvl]["total"]
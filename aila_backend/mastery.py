@@ -0,0 +1,107 @@
+# aila_backend/mastery.py
+"""
+Per-student mastery rollup (student_mastery).
+
+/api/student/performance and /api/student/quiz/adaptive-bloom used to
+rebuild mastery on every call: every completed attempt, then its
+MCQResponse rows, then one MCQ lookup per response. Now the counts are kept
+in student_mastery, one row per (student, course, quiz, concept, Bloom
+level) with correct / total. Both endpoints read them with one indexed
+GROUP BY. Quiz is part of the key because adaptive-bloom works per quiz and
+performance per course.
+
+Only answers in completed attempts count, as before. The writes that change
+them keep the table in step inside their own transaction:
+
+    apply_attempt(db, attempt_id, -1)   # before changing a completed attempt's answers
+    ...                                 # write responses, mark completed, db.flush()
+    apply_attempt(db, attempt_id, +1)   # add the attempt back as it is now
+    rebuild(db, quiz_id)                # an MCQ's Bloom level / concept changed, or it was deleted
+
+Both are single INSERT ... SELECT ... ON CONFLICT statements; the caller
+commits. Data from before the table existed is copied in by backfill() at
+startup.
+
+Bloom levels are read from mcq.bloom_rank, so they are normalised the way
+quiz start filters them. Missing levels count as Remember. Unrecognised ones
+are kept as written, and neither endpoint lists them.
+"""
+from sqlalchemy import func
+from sqlalchemy import text as sql_text
+
+from aila_backend.database import engine
+from aila_backend.models import BLOOM_RANKS, StudentMastery
+
+
+_BLOOM_NAME = "CASE m.bloom_rank {} ELSE COALESCE(m.bloom_level, 'Remember') END".format(
+    " ".join(f"WHEN {rank} THEN '{name}'" for name, rank in BLOOM_RANKS.items())
+)
+
+# Counts of completed attempts' answers, grouped by the table's key; {where} narrows the attempts
+_ROLLUP = """
+    INSERT INTO student_mastery (student_id, course_id, quiz_id, concept_id, bloom_level, correct, total)
+    SELECT COALESCE(a.student_id, ''), COALESCE(q.course_id, ''), COALESCE(a.quiz_id, ''),
+           COALESCE(NULLIF(m.concept_id, ''), 'unknown'), """ + _BLOOM_NAME + """,
+           :sign * SUM(CASE WHEN r.is_correct THEN 1 ELSE 0 END), :sign * COUNT(*)
+    FROM mcq_responses r
+    JOIN quiz_attempts a ON a.id = r.attempt_id
+    JOIN mcq m ON m.id = r.mcq_id
+    LEFT JOIN quizzes q ON q.id = a.quiz_id
+    WHERE a.completed = 1 AND {where}
+    GROUP BY 1, 2, 3, 4, 5
+    ON CONFLICT (student_id, course_id, quiz_id, concept_id, bloom_level) DO UPDATE SET
+        correct = correct + excluded.correct,
+        total = total + excluded.total
+"""
+_APPLY_ATTEMPT = sql_text(_ROLLUP.format(where="r.attempt_id = :attempt_id"))
+_REBUILD_QUIZ = sql_text(_ROLLUP.format(where="a.quiz_id = :quiz_id"))
+_BACKFILL = sql_text(_ROLLUP.format(where="NOT EXISTS (SELECT 1 FROM student_mastery)"))
+
+
+def apply_attempt(db, attempt_id, sign: int = 1):
+    """Add (+1) or take out (-1) a completed attempt's answers. No-op if it isn't completed."""
+    db.execute(_APPLY_ATTEMPT, {"attempt_id": attempt_id, "sign": sign})
+
+
+def rebuild(db, quiz_id):
+    """Recount one quiz from its responses."""
+    db.query(StudentMastery).filter(StudentMastery.quiz_id == quiz_id).delete(synchronize_session=False)
+    db.execute(_REBUILD_QUIZ, {"quiz_id": quiz_id, "sign": 1})
+
+
+def delete_quiz(db, quiz_id):
+    db.query(StudentMastery).filter(StudentMastery.quiz_id == quiz_id).delete(synchronize_session=False)
+
+
+def by_concept_and_bloom(db, student_id, course_id):
+    """[(concept_id, bloom_level, correct, total)] over a course's quizzes."""
+    return db.query(
+        StudentMastery.concept_id, StudentMastery.bloom_level,
+        func.sum(StudentMastery.correct), func.sum(StudentMastery.total)
+    ).filter(
+        StudentMastery.student_id == student_id, StudentMastery.course_id == course_id
+    ).group_by(StudentMastery.concept_id, StudentMastery.bloom_level) \
+        .having(func.sum(StudentMastery.total) > 0).all()
+
+
+def by_bloom(db, student_id, quiz_id) -> dict:
+    """{bloom_level: (correct, total)} for one quiz."""
+    rows = db.query(
+        StudentMastery.bloom_level, func.sum(StudentMastery.correct), func.sum(StudentMastery.total)
+    ).filter(
+        StudentMastery.student_id == student_id, StudentMastery.quiz_id == quiz_id
+    ).group_by(StudentMastery.bloom_level).having(func.sum(StudentMastery.total) > 0).all()
+    return {bloom: (correct, total) for bloom, correct, total in rows}
+
+
+def backfill() -> int:
+    """
+    Fill an empty student_mastery from existing responses. A single
+    statement that does nothing once the table has rows, so concurrent
+    startups can't count anything twice. Returns rows written.
+    """
+    with engine.begin() as conn:
+        written = conn.execute(_BACKFILL, {"sign": 1}).rowcount
+    if written and written > 0:
+        print(f"[DB] Backfilled {written} student_mastery row(s)")
+    return written
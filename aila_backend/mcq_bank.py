@@ -0,0 +1,157 @@
+# aila_backend/mcq_bank.py
+"""
+Warm question bank for adaptive quizzes.
+
+get_next_mcq_gemini used to call the LLM inline when the concept it picked
+had no unanswered questions left, and the student waited for it. Now the
+serve path only reads the bank (the quiz's `mcq` rows). After every serve,
+the replenisher checks the served concept: every (bloom, difficulty) bucket
+the quiz settings allow should keep LOW_WATER questions this attempt hasn't
+answered. If one doesn't, and the concept has fewer than MAX_DEPTH unused
+questions overall, a top-up runs in the background:
+
+    replenisher = BankReplenisher(fill_fn)     # fill_fn(quiz_id, concept_ids, urgent) -> {concept_id: saved}
+    replenisher.after_serve(db, quiz_id, concept_id, answered_ids, buckets)
+    replenisher.schedule(quiz_id, concept_ids, urgent=True)   # bank ran dry: top up now
+
+One generation call stocks several buckets at once (the prompt asks for a
+mix of levels), so concepts rather than single buckets are topped up. A
+concept is topped up at most once every COOLDOWN seconds unless urgent.
+Failures back off whether urgent or not: the n-th failed top-up in a row
+blocks the next for COOLDOWN * 2**(n-1) seconds. After MAX_FAILURES it counts
+as exhausted, and is tried again only once every MAX_BACKOFF seconds.
+
+Metrics: mcq_bank_depth{quiz,concept} (gauge, questions in the bank),
+mcq_bank_unused_at_serve (histogram), mcq_bank_stalls_total{reason} and
+mcq_bank_topups_total{outcome}.
+"""
+import asyncio
+import os
+import time
+from collections import Counter, defaultdict
+
+from sqlalchemy import func
+
+from aila_backend.metrics import metrics, COUNT_BUCKETS
+from aila_backend.models import MCQ
+
+
+LOW_WATER    = int(os.environ.get("AILA_MCQ_BANK_LOW_WATER", 1))   # unused per allowed (bloom, difficulty)
+MAX_DEPTH    = int(os.environ.get("AILA_MCQ_BANK_MAX_DEPTH", 12))  # never top up a concept past this many unused
+TOPUP_SIZE   = int(os.environ.get("AILA_MCQ_BANK_TOPUP", 6))       # questions asked for per top-up
+COOLDOWN     = 20.0
+MAX_FAILURES = 3
+MAX_BACKOFF  = 300.0
+
+
+def bank_depth(db, quiz_id, exclude_ids=()) -> dict:
+    """{concept_id: Counter{(bloom_level, difficulty): n}} of the quiz's questions not in exclude_ids."""
+    query = db.query(MCQ.concept_id, MCQ.bloom_level, MCQ.difficulty, func.count(MCQ.id)) \
+        .filter(MCQ.quiz_id == quiz_id)
+    exclude_ids = list(exclude_ids)
+    if exclude_ids:
+        query = query.filter(~MCQ.id.in_(exclude_ids))
+    depth = defaultdict(Counter)
+    for concept_id, bloom, difficulty, n in query.group_by(MCQ.concept_id, MCQ.bloom_level, MCQ.difficulty):
+        depth[concept_id][(bloom, difficulty)] = n
+    return depth
+
+
+def needs_topup(counts: Counter, buckets) -> bool:
+    """True if an allowed bucket is below the low-water mark and the concept isn't already deep."""
+    if sum(counts.values()) >= MAX_DEPTH:
+        return False
+    return any(counts.get(bucket, 0) < LOW_WATER for bucket in buckets)
+
+
+class BankReplenisher:
+    def __init__(self, fill_fn):
+        self.fill_fn = fill_fn
+        self._inflight = set()                # (quiz_id, concept_id)
+        self._last_fill = {}                  # (quiz_id, concept_id) -> monotonic time
+        self._failures = Counter()            # (quiz_id, concept_id) -> failed top-ups in a row
+        self._tasks = set()                   # keeps running tasks referenced
+
+    def _backoff(self, key) -> float:
+        """Seconds a concept must wait after its last top-up started (0 if the last one succeeded)."""
+        failures = self._failures[key]
+        if not failures:
+            return 0.0
+        if failures >= MAX_FAILURES:
+            return MAX_BACKOFF
+        return min(COOLDOWN * 2 ** (failures - 1), MAX_BACKOFF)
+
+    def _waiting(self, key, now) -> bool:
+        return now - self._last_fill.get(key, float("-inf")) < self._backoff(key)
+
+    def exhausted(self, quiz_id, concept_ids) -> bool:
+        """
+        True if every concept's recent top-ups failed and none is due another
+        try — waiting for the bank is pointless.
+        """
+        now = time.monotonic()
+        return bool(concept_ids) and all(
+            self._failures[(quiz_id, c)] >= MAX_FAILURES and self._waiting((quiz_id, c), now)
+            for c in concept_ids
+        )
+
+    def busy(self, quiz_id, concept_ids) -> bool:
+        return any((quiz_id, c) in self._inflight for c in concept_ids)
+
+    def publish_depth(self, db, quiz_id):
+        for concept_id, counts in bank_depth(db, quiz_id).items():
+            metrics.set("mcq_bank_depth", sum(counts.values()), quiz=quiz_id, concept=concept_id)
+
+    def after_serve(self, db, quiz_id, concept_id, answered_ids, buckets):
+        """Check the served concept against the low-water mark; top it up in the background if needed."""
+        counts = bank_depth(db, quiz_id, answered_ids).get(concept_id, Counter())
+        metrics.observe("mcq_bank_unused_at_serve", sum(counts.values()), buckets=COUNT_BUCKETS)
+        if needs_topup(counts, buckets):
+            self.schedule(quiz_id, [concept_id])
+
+    def schedule(self, quiz_id, concept_ids, urgent: bool = False) -> int:
+        """Start a background top-up for the concepts that aren't already being filled. Returns how many."""
+        now = time.monotonic()
+        todo = []
+        for concept_id in concept_ids:
+            key = (quiz_id, concept_id)
+            if key in self._inflight:
+                continue
+            if self._waiting(key, now):
+                continue  # backing off after failures; urgent doesn't override this
+            if not urgent and now - self._last_fill.get(key, -COOLDOWN) < COOLDOWN:
+                continue
+            todo.append(concept_id)
+        if not todo:
+            return 0
+        for concept_id in todo:
+            self._inflight.add((quiz_id, concept_id))
+            self._last_fill[(quiz_id, concept_id)] = now
+        task = asyncio.get_running_loop().create_task(self._run(quiz_id, todo, urgent))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return len(todo)
+
+    async def _run(self, quiz_id, concept_ids, urgent):
+        started = time.perf_counter()
+        try:
+            saved = await self.fill_fn(quiz_id, concept_ids, urgent) or {}
+        except Exception as e:
+            print(f"[MCQ BANK] Top-up of {len(concept_ids)} concept(s) in quiz {quiz_id} failed: {e}")
+            saved = {}
+        finally:
+            for concept_id in concept_ids:
+                self._inflight.discard((quiz_id, concept_id))
+        for concept_id in concept_ids:
+            key = (quiz_id, concept_id)
+            if saved.get(concept_id):
+                self._failures.pop(key, None)
+                metrics.inc("mcq_bank_topups_total", outcome="filled")
+            else:
+                self._failures[key] += 1
+                metrics.inc("mcq_bank_topups_total", outcome="failed")
+        metrics.observe("mcq_bank_topup_seconds", time.perf_counter() - started)
+        if any(saved.get(c) for c in concept_ids):
+            print(f"[MCQ BANK] Topped up quiz {quiz_id}: "
+                  f"{sum(saved.values())} question(s) for {len(concept_ids)} concept(s) "
+                  f"in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,163 @@
+# aila_backend/merge_scheduler.py
+"""
+Debounced, serialised master-graph merges per (course, week).
+
+Every finished lecture used to re-merge its week's master graph straight
+away. Ten decks uploaded together meant ten full merges racing to UPDATE the
+same row. Now a finished lecture calls:
+
+    seq = request_merge(course_id, week)          # after its file graph is committed
+    run_when_due(course_id, week, seq, merge_fn)  # merge, or return once someone else has
+
+run_when_due waits for DEBOUNCE seconds without new requests for that week,
+then takes a lease on the week's master_merge_requests row (a conditional
+UPDATE, like the job queue's claim). That works across worker processes.
+While merging, a heartbeat thread keeps extending the lease, so a merge
+that runs longer than LOCK_TTL isn't taken over; only a crashed merger's
+lease expires.
+The lease holder reads the latest requested_seq *before* loading file graphs,
+so its merge covers every request up to that number. Anyone whose seq is
+covered returns without merging. A burst of uploads ends in one merge. The
+week's master row is replaced in a single UPDATE that bumps its version, so
+readers see either the old graph or the new one.
+"""
+import os
+import threading
+import time
+import uuid
+
+from sqlalchemy import text as sql_text
+
+from aila_backend.database import SessionLocal
+
+
+DEBOUNCE      = float(os.environ.get("AILA_MERGE_DEBOUNCE", 1.5))  # quiet period before merging
+MAX_DEBOUNCE  = 10.0   # a constant trickle of requests can't postpone a merge longer than this
+LOCK_TTL      = 120.0  # lease on a week's merge, renewed every LOCK_TTL / 3 while merging
+MAX_WAIT      = 600.0  # give up (the job fails and retries) if no merge covers us by then
+POLL_INTERVAL = 0.2
+
+
+def request_merge(course_id: str, week: int) -> int:
+    """Record that the week's file graphs changed. Returns this request's sequence number."""
+    db = SessionLocal()
+    try:
+        db.execute(
+            sql_text("""
+                INSERT INTO master_merge_requests (course_id, week, requested_seq, merged_seq, requested_at)
+                VALUES (:c, :w, 1, 0, :now)
+                ON CONFLICT (course_id, week) DO UPDATE
+                SET requested_seq = requested_seq + 1, requested_at = excluded.requested_at
+            """),
+            {"c": course_id, "w": week, "now": time.time()}
+        )
+        seq = db.execute(
+            sql_text("SELECT requested_seq FROM master_merge_requests WHERE course_id=:c AND week=:w"),
+            {"c": course_id, "w": week}
+        ).scalar()
+        db.commit()
+        return seq
+    finally:
+        db.close()
+
+
+def _row(db, course_id, week):
+    return db.execute(
+        sql_text("""
+            SELECT requested_seq, merged_seq, requested_at FROM master_merge_requests
+            WHERE course_id=:c AND week=:w
+        """),
+        {"c": course_id, "w": week}
+    ).fetchone()
+
+
+def _renew_lease(course_id, week, owner, stop: threading.Event):
+    while not stop.wait(LOCK_TTL / 3):
+        db = SessionLocal()
+        try:
+            held = db.execute(
+                sql_text("""
+                    UPDATE master_merge_requests SET lock_expires_at=:exp
+                    WHERE course_id=:c AND week=:w AND lock_owner=:o
+                """),
+                {"exp": time.time() + LOCK_TTL, "c": course_id, "w": week, "o": owner}
+            ).rowcount
+            db.commit()
+        except Exception as e:  # DB busy — the lease still has 2/3 of its TTL left
+            print(f"[MERGE] lease renewal for {course_id}/week {week} failed: {e}")
+            continue
+        finally:
+            db.close()
+        if not held:
+            print(f"[MERGE] {owner} lost the lease on {course_id}/week {week}")
+            return
+
+
+def run_when_due(course_id: str, week: int, seq: int, merge_fn, owner: str = None):
+    """
+    Make sure a merge covering request `seq` happens. merge_fn(db) performs
+    the merge and returns a stats dict. Returns that dict if this caller
+    merged, or None if another caller's merge covered `seq`.
+    """
+    owner = owner or f"merge-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    started = time.time()
+    db = SessionLocal()
+    try:
+        while True:
+            now = time.time()
+            if now - started > MAX_WAIT:
+                raise TimeoutError(f"Master merge for {course_id}/week {week} not done after {MAX_WAIT:.0f}s")
+            requested_seq, merged_seq, requested_at = _row(db, course_id, week)
+            db.commit()  # end the read transaction so the next poll sees other processes' writes
+            if merged_seq >= seq:
+                return None
+            quiet_for = now - (requested_at or 0)
+            if quiet_for < DEBOUNCE and now - started < MAX_DEBOUNCE:
+                time.sleep(min(DEBOUNCE - quiet_for, POLL_INTERVAL * 2))
+                continue
+
+            won = db.execute(
+                sql_text("""
+                    UPDATE master_merge_requests SET lock_owner=:o, lock_expires_at=:exp
+                    WHERE course_id=:c AND week=:w AND (lock_owner IS NULL OR lock_expires_at < :now)
+                """),
+                {"o": owner, "exp": now + LOCK_TTL, "c": course_id, "w": week, "now": now}
+            ).rowcount
+            db.commit()
+            if not won:
+                time.sleep(POLL_INTERVAL)  # someone is merging; their merge may cover us
+                continue
+
+            stop = threading.Event()
+            threading.Thread(target=_renew_lease, args=(course_id, week, owner, stop),
+                             name=f"merge-lease-{week}", daemon=True).start()
+            try:
+                target, merged_seq, _ = _row(db, course_id, week)
+                db.commit()
+                if merged_seq >= seq:
+                    return None
+                stats = merge_fn(db) or {}
+                db.execute(
+                    sql_text("""
+                        UPDATE master_merge_requests
+                        SET merged_seq = MAX(merged_seq, :t), merged_at = :now
+                        WHERE course_id=:c AND week=:w
+                    """),
+                    {"t": target, "now": time.time(), "c": course_id, "w": week}
+                )
+                db.commit()
+                stats.update({"covered_requests": target - merged_seq, "waited": round(time.time() - started, 3)})
+                return stats
+            finally:
+                stop.set()
+                db.rollback()
+                db.execute(
+                    sql_text("""
+                        UPDATE master_merge_requests SET lock_owner=NULL, lock_expires_at=NULL
+                        WHERE course_id=:c AND week=:w AND lock_owner=:o
+                    """),
+                    {"c": course_id, "w": week, "o": owner}
+                )
+                db.commit()
+    finally:
+        db.close()
@@ -0,0 +1,191 @@
+# aila_backend/metrics.py
+"""
+In-process counters, gauges and histograms, served as JSON from /api/metrics.
+
+Series are identified by a name plus labels, e.g.
+    metrics.observe("llm_latency_seconds", 2.4, call_site="pass2_subtopic", model="models/gemini-2.5-flash")
+    metrics.inc("llm_fallback_switches_total", model="models/gemini-2.5-flash")
+    metrics.set("mcq_bank_depth", 14, quiz="q1", concept="stacks")   # gauge: last value wins
+
+Histograms keep cumulative fixed buckets (Prometheus-style) plus count, sum,
+min and max; p50/p95/p99 are estimated from the buckets. Nothing is
+persisted — values reset on restart, which is fine for answering "where is
+the time going right now".
+
+Each process has its own registry. export() / Metrics.merged() let
+metrics_share.py publish worker processes' registries and serve them merged
+with the web server's.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+SIZE_BUCKETS    = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+COUNT_BUCKETS   = (0, 1, 2, 3, 5, 10)
+
+
+def _series(name: str, labels: dict) -> str:
+    if not labels:
+        return name
+    inner = ",".join(f"{k}={labels[k]}" for k in sorted(labels))
+    return f"{name}{{{inner}}}"
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def state(self) -> dict:
+        return {"bounds": list(self.bounds), "counts": list(self.counts), "count": self.count,
+                "sum": self.sum, "min": self.min, "max": self.max}
+
+    def merge(self, state: dict):
+        """Add another histogram's state() into this one. Bucket bounds must match."""
+        if tuple(state["bounds"]) != self.bounds:
+            return
+        self.counts = [a + b for a, b in zip(self.counts, state["counts"])]
+        self.count += state["count"]
+        self.sum += state["sum"]
+        for attr, pick in (("min", min), ("max", max)):
+            theirs, ours = state[attr], getattr(self, attr)
+            if theirs is not None:
+                setattr(self, attr, theirs if ours is None else pick(ours, theirs))
+
+    def quantile(self, q: float):
+        """Upper bound of the bucket holding the q-th observation (max for +Inf)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        cumulative, running = {}, 0
+        for bound, c in zip(self.bounds, self.counts):
+            running += c
+            cumulative[str(bound)] = running
+        cumulative["+Inf"] = self.count
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 4),
+            "avg": round(self.sum / self.count, 4) if self.count else None,
+            "min": round(self.min, 4) if self.min is not None else None,
+            "max": round(self.max, 4) if self.max is not None else None,
+            "p50": self.quantile(0.50),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": cumulative,
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _series(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        key = _series(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, value: float, buckets=LATENCY_BUCKETS, **labels):
+        key = _series(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram(buckets)
+            hist.observe(value)
+
+    @contextmanager
+    def timed(self, name: str, **labels):
+        """Observe the wall time of the block, in seconds, even if it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self, prefix: str = None) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {k: h.snapshot() for k, h in self._histograms.items()}
+        if prefix:
+            counters = {k: v for k, v in counters.items() if k.startswith(prefix)}
+            gauges = {k: v for k, v in gauges.items() if k.startswith(prefix)}
+            histograms = {k: v for k, v in histograms.items() if k.startswith(prefix)}
+        return {
+            "uptime_s": round(time.time() - self.started_at, 1),
+            "counters": dict(sorted(counters.items())),
+            "gauges": dict(sorted(gauges.items())),
+            "histograms": dict(sorted(histograms.items())),
+        }
+
+    def export(self) -> dict:
+        """Raw state for merging into another process's registry."""
+        with self._lock:
+            return {
+                "started_at": self.started_at,
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "histograms": {k: h.state() for k, h in self._histograms.items()},
+            }
+
+    @classmethod
+    def merged(cls, states) -> "Metrics":
+        """
+        One registry from several export()s, oldest first: counters and
+        histograms add up, the last state's value wins for gauges.
+        """
+        out = cls()
+        for state in states:
+            out.started_at = min(out.started_at, state["started_at"])
+            for k, v in state["counters"].items():
+                out._counters[k] = out._counters.get(k, 0) + v
+            out._gauges.update(state["gauges"])
+            for k, h in state["histograms"].items():
+                if k not in out._histograms:
+                    out._histograms[k] = Histogram(h["bounds"])
+                out._histograms[k].merge(h)
+        return out
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+            self.started_at = time.time()
+
+
+metrics = Metrics()
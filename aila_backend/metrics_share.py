@@ -0,0 +1,130 @@
+# aila_backend/metrics_share.py
+"""
+Metrics and prompt_log from every process, for /api/metrics and
+/api/llm/prompt-stats.
+
+metrics.py and prompt_builder.prompt_log live in process memory, and the
+lecture pipeline runs in worker.py's processes. So pass1/pass2 LLM metrics,
+lecture_stage_seconds and the pipeline's prompt samples never reached the
+web server. Now every process publishes its registry and prompt samples
+every PUBLISH_INTERVAL seconds, and once more when it stops. Each process
+has one row in a small SQLite file (AILA_METRICS_SHARE_PATH):
+
+    start_publishing("worker")        # worker.py, per process
+    metrics_share.merged(prefix)      # /api/metrics: own live values + every other process's row
+    metrics_share.merged_prompt_log() # /api/llm/prompt-stats
+
+Rows from processes that stopped publishing more than ROW_TTL seconds ago
+are dropped, so a restarted worker's old counts fall out after a while
+instead of adding up for ever. Worker values are up to PUBLISH_INTERVAL old.
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from aila_backend.metrics import metrics, Metrics
+from aila_backend.prompt_builder import prompt_log, PromptLog
+
+
+SHARE_PATH       = os.environ.get("AILA_METRICS_SHARE_PATH", "db/metrics_share.sqlite3")
+PUBLISH_INTERVAL = float(os.environ.get("AILA_METRICS_PUBLISH_INTERVAL", 10))
+ROW_TTL          = float(os.environ.get("AILA_METRICS_ROW_TTL", 3600))
+
+PROCESS_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class MetricsShare:
+    def __init__(self, path: str = SHARE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._ready:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5)
+        if not self._ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS process_metrics (
+                    process_id   TEXT PRIMARY KEY,
+                    role         TEXT NOT NULL,
+                    published_at REAL NOT NULL,
+                    metrics      TEXT NOT NULL,
+                    prompt_log   TEXT NOT NULL
+                )
+            """)
+            conn.commit()
+            self._ready = True
+        return conn
+
+    def publish(self, role: str):
+        """Write this process's current metrics and prompt samples to its row."""
+        state = json.dumps(metrics.export())
+        samples = json.dumps(prompt_log.recent(prompt_log.maxlen))
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO process_metrics VALUES (?, ?, ?, ?, ?)",
+                    (PROCESS_ID, role, time.time(), state, samples),
+                )
+                conn.execute("DELETE FROM process_metrics WHERE published_at < ?", (time.time() - ROW_TTL,))
+                conn.commit()
+            finally:
+                conn.close()
+
+    def _others(self) -> list:
+        with self._lock:
+            conn = self._connect()
+            try:
+                return conn.execute(
+                    "SELECT process_id, role, published_at, metrics, prompt_log FROM process_metrics "
+                    "WHERE process_id != ? AND published_at >= ? ORDER BY published_at",
+                    (PROCESS_ID, time.time() - ROW_TTL),
+                ).fetchall()
+            finally:
+                conn.close()
+
+    def merged(self, prefix: str = None) -> dict:
+        """metrics.snapshot() over this process and every process that published recently."""
+        rows = self._others()
+        snapshot = Metrics.merged([json.loads(r[3]) for r in rows] + [metrics.export()]).snapshot(prefix)
+        snapshot["processes"] = [{"process_id": PROCESS_ID, "role": "serving", "age_s": 0.0}] + [
+            {"process_id": r[0], "role": r[1], "age_s": round(time.time() - r[2], 1)} for r in rows
+        ]
+        return snapshot
+
+    def merged_prompt_log(self) -> PromptLog:
+        """prompt_log with every other process's published samples added, newest last."""
+        merged = PromptLog(maxlen=prompt_log.maxlen * 4)
+        merged.extend(prompt_log.recent(prompt_log.maxlen))
+        for row in self._others():
+            merged.extend(json.loads(row[4]))
+        return merged
+
+
+metrics_share = MetricsShare()
+
+
+def start_publishing(role: str, stop_event: threading.Event = None,
+                     interval: float = PUBLISH_INTERVAL) -> threading.Thread:
+    """Publish every ``interval`` seconds on a daemon thread, and once more when stop_event is set."""
+    stop_event = stop_event or threading.Event()
+
+    def _loop():
+        while True:
+            stopping = stop_event.wait(interval)
+            try:
+                metrics_share.publish(role)
+            except Exception as e:  # share file locked or unwritable: metrics are best-effort
+                print(f"[METRICS] publish failed: {e}")
+            if stopping:
+                return
+
+    t = threading.Thread(target=_loop, name="metrics-publisher", daemon=True)
+    t.start()
+    return t
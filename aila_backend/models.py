@@ -10,7 +10,7 @@ from sqlalchemy import (
     ForeignKey,
     JSON,
 )
-from sqlalchemy import Column, String, Integer, Boolean, DateTime, Text, JSON, func, Index, PrimaryKeyConstraint
+from sqlalchemy import Column, String, Integer, Boolean, DateTime, Text, JSON, Float, func, Index, PrimaryKeyConstraint, event
 from sqlalchemy.orm import relationship, declarative_base, sessionmaker
 from sqlalchemy.dialects.sqlite import DATETIME
 from sqlalchemy.sql import func
@@ -78,6 +78,34 @@ class LectureProcessing(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
+    # Job-queue bookkeeping — this table is the lecture queue's status view
+    # (see job_queue.py). Times are epoch seconds.
+    file_path = Column(String, nullable=True)
+    upload_id = Column(String, nullable=True)
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=3)
+    available_at = Column(Float, nullable=True)      # not claimable before this (retry backoff)
+    claimed_at = Column(Float, nullable=True)        # last claim, drives per-course round-robin
+    lease_expires_at = Column(Float, nullable=True)  # visibility timeout of the current claim
+    worker_id = Column(String, nullable=True)
+    backend_job_id = Column(String, nullable=True)   # rq job id when the Redis backend is used
+    stats = Column(JSON, nullable=True)              # per-stage pipeline stats (e.g. extraction pages/sec)
+    content_hash = Column(String, nullable=True, index=True)  # sha256 of the uploaded file (upload_store.py)
+
+    __table_args__ = (
+        Index("ix_lecture_processing_queue", "status", "available_at"),
+    )
+
+
+class ProcessingEvent(Base):
+    """Progress events of lecture jobs, relayed to SSE/WebSocket clients (progress_bus.py)."""
+    __tablename__ = "processing_events"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)  # relay cursor
+    processing_id = Column(String, index=True)
+    payload = Column(JSON)
+    created_at = Column(Float)  # epoch seconds, for pruning
+
 
 class Segment(Base):
     __tablename__ = "segments"
@@ -93,6 +121,28 @@ class Segment(Base):
     summary = Column(Text, nullable=True)
 
 
+class LectureVersion(Base):
+    """
+    Per-slide fingerprints and LLM output of the latest processed version of
+    a lecture file (course, week, file_name). A re-upload of the same file is
+    diffed against it so only sub-topics on changed slides are re-expanded.
+    """
+    __tablename__ = "lecture_versions"
+
+    id = Column(String, primary_key=True)            # processing id of that upload
+    course_id = Column(String, index=True)
+    week = Column(Integer)
+    file_name = Column(String)
+    slide_hashes = Column(JSON)   # {"<slide_num>": sha256 of title + text}
+    structure = Column(JSON)      # Pass 1 output (after the sub-topic cap)
+    expansions = Column(JSON)     # {sub_topic name: Pass 2 {nodes, edges}}
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_lecture_versions_file", "course_id", "week", "file_name"),
+    )
+
+
 # ---------- KNOWLEDGE GRAPH ----------
 
 class KnowledgeGraph(Base):
@@ -108,6 +158,55 @@ class KnowledgeGraph(Base):
 
     node_data = Column(Text)  # JSON string
     edge_data = Column(Text)  # JSON string
+    version = Column(Integer, default=0)  # bumped by every master merge (merge_scheduler.py)
+
+
+class KgNode(Base):
+    """
+    One node of a knowledge graph (kg_store.py). Mirrors knowledge_graph.node_data
+    so single nodes can be looked up without parsing the whole graph.
+    """
+    __tablename__ = "kg_nodes"
+
+    graph_id = Column(String, primary_key=True)   # knowledge_graph.id
+    node_id = Column(String, primary_key=True)
+    position = Column(Integer)                    # index in node_data
+    label = Column(String, nullable=True)
+    level = Column(Integer, nullable=True)
+    data = Column(JSON)                           # the full node dict
+
+
+class KgEdge(Base):
+    """One edge of a knowledge graph; mirrors knowledge_graph.edge_data."""
+    __tablename__ = "kg_edges"
+
+    graph_id = Column(String, primary_key=True)
+    position = Column(Integer, primary_key=True)  # index in edge_data
+    source = Column(String)
+    target = Column(String)
+    relation = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index("ix_kg_edges_source", "graph_id", "source"),
+        Index("ix_kg_edges_target", "graph_id", "target"),
+    )
+
+
+class MasterMergeRequest(Base):
+    """
+    Merge bookkeeping for one (course, week) master graph: a request counter
+    for debouncing, and a lease that serialises merges across worker processes.
+    """
+    __tablename__ = "master_merge_requests"
+
+    course_id = Column(String, primary_key=True)
+    week = Column(Integer, primary_key=True)
+    requested_seq = Column(Integer, default=0)   # bumped whenever a file graph of the week changes
+    merged_seq = Column(Integer, default=0)      # highest requested_seq the master graph reflects
+    requested_at = Column(Float, nullable=True)  # epoch seconds of the latest request
+    merged_at = Column(Float, nullable=True)
+    lock_owner = Column(String, nullable=True)
+    lock_expires_at = Column(Float, nullable=True)
 
 
 # ---------- QUIZZES & MCQs ----------
@@ -126,6 +225,20 @@ class Quiz(Base):
     mcqs = relationship("MCQ", back_populates="quiz")
 
 
+DIFFICULTY_RANKS = {"easy": 1, "medium": 2, "hard": 3}
+BLOOM_RANKS = {"Remember": 1, "Understand": 2, "Apply": 3, "Analyze": 4, "Evaluate": 5, "Create": 6}
+
+
+def difficulty_rank(difficulty) -> int:
+    """1-3; missing or unrecognised difficulties count as Medium."""
+    return DIFFICULTY_RANKS.get((difficulty or "Medium").strip().lower(), 2)
+
+
+def bloom_rank(bloom_level) -> int:
+    """1-6 in Bloom order; missing counts as Remember, unrecognised levels are 0 (never in range)."""
+    return BLOOM_RANKS.get((bloom_level or "Remember").strip().title(), 0)
+
+
 class MCQ(Base):
     __tablename__ = "mcq"  
 
@@ -137,9 +250,26 @@ class MCQ(Base):
     answer = Column(String(255), nullable=False)
     difficulty = Column(String(20), default="Medium")
     bloom_level = Column(String(20), default="Remember")  
+    # Normalised copies of difficulty / bloom_level for indexed range filters;
+    # kept in sync by the listener below
+    difficulty_rank = Column(Integer, nullable=True)
+    bloom_rank = Column(Integer, nullable=True)
 
     quiz = relationship("Quiz", back_populates="mcqs")
 
+    __table_args__ = (
+        Index("ix_mcq_quiz_concept_rank", "quiz_id", "concept_id", "bloom_rank", "difficulty_rank"),
+        # Quiz start filters on the rank ranges across all concepts
+        Index("ix_mcq_quiz_rank", "quiz_id", "bloom_rank", "difficulty_rank"),
+    )
+
+
+@event.listens_for(MCQ, "before_insert")
+@event.listens_for(MCQ, "before_update")
+def _set_mcq_ranks(mapper, connection, target):
+    target.difficulty_rank = difficulty_rank(target.difficulty)
+    target.bloom_rank = bloom_rank(target.bloom_level)
+
 
 class QuizSettings(Base):
     __tablename__ = "quiz_settings"
@@ -172,6 +302,10 @@ class QuizAttempt(Base):
     total_questions = Column(Integer, default=0) 
     completed = Column(Boolean, default=False)
 
+    __table_args__ = (
+        Index("ix_quiz_attempts_student_quiz", "student_id", "quiz_id", "completed"),
+    )
+
 
 class MCQResponse(Base):
     __tablename__ = "mcq_responses"
@@ -188,3 +322,24 @@ class MCQResponse(Base):
         Index("ix_mcq_response_attempt", "attempt_id"),
         Index("ix_mcq_response_mcq", "mcq_id"),
     )
+
+
+class StudentMastery(Base):
+    """
+    Running correct/total counts of a student's answers in completed attempts,
+    per quiz, concept and Bloom level. Maintained by mastery.apply_attempt in
+    the transaction that completes (or changes) an attempt.
+    """
+    __tablename__ = "student_mastery"
+
+    student_id = Column(String(50), primary_key=True)
+    course_id = Column(String, primary_key=True)
+    quiz_id = Column(String(50), primary_key=True)
+    concept_id = Column(String(36), primary_key=True)  # "unknown" if the MCQ has none
+    bloom_level = Column(String(20), primary_key=True)  # Title case, as in BLOOM_RANKS
+    correct = Column(Integer, nullable=False, default=0)
+    total = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index("ix_student_mastery_quiz", "student_id", "quiz_id"),
+    )
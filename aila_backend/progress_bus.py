@@ -0,0 +1,174 @@
+# aila_backend/progress_bus.py
+"""
+Push-based progress for lecture jobs.
+
+The pipeline and the job queue (usually inside worker.py processes) call
+publish() at each stage: extracted, Pass 1 done, sub-topic k/n, merged, done.
+Events travel over a channel every process can reach:
+
+  sqlite (default) — rows appended to processing_events.
+  redis            — Redis pub/sub on AILA_REDIS_URL (AILA_JOB_BACKEND=redis).
+
+In the web process, one relay (ProgressHub) reads that channel and fans the
+events out to the SSE / WebSocket subscribers in main.py. Its cost does not
+grow with the number of open browser tabs: on SQLite it is one indexed
+"id > last seen" query every RELAY_INTERVAL, and only while someone is
+subscribed. Clients get a snapshot of the status row on connect, then events.
+
+    publish(processing_id, "pass2", progress=55, done=3, total=6)
+    queue = await hub.subscribe(processing_id)   # asyncio.Queue of event dicts
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+
+from aila_backend.database import SessionLocal
+from aila_backend.models import ProcessingEvent
+
+
+BUS_BACKEND     = os.environ.get("AILA_PROGRESS_BUS", os.environ.get("AILA_JOB_BACKEND", "sqlite")).lower()
+REDIS_URL       = os.environ.get("AILA_REDIS_URL", "redis://localhost:6379/0")
+REDIS_CHANNEL   = "aila-lecture-progress"
+RELAY_INTERVAL  = float(os.environ.get("AILA_PROGRESS_RELAY_INTERVAL", 0.5))
+EVENT_TTL       = 3600   # seconds processing_events rows are kept
+TERMINAL_STATUSES = ("done", "error")
+
+_redis = None
+_redis_lock = threading.Lock()
+
+
+def _redis_client():
+    global _redis
+    with _redis_lock:
+        if _redis is None:
+            from redis import Redis
+            _redis = Redis.from_url(REDIS_URL)
+        return _redis
+
+
+def publish(processing_id: str, stage: str, progress: int = None, status: str = None, **detail):
+    """
+    Publish one progress event. Never raises: progress reporting must not
+    fail a lecture job.
+    """
+    event = {"processing_id": processing_id, "stage": stage, "ts": time.time()}
+    if progress is not None:
+        event["progress"] = int(progress)
+    if status is not None:
+        event["status"] = status
+    event.update(detail)
+    try:
+        if BUS_BACKEND == "redis":
+            _redis_client().publish(REDIS_CHANNEL, json.dumps(event))
+        else:
+            db = SessionLocal()
+            try:
+                db.add(ProcessingEvent(processing_id=processing_id, payload=event, created_at=event["ts"]))
+                db.commit()
+            finally:
+                db.close()
+    except Exception as e:
+        print(f"[PROGRESS] publish failed for {processing_id}: {e}")
+    return event
+
+
+class ProgressHub:
+    """Relays published events to in-process subscribers (one asyncio.Queue each)."""
+
+    def __init__(self):
+        self._subs = {}        # processing_id -> set of asyncio.Queue
+        self._loop = None
+        self._relay = None     # asyncio.Task (sqlite) or thread (redis)
+        self._last_id = None
+        self._last_prune = 0.0
+
+    def subscriber_count(self) -> int:
+        return sum(len(qs) for qs in self._subs.values())
+
+    async def subscribe(self, processing_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=256)
+        self._subs.setdefault(processing_id, set()).add(queue)
+        if BUS_BACKEND != "redis" and self._last_id is None:
+            # Pin the cursor before the caller reads its snapshot, so nothing
+            # published in between is missed
+            self._last_id, _ = await asyncio.to_thread(self._fetch_since, None)
+        self._ensure_relay()
+        return queue
+
+    def unsubscribe(self, processing_id: str, queue: asyncio.Queue):
+        queues = self._subs.get(processing_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subs[processing_id]
+
+    def _dispatch(self, event: dict):
+        for queue in list(self._subs.get(event.get("processing_id"), ())):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                pass  # a stalled client only misses intermediate steps
+
+    def _ensure_relay(self):
+        self._loop = asyncio.get_running_loop()
+        if BUS_BACKEND == "redis":
+            if self._relay is None or not self._relay.is_alive():
+                self._relay = threading.Thread(target=self._redis_relay, name="progress-relay", daemon=True)
+                self._relay.start()
+        elif self._relay is None or self._relay.done():
+            self._relay = self._loop.create_task(self._sqlite_relay())
+
+    # ── sqlite: tail processing_events ───────────────────────────────────────
+    def _fetch_since(self, last_id):
+        db = SessionLocal()
+        try:
+            if last_id is None:
+                # start at the current tail; older events are covered by the snapshot
+                newest = db.query(ProcessingEvent.id).order_by(ProcessingEvent.id.desc()).first()
+                return (newest[0] if newest else 0), []
+            rows = db.query(ProcessingEvent.id, ProcessingEvent.processing_id, ProcessingEvent.payload).filter(
+                ProcessingEvent.id > last_id
+            ).order_by(ProcessingEvent.id).all()
+            now = time.time()
+            if now - self._last_prune > 60:
+                self._last_prune = now
+                db.query(ProcessingEvent).filter(ProcessingEvent.created_at < now - EVENT_TTL).delete()
+                db.commit()
+            return (rows[-1][0] if rows else last_id), rows
+        finally:
+            db.close()
+
+    async def _sqlite_relay(self):
+        while self._subs:
+            try:
+                self._last_id, rows = await asyncio.to_thread(self._fetch_since, self._last_id)
+                for _, processing_id, payload in rows:
+                    if processing_id in self._subs:
+                        self._dispatch(payload)
+            except Exception as e:
+                print(f"[PROGRESS] relay error: {e}")
+            await asyncio.sleep(RELAY_INTERVAL)
+        # idle: the next subscriber restarts the relay; its snapshot covers the gap
+        self._last_id = None
+
+    # ── redis: pub/sub listener thread ───────────────────────────────────────
+    def _redis_relay(self):
+        pubsub = _redis_client().pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(REDIS_CHANNEL)
+        try:
+            for message in pubsub.listen():
+                try:
+                    event = json.loads(message["data"])
+                except (TypeError, ValueError):
+                    continue
+                if event.get("processing_id") in self._subs:
+                    self._loop.call_soon_threadsafe(self._dispatch, event)
+        except Exception as e:
+            print(f"[PROGRESS] redis relay stopped: {e}")
+        finally:
+            pubsub.close()
+
+
+hub = ProgressHub()
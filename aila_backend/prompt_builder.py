@@ -0,0 +1,184 @@
+# aila_backend/prompt_builder.py
+"""
+Token-budgeted prompt assembly shared by every LLM call site.
+
+Context used to be trimmed by character slicing (``[:10000]``, ``[:1200]``
+...), which under-fills the window on dense text and overruns it on code
+heavy slides. Everything here counts tokens instead:
+
+- ``count_tokens`` / ``fit_tokens``  — count or trim a single string
+- ``pack_blocks``                    — choose whole blocks (slides, KG nodes)
+                                       by priority until the budget is spent,
+                                       then emit them in their original order
+- ``budget_for``                     — the per-call-site budget, clamped so the
+                                       whole prompt stays under the model's cap
+
+Counts use tiktoken's cl100k_base encoding. It is not Gemini's tokenizer but
+tracks it far more closely than characters do; if the encoding can't be
+loaded (no network on first use) we fall back to ~4 chars per token.
+
+``prompt_log`` keeps recent (call site, prompt tokens, latency) samples so
+prompt size can be correlated with latency — see /api/llm/prompt-stats.
+"""
+import threading
+import time
+from collections import defaultdict, deque
+
+try:
+    import tiktoken
+except ImportError:  # optional: fall back to the char heuristic
+    tiktoken = None
+
+
+ENCODING_NAME = "cl100k_base"
+
+# Hard cap on the whole prompt per model. Both Flash models accept far more,
+# but latency and free-tier TPM grow with input, so we stay well under.
+MODEL_PROMPT_BUDGETS = {
+    "models/gemini-2.5-flash": 32000,
+    "models/gemini-1.5-flash": 32000,
+}
+DEFAULT_MODEL_BUDGET = 16000
+
+# Budget for the variable (context) part of each prompt, in tokens.
+SITE_BUDGETS = {
+    "pass1_structure": 7000,   # whole-lecture slide text, or one window of a long lecture
+    "pass1_reduce":    6000,   # partial structures merged in one reduce call
+    "pass2_subtopic":  2500,   # slides anchored to one sub-topic
+    "kg_single_pass":  3750,
+    "mcq_summary":     200,    # per concept
+    "mcq_contents":    300,    # per concept
+    "mcq_batch":       6000,   # all concept blocks in one batch prompt
+}
+DEFAULT_SITE_BUDGET = 2000
+
+_encoder = None
+_encoder_failed = False
+_encoder_lock = threading.Lock()
+
+
+def _get_encoder():
+    global _encoder, _encoder_failed
+    if _encoder is not None or _encoder_failed:
+        return _encoder
+    with _encoder_lock:
+        if _encoder is None and not _encoder_failed:
+            try:
+                _encoder = tiktoken.get_encoding(ENCODING_NAME)
+            except Exception as e:
+                # tiktoken missing, or the BPE file can't be fetched — don't retry per call
+                _encoder_failed = True
+                print(f"[PROMPT] tiktoken unavailable ({type(e).__name__}); using ~4 chars/token estimate")
+    return _encoder
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    enc = _get_encoder()
+    if enc is None:
+        return len(text) // 4 + 1
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def fit_tokens(text: str, max_tokens: int) -> str:
+    """Trim text to at most max_tokens, cutting on a token (or char) boundary."""
+    if not text or max_tokens <= 0:
+        return ""
+    enc = _get_encoder()
+    if enc is None:
+        return text[: max_tokens * 4]
+    tokens = enc.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return enc.decode(tokens[:max_tokens])
+
+
+def budget_for(model_name: str, call_site: str, template: str = "") -> int:
+    """
+    Tokens available for context at this call site: the site's budget, but
+    never more than what's left of the model's cap after the fixed template.
+    """
+    site = SITE_BUDGETS.get(call_site, DEFAULT_SITE_BUDGET)
+    model_cap = MODEL_PROMPT_BUDGETS.get(model_name, DEFAULT_MODEL_BUDGET)
+    return max(0, min(site, model_cap - count_tokens(template)))
+
+
+def pack_blocks(blocks: list, budget: int, priorities: list = None,
+                separator: str = "\n\n", truncate_first: bool = True) -> str:
+    """
+    Pick whole blocks, highest priority first (ties keep input order), skipping
+    any that no longer fit, and join the survivors in their original order.
+    If not even the top block fits, a trimmed copy of it is used rather than
+    returning nothing.
+    """
+    if not blocks or budget <= 0:
+        return ""
+    priorities = priorities or [0] * len(blocks)
+    sep_cost = count_tokens(separator)
+    order = sorted(range(len(blocks)), key=lambda i: -priorities[i])
+    chosen, used = set(), 0
+    for i in order:
+        cost = count_tokens(blocks[i]) + (sep_cost if chosen else 0)
+        if used + cost <= budget:
+            chosen.add(i)
+            used += cost
+    if not chosen:
+        return fit_tokens(blocks[order[0]], budget) if truncate_first else ""
+    return separator.join(blocks[i] for i in sorted(chosen))
+
+
+class PromptLog:
+    """Bounded ring of prompt-size / latency samples, summarised per call site."""
+
+    def __init__(self, maxlen: int = 500):
+        self.maxlen = maxlen
+        self._samples = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def record(self, call_site: str, model_name: str, prompt_tokens: int,
+               latency: float, cached: bool = False):
+        with self._lock:
+            self._samples.append({
+                "call_site": call_site or "unnamed",
+                "model": model_name,
+                "prompt_tokens": prompt_tokens,
+                "latency_s": round(latency, 3),
+                "cached": cached,
+                "at": time.time(),
+            })
+
+    def extend(self, samples):
+        """Add samples recorded elsewhere (another process's recent()); keeps time order."""
+        with self._lock:
+            merged = sorted([*self._samples, *samples], key=lambda s: s["at"])
+            self._samples.clear()
+            self._samples.extend(merged)
+
+    def recent(self, limit: int = 50) -> list:
+        with self._lock:
+            return list(self._samples)[-limit:]
+
+    def summary(self) -> dict:
+        with self._lock:
+            samples = list(self._samples)
+        by_site = defaultdict(list)
+        for s in samples:
+            if not s["cached"]:
+                by_site[s["call_site"]].append(s)
+        out = {}
+        for site, rows in by_site.items():
+            tokens = [r["prompt_tokens"] for r in rows]
+            latency = [r["latency_s"] for r in rows]
+            out[site] = {
+                "calls": len(rows),
+                "avg_prompt_tokens": round(sum(tokens) / len(tokens), 1),
+                "max_prompt_tokens": max(tokens),
+                "avg_latency_s": round(sum(latency) / len(latency), 3),
+                # seconds per 1k prompt tokens — rough cost of extra context
+                "latency_per_1k_tokens": round(sum(latency) / max(1, sum(tokens)) * 1000, 3),
+            }
+        return out
+
+
+prompt_log = PromptLog()
@@ -0,0 +1,170 @@
+# aila_backend/slide_extraction.py
+"""
+Slide text extraction for the lecture pipeline (PDF via PyMuPDF, PPTX via
+python-pptx).
+
+Large PDFs are split into page ranges and the ranges are extracted in a
+process pool; results come back in page order. Each PDF page is read once,
+with a single ``get_text("dict")`` pass that yields both the body text and
+the title (the largest-font span). Before this, every page did a ``sort=True``
+text pass and then a separate dict pass.
+
+Small decks are extracted in-process: below MIN_PAGES_FOR_POOL, handing the
+work to another process costs more than it saves. PPTX is always extracted
+in-process in one pass: python-pptx can't open a slide range, so every
+shard would parse the whole file again.
+
+    segments, stats = extract_slides(path)
+    # segments: [{"slide_num", "text", "title"}], stats: pages, seconds, pages_per_sec, ...
+"""
+import math
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+
+import fitz  # PyMuPDF
+from pptx import Presentation
+
+
+EXTRACT_PROCESSES  = int(os.environ.get("AILA_EXTRACT_PROCESSES", min(4, os.cpu_count() or 1)))
+MIN_PAGES_FOR_POOL = int(os.environ.get("AILA_EXTRACT_MIN_PAGES", 24))
+MIN_SHARD_PAGES    = 8
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    """One long-lived pool per process, so interpreter start-up is paid once."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: workers calling this run threads (lease heartbeat, LLM loop)
+            # that must not be forked mid-flight
+            _pool = ProcessPoolExecutor(
+                max_workers=EXTRACT_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+# ── per-format extractors (run inside pool workers) ───────────────────────
+def _pdf_page(page, slide_num: int):
+    """Text and title of one page from a single dict pass, or None if blank."""
+    lines_out, biggest = [], None
+    for block in page.get_text("dict", sort=True)["blocks"]:
+        for line in block.get("lines", []):
+            spans = line.get("spans", [])
+            text = "".join(s.get("text", "") for s in spans)
+            if text.strip():
+                lines_out.append(text)
+            for s in spans:
+                if s.get("text", "").strip() and (biggest is None or s["size"] > biggest["size"]):
+                    biggest = s
+    text = "\n".join(lines_out)
+    if not text.strip():
+        return None
+    title = f"Slide {slide_num}"
+    if biggest is not None:
+        candidate = biggest["text"].strip()
+        if len(candidate) > 3:  # ignore single chars / page numbers
+            title = candidate
+    return {"slide_num": slide_num, "text": text, "title": title}
+
+
+def _extract_pdf_range(path: str, start: int, stop: int) -> list:
+    out = []
+    with fitz.open(path) as doc:
+        for i in range(start, stop):
+            seg = _pdf_page(doc[i], i + 1)
+            if seg:
+                out.append(seg)
+    return out
+
+
+def _pptx_slide(slide, slide_num: int):
+    default_title = f"Slide {slide_num}"
+    title, lines = default_title, []
+    for shape in slide.shapes:
+        # Title = first non-empty text frame
+        if shape.has_text_frame and shape.text_frame.text.strip():
+            text = shape.text_frame.text
+            if title == default_title:
+                title = text.strip().splitlines()[0][:120]
+            lines.append(text)
+        if getattr(shape, "has_table", False) and shape.has_table:
+            for row in shape.table.rows:
+                row_text = "\t".join(c.text.strip() for c in row.cells if c.text.strip())
+                if row_text:
+                    lines.append(row_text)
+    content = "\n".join(lines)
+    if not content.strip():
+        return None
+    return {"slide_num": slide_num, "text": content, "title": title}
+
+
+def _extract_pptx(path: str):
+    """(segments, slide count) from a single parse of the file."""
+    slides = list(Presentation(path).slides)
+    return [seg for i, slide in enumerate(slides) if (seg := _pptx_slide(slide, i + 1))], len(slides)
+
+
+# ── driver ─────────────────────────────────────────────────────────────────
+def _page_count(path: str) -> int:
+    with fitz.open(path) as doc:
+        return doc.page_count
+
+
+def _shards(pages: int, workers: int) -> list:
+    # ~2 shards per worker smooths out uneven pages without much overhead
+    size = max(MIN_SHARD_PAGES, math.ceil(pages / max(1, workers * 2)))
+    return [(s, min(s + size, pages)) for s in range(0, pages, size)]
+
+
+def extract_slides(path: str):
+    """Return (segments in slide order, stats dict). Unsupported types yield no segments."""
+    ext = os.path.splitext(path)[-1].lower()
+    if ext not in (".pdf", ".pptx"):
+        return [], {"pages": 0, "segments": 0, "seconds": 0.0, "pages_per_sec": 0.0, "processes": 0}
+
+    started = time.perf_counter()
+    processes = 1
+    segments = None
+    if ext == ".pptx":
+        segments, pages = _extract_pptx(path)
+    else:
+        pages = _page_count(path)
+    if segments is None and EXTRACT_PROCESSES > 1 and pages >= MIN_PAGES_FOR_POOL:
+        shards = _shards(pages, EXTRACT_PROCESSES)
+        try:
+            pool = _get_pool()
+            futures = [pool.submit(_extract_pdf_range, path, s, e) for s, e in shards]
+            segments = [seg for f in futures for seg in f.result()]  # submission order = page order
+            processes = min(EXTRACT_PROCESSES, len(shards))
+        except BrokenProcessPool as e:
+            print(f"[EXTRACT] Process pool failed ({e}); extracting in-process")
+            _reset_pool()
+    if segments is None:
+        segments = _extract_pdf_range(path, 0, pages)
+
+    seconds = time.perf_counter() - started
+    stats = {
+        "pages": pages,
+        "segments": len(segments),
+        "seconds": round(seconds, 3),
+        "pages_per_sec": round(pages / seconds, 1) if seconds > 0 else None,
+        "processes": processes,
+    }
+    print(f"📑 [EXTRACT] {pages} pages → {len(segments)} slides in {seconds:.2f}s "
+          f"({stats['pages_per_sec']} pages/s, {processes} process(es))")
+    return segments, stats
@@ -0,0 +1,50 @@
+# aila_backend/upload_store.py
+"""
+Content-addressed storage for uploaded lecture files.
+
+Uploads are streamed to disk in chunks while their SHA-256 is computed, then
+moved to ``db/uploads/blobs/<first two hex chars>/<sha256><ext>``. The same
+deck uploaded twice, into any course, is stored once, and the hash tells the
+pipeline it has already processed this content (see upload_lecture).
+"""
+import hashlib
+import os
+import uuid
+
+
+BLOB_DIR   = os.path.join("db", "uploads", "blobs")
+TMP_DIR    = os.path.join("db", "uploads", "tmp")
+CHUNK_SIZE = 1024 * 1024
+
+
+def blob_path(content_hash: str, ext: str) -> str:
+    return os.path.join(BLOB_DIR, content_hash[:2], f"{content_hash}{ext.lower()}")
+
+
+async def store_upload(upload_file) -> tuple:
+    """
+    Stream a FastAPI UploadFile into the blob store.
+    Returns (sha256 hex, path, already_stored).
+    """
+    os.makedirs(TMP_DIR, exist_ok=True)
+    ext = os.path.splitext(upload_file.filename or "")[-1]
+    tmp_path = os.path.join(TMP_DIR, f"{uuid.uuid4()}{ext}")
+    hasher = hashlib.sha256()
+    try:
+        with open(tmp_path, "wb") as out:
+            while True:
+                chunk = await upload_file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                out.write(chunk)
+        content_hash = hasher.hexdigest()
+        path = blob_path(content_hash, ext)
+        if os.path.exists(path):
+            return content_hash, path, True
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)  # atomic: a blob is never seen half-written
+        return content_hash, path, False
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
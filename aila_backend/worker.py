@@ -0,0 +1,75 @@
+# aila_backend/worker.py
+"""
+Lecture-processing worker processes.
+
+    python worker.py --processes 2          # from aila_backend/, next to aila.db
+    AILA_JOB_BACKEND=redis python worker.py # rq workers instead of SQLite polling
+
+Each process claims jobs from the queue (job_queue.py) one at a time, so
+PyMuPDF parsing and LLM calls never compete with the web server. SIGTERM
+or Ctrl-C finishes the current job before exiting; an interrupted job is
+picked up again once its lease runs out.
+
+Each process publishes its metrics for the web server's /api/metrics
+(metrics_share.py), and gets its LLM tokens from the quota shared with the
+web server (llm_quota.py).
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+
+if __package__ in (None, ""):
+    # Run as a script: make `aila_backend.*` importable like it is for uvicorn
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from aila_backend.job_queue import get_queue, make_worker_id
+from aila_backend.metrics_share import start_publishing
+
+
+def _worker_main(index: int):
+    stop = threading.Event()
+
+    def _stop(signum, frame):
+        print(f"[WORKER {index}] stopping after the current job...")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    publisher = start_publishing(f"worker-{index}", stop)
+    get_queue().work(make_worker_id(f"w{index}"), stop_event=stop)
+    stop.set()
+    publisher.join(timeout=10)  # last publish, so the final job's metrics aren't lost
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run AILA lecture-processing workers")
+    parser.add_argument("--processes", type=int, default=int(os.environ.get("AILA_WORKER_PROCESSES", 2)))
+    args = parser.parse_args()
+
+    queue = get_queue()
+    print(f"[WORKER] Starting {args.processes} {queue.name} worker process(es)")
+    if args.processes <= 1:
+        _worker_main(0)
+        return
+
+    ctx = multiprocessing.get_context("spawn")  # no inherited DB connections or threads
+    procs = [ctx.Process(target=_worker_main, args=(i,), name=f"aila-worker-{i}") for i in range(args.processes)]
+    for p in procs:
+        p.start()
+
+    def _forward(signum, frame):
+        for p in procs:
+            if p.is_alive():
+                os.kill(p.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, _forward)
+    signal.signal(signal.SIGINT, _forward)
+    for p in procs:
+        p.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+# aila_backend/write_queue.py
+"""
+Group commit for the quiz write path.
+
+Each quiz endpoint used to commit on its own. Under a deadline burst every
+commit is a separate SQLite transaction (lock, journal write, fsync), and
+the writers queue up on the database lock. Now those endpoints hand their
+writes to one writer thread instead:
+
+    def write(wdb):                       # runs on the writer's session
+        attempt = wdb.get(QuizAttempt, attempt_id)
+        attempt.completed = True
+        return attempt.score              # plain values only: the session closes after commit
+    score = await db_writer.run(write, release=db)
+
+The writer takes whatever writes are queued, waits up to WINDOW_MS for more
+(at most MAX_BATCH), runs them in order on one session and commits once.
+Every caller's future resolves when that commit is done, with its function's
+return value or exception. If anything in a batch fails, the batch is rolled
+back and each write is re-run in a transaction of its own. One bad write
+then fails only its own caller. So a write function must only change the
+database through the session it is given, and must be safe to run twice.
+
+The engine runs SQLite in WAL mode with a busy_timeout (database.py). Reads
+in request sessions don't block the writer, and writers in other processes
+(workers, the pipeline) wait for the lock instead of failing.
+
+Metrics: write_queue_batch_size (histogram), write_queue_wait_seconds (queued
+to committed), write_queue_commits_total{outcome}.
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+
+from aila_backend.database import SessionLocal
+from aila_backend.metrics import metrics
+
+
+WINDOW_MS = float(os.environ.get("AILA_WRITE_BATCH_WINDOW_MS", 2))   # wait this long for more writes
+MAX_BATCH = int(os.environ.get("AILA_WRITE_BATCH_MAX", 128))         # writes per transaction
+BATCH_BUCKETS = (1, 2, 5, 10, 25, 50, 100)
+
+
+def _resolve(fut, result, exc):
+    if fut.cancelled():
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(result)
+
+
+class GroupCommitWriter:
+    def __init__(self, session_factory=SessionLocal, window_ms: float = WINDOW_MS, max_batch: int = MAX_BATCH):
+        self.session_factory = session_factory
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="aila-db-writer", daemon=True)
+                self._thread.start()
+
+    async def run(self, fn, release=None):
+        """
+        Queue fn(session) for the next group commit; returns its result once
+        committed. release: the request's own session. It is closed first, so
+        requests waiting here don't hold pooled connections the writer needs.
+        Attributes already loaded stay readable after close.
+        """
+        if release is not None:
+            release.close()
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._ensure_started()
+        self._queue.put((fn, loop, fut, time.perf_counter()))
+        return await fut
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            metrics.observe("write_queue_batch_size", len(batch), buckets=BATCH_BUCKETS)
+            if not self._commit(batch):
+                metrics.inc("write_queue_commits_total", outcome="split")
+                for item in batch:
+                    self._commit([item], alone=True)
+
+    def _commit(self, batch, alone: bool = False) -> bool:
+        """Run and commit a batch. False if it failed and should be re-run write by write."""
+        db = self.session_factory()
+        results = []
+        try:
+            for fn, _, _, _ in batch:
+                results.append(fn(db))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            if not alone and len(batch) > 1:
+                return False
+            metrics.inc("write_queue_commits_total", outcome="error")
+            self._settle(batch, [None] * len(batch), e)
+            return True
+        finally:
+            db.close()
+        metrics.inc("write_queue_commits_total", outcome="ok")
+        self._settle(batch, results, None)
+        return True
+
+    def _settle(self, batch, results, exc):
+        now = time.perf_counter()
+        for (_, loop, fut, queued_at), result in zip(batch, results):
+            metrics.observe("write_queue_wait_seconds", now - queued_at)
+            try:
+                loop.call_soon_threadsafe(_resolve, fut, result, exc)
+            except RuntimeError:
+                pass  # the caller's loop has closed; nobody is waiting
+
+
+db_writer = GroupCommitWriter()
@@ -12,6 +12,7 @@ export default function AdaptiveQuiz({ quizId, studentId, attemptId: attemptIdPr
   const [done, setDone] = useState(false);
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState("");
+  const [retryTick, setRetryTick] = useState(0); // bumped to re-ask while the question bank warms up
 
   // Start a new attempt if not given
   useEffect(() => {
@@ -41,6 +42,7 @@ export default function AdaptiveQuiz({ quizId, studentId, attemptId: attemptIdPr
   // Fetch next MCQ whenever attemptId changes or after answer submission
   useEffect(() => {
     if (!attemptId) return;
+    let retryTimer = null;
     setLoading(true);
     setError("");
     (async () => {
@@ -49,6 +51,11 @@ export default function AdaptiveQuiz({ quizId, studentId, attemptId: attemptIdPr
           `${BACKEND_URL}/api/quiz/attempt/next?attempt_id=${attemptId}`
         );
         const data = await res.json();
+        if (data.pending) {
+          // Questions are being generated in the background — ask again shortly
+          retryTimer = setTimeout(() => setRetryTick((t) => t + 1), (data.retry_after || 2) * 1000);
+          return;
+        }
         if (data.done) {
           setDone(true);
           setMcq(null);
@@ -72,8 +79,9 @@ export default function AdaptiveQuiz({ quizId, studentId, attemptId: attemptIdPr
       }
       setLoading(false);
     })();
+    return () => clearTimeout(retryTimer); // no polling after unmount or once the effect re-runs
     // eslint-disable-next-line
-  }, [attemptId, answers.length]);
+  }, [attemptId, answers.length, retryTick]);
 
   function quit() {
     setDone(true);
@@ -2,8 +2,8 @@
 import useProcessingStatus from "../hooks/useProcessingStatus";
 import ProgressBar from "./ProgressBar";
 
-export default function ProcessingFileStatus({ processingId, fileName }) {
-  const { progress, status, error } = useProcessingStatus(processingId);
+export default function ProcessingFileStatus({ processingId, fileName, onStage, onDone }) {
+  const { progress, status, error } = useProcessingStatus(processingId, { onStage, onDone });
 
   return (
     <div className="my-2 p-2 border rounded bg-white">
@@ -1,34 +1,47 @@
 // app/hooks/useProcessingStatus.js
-import { useState, useEffect } from "react";
-import axios from "axios";
+import { useState, useEffect, useRef } from "react";
 
 const BACKEND_URL = process.env.NEXT_PUBLIC_BACKEND_URL || "http://localhost:8000";
 
-export default function useProcessingStatus(processingId) {
+// Subscribes to the lecture job's Server-Sent Events stream: a snapshot on
+// connect, then one event per pipeline stage, until the job is done/errored.
+// onStage(processingId, stage) / onDone(processingId) are optional callbacks.
+export default function useProcessingStatus(processingId, { onStage, onDone } = {}) {
   const [status, setStatus] = useState("pending");
   const [progress, setProgress] = useState(0);
+  const [stage, setStage] = useState(null);
   const [error, setError] = useState(null);
+  const callbacks = useRef({ onStage, onDone });
+  callbacks.current = { onStage, onDone };
 
   useEffect(() => {
     if (!processingId) return;
 
-    let interval = setInterval(async () => {
-      try {
-        const res = await axios.get(
-          `${BACKEND_URL}/api/lecture-status/?processing_id=${processingId}`
-        );
-        setStatus(res.data.status);
-        setProgress(res.data.progress);
-        setError(res.data.error || null);
-        if (["done", "error"].includes(res.data.status)) clearInterval(interval);
-      } catch (e) {
-        setError("Network error");
-        clearInterval(interval);
+    const source = new EventSource(
+      `${BACKEND_URL}/api/lecture-status/stream?processing_id=${processingId}`
+    );
+
+    source.onmessage = (msg) => {
+      const data = JSON.parse(msg.data);
+      if (data.status) setStatus(data.status);
+      if (typeof data.progress === "number") setProgress(data.progress);
+      if (data.stage) {
+        setStage(data.stage);
+        callbacks.current.onStage?.(processingId, data.stage);
       }
-    }, 2000);
+      setError(data.error || null);
+      if (["done", "error"].includes(data.status)) source.close();
+      if (data.status === "done") callbacks.current.onDone?.(processingId);
+    };
+
+    // EventSource reconnects by itself (and gets a fresh snapshot);
+    // only a stream that was closed for good is an error.
+    source.onerror = () => {
+      if (source.readyState === EventSource.CLOSED) setError("Network error");
+    };
 
-    return () => clearInterval(interval);
+    return () => source.close();
   }, [processingId]);
 
-  return { progress, status, error };
-}
\ No newline at end of file
+  return { progress, status, stage, error };
+}
@@ -563,45 +563,20 @@ export default function CourseWeekPage({ params }) {
     }
   }, [selectedQuizId]); 
 
-  // Polling Effect
-  useEffect(() => {
-    if (processingFiles.length === 0) return;
-  
-    const interval = setInterval(async () => {
-      const results = await Promise.all(
-        processingFiles.map(async (f) => {
-          try {
-            const res = await fetch(
-              `${BACKEND_URL}/api/lecture-status?processing_id=${f.processingId}`
-            );
-            const data = await safeJson(res);
-            if (data.status === "processing" && data.progress >= 20) {
-                fetchKnowledgeGraph(); 
-            }
-            return { ...data, processingId: f.processingId };
-          } catch {
-            return { status: "error", processingId: f.processingId };
-          }
-        })
-      );
-  
-      const doneJobs = results.filter((r) => r.status === "done");
-  
-      if (doneJobs.length > 0) {
-        setProcessingFiles((prev) =>
-          prev.filter((p) => !doneJobs.some((d) => d.processingId === p.processingId))
-        );
-  
-        setTimeout(() => {
-          fetchKnowledgeGraph();
-          fetchQuizzes();
-          setRefreshTrigger((prev) => prev + 1);
-        }, 1000);
-      }
-    }, 2000); 
-  
-    return () => clearInterval(interval);
-  }, [processingFiles, fetchKnowledgeGraph, fetchQuizzes]);
+  // Progress arrives over each file's event stream (ProcessingFileStatus);
+  // these react to its stage changes instead of polling every file.
+  const handleProcessingStage = useCallback((processingId, stage) => {
+    if (stage === "merged") fetchKnowledgeGraph();
+  }, [fetchKnowledgeGraph]);
+
+  const handleProcessingDone = useCallback((processingId) => {
+    setProcessingFiles((prev) => prev.filter((p) => p.processingId !== processingId));
+    setTimeout(() => {
+      fetchKnowledgeGraph();
+      fetchQuizzes();
+      setRefreshTrigger((prev) => prev + 1);
+    }, 1000);
+  }, [fetchKnowledgeGraph, fetchQuizzes]);
   
 
   // --- RENDER HELPERS ---
@@ -730,6 +705,8 @@ export default function CourseWeekPage({ params }) {
                   key={processingId}
                   processingId={processingId}
                   fileName={fileName}
+                  onStage={handleProcessingStage}
+                  onDone={handleProcessingDone}
                 />
               ))}
             </div>
@@ -15,7 +15,18 @@ module.exports = {
       cwd: "./aila_backend",
       script: "python3",
       args: "-m uvicorn main:app --host 0.0.0.0 --port 8000",
-      interpreter: "python3"
+      interpreter: "python3",
+      env: {
+        AILA_EMBEDDED_WORKERS: "0"
+      }
+    },
+    {
+      name: "aila-worker",
+      cwd: "./aila_backend",
+      script: "worker.py",
+      args: "--processes 2",
+      interpreter: "python3",
+      kill_timeout: 60000
     }
   ]
 };